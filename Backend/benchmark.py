@@ -0,0 +1,424 @@
+#***********************************************************************
+#*                 Program: LegalEagleEyeAI benchmark
+#* Runs the backend against local stand-ins for Azure Computer Vision,
+#* Translator, Speech and the OpenAI/Azure OpenAI chat APIs, then drives
+#* /upload, /translate, /speak, /ask and /regenerate at several
+#* concurrency levels with the sample documents in the repository.
+#* Reports p50/p95/p99 latency, throughput and peak server RSS.
+#*
+#* Usage (from Backend/):
+#*   python benchmark.py
+#*   python benchmark.py --concurrency 1,8,32 --requests 64 --output run.json
+#*   python benchmark.py --compare baseline.json
+#*
+#* Stub latency and errors are set with environment variables:
+#*   BENCH_LATENCY_MS        default latency for every stub (ms)
+#*   BENCH_<SERVICE>_LATENCY_MS  per service: OCR, TRANSLATOR, SPEECH, LLM
+#*   BENCH_LATENCY_JITTER    +/- fraction applied to each latency (0.2)
+#*   BENCH_ERROR_RATE        fraction of stub calls answered with a 500
+#*   BENCH_<SERVICE>_ERROR_RATE  per service error rate
+#*   BENCH_RPM / BENCH_<SERVICE>_RPM  quota; calls over it get a 429 with
+#*                           Retry-After (checked per 10s window, like Azure)
+#*   BENCH_SEED              seed for jitter and error injection
+#************************************************************************
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+import requests
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BACKEND_DIR)
+SAMPLES = {
+    "txt": os.path.join(REPO_DIR, "Car rental agreement.txt"),
+    "pdf": os.path.join(REPO_DIR, "lease.pdf"),
+    "image": os.path.join(REPO_DIR, "Apartment Lease Agreement.jpeg"),
+}
+ASK_QUESTION = "What happens if I return the car late or without a full tank?"
+
+#---------------------------
+# Stub upstream services
+#---------------------------
+#Stub setting for a service, e.g. BENCH_OCR_LATENCY_MS, else BENCH_LATENCY_MS
+def stub_setting(service, name, default):
+    value = os.getenv(f"BENCH_{service.upper()}_{name}") or os.getenv(f"BENCH_{name}")
+    return float(value) if value else default
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True #Headers and body go out as separate writes
+    rng = random.Random(int(os.getenv("BENCH_SEED", "42")))
+    rng_lock = threading.Lock()
+    windows = {} #service -> (window start, calls in the window)
+
+    def log_message(self, *args):
+        pass
+
+    def service(self):
+        path = urlparse(self.path).path
+        if path.startswith("/vision/"):
+            return "ocr"
+        if path.endswith("/translate"):
+            return "translator"
+        if path.endswith("/cognitiveservices/v1"):
+            return "speech"
+        if path.endswith("/chat/completions"):
+            return "llm"
+        return None
+
+    def send(self, status, body, content_type="application/json", headers=None):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    #Seconds until the service's quota window resets, 0 if this call fits
+    def throttled(self, service):
+        rpm = stub_setting(service, "RPM", 0.0)
+        if not rpm:
+            return 0
+        with self.rng_lock:
+            now = time.monotonic()
+            start, calls = self.windows.get(service, (now, 0))
+            if now - start >= 10:
+                start, calls = now, 0
+            if calls >= rpm / 6:
+                return 10 - (now - start)
+            self.windows[service] = (start, calls + 1)
+            return 0
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        service = self.service()
+        if service is None:
+            return self.send(404, {"error": f"No stub for {self.path}"})
+        retry_after = self.throttled(service)
+        if retry_after:
+            return self.send(429, {"error": {"message": "Rate limit exceeded", "type": "rate_limit"}},
+                             headers={"Retry-After": str(max(1, round(retry_after)))})
+
+        #Same seed -> same sequence of delays and injected errors
+        latency = stub_setting(service, "LATENCY_MS", 50.0) / 1000
+        jitter = stub_setting(service, "LATENCY_JITTER", 0.2)
+        with self.rng_lock:
+            delay = latency * self.rng.uniform(1 - jitter, 1 + jitter)
+            failed = self.rng.random() < stub_setting(service, "ERROR_RATE", 0.0)
+        time.sleep(max(0.0, delay))
+        if failed:
+            return self.send(500, {"error": {"message": f"Injected {service} failure", "type": "server_error"}})
+        getattr(self, f"reply_{service}")(body)
+
+    def reply_ocr(self, body):
+        #Words sized so the text resembles a one-page lease
+        lines = [{"words": [{"text": word} for word in line.split()]} for line in STUB_OCR_LINES]
+        self.send(200, {"language": "en", "regions": [{"lines": lines}]})
+
+    def reply_translator(self, body):
+        to_lang = parse_qs(urlparse(self.path).query).get("to", ["xx"])[0]
+        texts = [item["Text"] for item in json.loads(body)]
+        self.send(200, [{"translations": [{"text": f"[{to_lang}] {text}", "to": to_lang}]} for text in texts])
+
+    def reply_speech(self, body):
+        #Roughly the size of 128 kbit/s audio for the spoken text
+        spoken = re.sub(r"<[^>]+>", "", body.decode("utf-8", "replace"))
+        self.send(200, b"\xff\xfb" + b"\x00" * (len(spoken) * 1000), "audio/mpeg")
+
+    def reply_llm(self, body):
+        request = json.loads(body)
+        messages = request.get("messages", [])
+        prompt = messages[-1]["content"] if messages else ""
+        if messages and "Title:" in messages[0]["content"]:
+            #Risk prompt: one risk line per numbered/keyword sentence
+            sentences = [s.strip() for s in re.split(r"(?<=[.!?])\s+", prompt) if len(s.strip()) > 20][:8]
+            severities = ["High Risk", "Moderate Risk", "Informational"]
+            content = "Title: Benchmark Agreement\n" + "\n".join(
+                f"- [{severities[i % 3]}] {sentence}" for i, sentence in enumerate(sentences)
+            )
+        else:
+            content = ("Based on the document, returning the vehicle late or without a full tank adds "
+                       "the penalties described in the agreement. Review the fees section before signing. "
+                       "You may also be charged for cleaning. Contact the rental company if anything is unclear.")
+        usage = {"prompt_tokens": len(prompt) // 4 + 1, "completion_tokens": len(content) // 4 + 1}
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        if not request.get("stream"):
+            return self.send(200, {
+                "id": "bench", "object": "chat.completion", "created": int(time.time()), "model": "bench",
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage": usage
+            })
+        events = []
+        for word in re.findall(r"\S+\s*", content):
+            chunk = {"id": "bench", "object": "chat.completion.chunk", "created": int(time.time()), "model": "bench",
+                     "choices": [{"index": 0, "delta": {"content": word}, "finish_reason": None}]}
+            events.append(f"data: {json.dumps(chunk)}\n\n")
+        events.append("data: [DONE]\n\n")
+        self.send(200, "".join(events).encode(), "text/event-stream")
+
+STUB_OCR_LINES = [
+    "RESIDENTIAL LEASE AGREEMENT",
+    "The tenant shall pay rent of $1,200 on the first day of each month.",
+    "A late fee of $50 applies to payments received after the fifth day.",
+    "The security deposit is non-refundable if the lease is terminated early.",
+    "The landlord may share personal data with credit reporting agencies.",
+    "Any dispute shall be resolved by binding arbitration.",
+] * 6
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024 #The backend opens many connections at once
+
+    def handle_error(self, request, client_address):
+        #Keep-alive connections are reset when the backend is stopped
+        if not isinstance(sys.exc_info()[1], ConnectionResetError):
+            super().handle_error(request, client_address)
+
+#Run the stubs in their own process so they don't compete with the
+#load generator for the GIL
+def run_stub_server(port_queue):
+    server = StubServer(("127.0.0.1", 0), StubHandler)
+    port_queue.put(server.server_port)
+    server.serve_forever()
+
+#---------------------------
+# Backend under test
+#---------------------------
+SERVER_CODE = """
+import logging, sys
+import legal_eagleeye_ai as backend
+logging.getLogger().setLevel(sys.argv[2])
+backend.initialize_default_agents()
+backend.app.run(host="127.0.0.1", port=int(sys.argv[1]), threaded=True, debug=False, use_reloader=False)
+"""
+
+def free_port():
+    import socket
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+#Environment pointing every service at the stubs. Every variable is set
+#explicitly (even to "") so values from a local .env are never used.
+def backend_env(stub_url, args, tts_dir):
+    env = dict(os.environ)
+    env.update({
+        "AZURE_CV_ENDPOINT": stub_url, "AZURE_CV_KEY": "bench",
+        "AZURE_TRANSLATOR_ENDPOINT": stub_url, "AZURE_TRANSLATOR_KEY": "bench", "AZURE_TRANSLATOR_REGION": "bench",
+        "SPEECH_ENDPOINT": f"{stub_url}/cognitiveservices/v1", "SPEECH_KEY": "bench", "SPEECH_REGION": "bench",
+        "AZURE_OPENAI_ENDPOINT": "", "AZURE_OPENAI_KEY": "", "AZURE_OPENAI_DEPLOYMENT": "",
+        "AZURE_OPENAI_EMBEDDING_DEPLOYMENT": "", "OPENAI_API_KEY": "", "OPENAI_API_BASE": "",
+        "RESULT_CACHE_DB": "", "TTS_CACHE_DIR": tts_dir,
+    })
+    if args.llm in ("azure", "both"):
+        env.update({"AZURE_OPENAI_ENDPOINT": stub_url, "AZURE_OPENAI_KEY": "bench", "AZURE_OPENAI_DEPLOYMENT": "bench"})
+    if args.llm in ("openai", "both"):
+        env.update({"OPENAI_API_BASE": f"{stub_url}/v1", "OPENAI_API_KEY": "bench"})
+    if not args.warm:
+        #Every request does the full work instead of hitting a result cache
+        env.update({
+            "RESULT_CACHE_SIZE": "0", "RISK_SECTION_CACHE_SIZE": "0", "TRANSLATION_CACHE_SIZE": "0",
+            "TTS_CACHE_MEMORY_BYTES": "0", "TTS_CACHE_DISK_BYTES": "0", "RETRIEVAL_INDEX_CACHE_SIZE": "0",
+            "ANSWER_CACHE_SIZE": "0",
+        })
+    return env
+
+def start_backend(env, log_level):
+    port = free_port()
+    process = subprocess.Popen(
+        [sys.executable, "-c", SERVER_CODE, str(port), log_level],
+        cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Backend exited with code {process.returncode}")
+        try:
+            if requests.get(f"{base_url}/agents", timeout=1).ok:
+                return process, base_url
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    process.kill()
+    raise RuntimeError("Backend did not start within 60s")
+
+#Resident memory of a process in MB from /proc (Linux only)
+def read_rss(pid, field):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith(f"{field}:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+#Reset the peak RSS counter so each run reports its own peak (Linux >= 4.0)
+def reset_peak_rss(pid):
+    try:
+        with open(f"/proc/{pid}/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+#---------------------------
+# Scenarios
+#---------------------------
+def upload(sample):
+    with open(SAMPLES[sample], "rb") as f:
+        data = f.read()
+    name = os.path.basename(SAMPLES[sample])
+
+    def send(session, base_url, document_id):
+        return session.post(f"{base_url}/upload", files={"file": (name, data)}, data={"include_text": "false"})
+    return send
+
+def json_post(path, **payload):
+    def send(session, base_url, document_id):
+        return session.post(f"{base_url}{path}", json={"document_id": document_id, **payload})
+    return send
+
+SCENARIOS = {
+    "upload_txt": upload("txt"),
+    "upload_pdf": upload("pdf"),
+    "upload_image": upload("image"),
+    "translate": json_post("/translate", target_lang="es"),
+    "speak": json_post("/speak"),
+    "ask": json_post("/ask", question=ASK_QUESTION),
+    "regenerate": json_post("/regenerate"),
+}
+
+#Send `total` requests with `concurrency` in flight; returns per-request
+#latencies in seconds and the number of failed requests
+def run_load(send, base_url, document_id, concurrency, total):
+    local = threading.local()
+
+    def one(_):
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        start = time.perf_counter()
+        try:
+            response = send(local.session, base_url, document_id)
+            response.content #Read streamed bodies (/speak) to the end
+            ok = response.status_code < 400
+        except requests.RequestException:
+            ok = False
+        return time.perf_counter() - start, ok
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        outcomes = list(executor.map(one, range(total)))
+    elapsed = time.perf_counter() - start
+    latencies = [latency for latency, ok in outcomes if ok]
+    errors = sum(1 for _, ok in outcomes if not ok)
+    return latencies, errors, elapsed
+
+def summarize(scenario, concurrency, latencies, errors, elapsed, peak_rss):
+    result = {
+        "scenario": scenario,
+        "concurrency": concurrency,
+        "requests": len(latencies) + errors,
+        "errors": errors,
+        "throughput": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "peak_rss_mb": round(peak_rss, 1) if peak_rss is not None else None,
+    }
+    for q in (50, 95, 99):
+        result[f"p{q}_ms"] = round(float(np.percentile(latencies, q)) * 1000, 1) if latencies else None
+    return result
+
+def print_table(results, baseline=None):
+    columns = ["scenario", "concurrency", "requests", "errors", "p50_ms", "p95_ms", "p99_ms", "throughput", "peak_rss_mb"]
+    previous = {(r["scenario"], r["concurrency"]): r for r in (baseline or [])}
+    rows = [columns]
+    for result in results:
+        row = []
+        for column in columns:
+            value = result[column]
+            old = previous.get((result["scenario"], result["concurrency"]), {}).get(column)
+            if column in ("p50_ms", "p95_ms", "p99_ms", "throughput", "peak_rss_mb") and value and old:
+                value = f"{value} ({(value - old) / old:+.0%})"
+            row.append("-" if value is None else str(value))
+        rows.append(row)
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+    for row in rows:
+        print("  ".join(cell.ljust(width) for cell, width in zip(row, widths)))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the backend against local stub services.")
+    parser.add_argument("--concurrency", default="1,4,16", help="Comma-separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=32, help="Requests per scenario and concurrency level")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="Comma-separated scenarios to run")
+    parser.add_argument("--llm", choices=["azure", "openai", "both"], default="azure", help="Chat providers pointed at the stub")
+    parser.add_argument("--warm", action="store_true", help="Keep result caches enabled (default: caches off)")
+    parser.add_argument("--log-level", default="WARNING", help="Backend log level during the run")
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    parser.add_argument("--compare", help="Earlier JSON results to show relative changes against")
+    args = parser.parse_args()
+
+    levels = [int(level) for level in args.concurrency.split(",")]
+    scenarios = [name.strip() for name in args.scenarios.split(",")]
+    unknown = [name for name in scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"Unknown scenarios: {', '.join(unknown)}")
+
+    port_queue = multiprocessing.get_context("spawn").Queue()
+    stub = multiprocessing.get_context("spawn").Process(target=run_stub_server, args=(port_queue,), daemon=True)
+    stub.start()
+    stub_url = f"http://127.0.0.1:{port_queue.get(timeout=30)}"
+
+    results = []
+    with tempfile.TemporaryDirectory() as tts_dir:
+        backend, base_url = start_backend(backend_env(stub_url, args, tts_dir), args.log_level)
+        try:
+            for scenario in scenarios:
+                #Shared document for the endpoints that take a document_id, uploaded
+                #per scenario so earlier upload scenarios cannot evict it from the store
+                response = SCENARIOS["upload_txt"](requests.Session(), base_url, None)
+                response.raise_for_status()
+                document_id = response.json()["document_id"]
+                send = SCENARIOS[scenario]
+                run_load(send, base_url, document_id, 1, 1) #Warm-up, not reported
+                for concurrency in levels:
+                    reset_peak_rss(backend.pid)
+                    latencies, errors, elapsed = run_load(send, base_url, document_id, concurrency, args.requests)
+                    peak_rss = read_rss(backend.pid, "VmHWM")
+                    results.append(summarize(scenario, concurrency, latencies, errors, elapsed, peak_rss))
+                    print(f"{scenario} x{concurrency}: p50 {results[-1]['p50_ms']} ms, "
+                          f"{results[-1]['throughput']} req/s, {errors} errors", file=sys.stderr)
+        finally:
+            backend.terminate()
+            backend.wait(timeout=10)
+            stub.terminate()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+    print_table(results, baseline)
+    if args.output:
+        config = {
+            "concurrency": levels, "requests": args.requests, "llm": args.llm, "warm": args.warm,
+            "stub": {key: value for key, value in os.environ.items() if key.startswith("BENCH_")},
+            "python": sys.version.split()[0], "cpus": os.cpu_count(),
+        }
+        with open(args.output, "w") as f:
+            json.dump({"config": config, "results": results}, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+#Gunicorn settings for running the backend in production:
+#    cd Backend && gunicorn -c gunicorn.conf.py
+#Each worker is a separate process with its own agents, thread pools and
+#PDF process pool, so the app is not preloaded in the master.
+import os
+import signal
+import sys
+import tempfile
+from dotenv import load_dotenv
+
+load_dotenv()
+
+wsgi_app = "legal_eagleeye_ai:create_app()"
+bind = f"{os.getenv('HOST', '0.0.0.0')}:{os.getenv('PORT', '5001')}"
+workers = int(os.getenv("WEB_WORKERS") or min(os.cpu_count() or 1, 4))
+worker_class = "gthread"
+threads = int(os.getenv("WEB_THREADS", "16"))
+#/upload waits for the whole analysis, so allow long requests
+timeout = int(os.getenv("WEB_TIMEOUT", "180"))
+#Time for in-flight requests plus SHUTDOWN_GRACE_SECONDS for unfinished jobs
+graceful_timeout = int(os.getenv("WEB_GRACEFUL_TIMEOUT") or float(os.getenv("SHUTDOWN_GRACE_SECONDS", "30")) + 30)
+keepalive = 5
+preload_app = False
+loglevel = os.getenv("LOG_LEVEL", "info").lower()
+accesslog = "-"
+
+#Split the CPUs between the workers' PDF process pools
+if not os.getenv("PDF_PROCESS_WORKERS"):
+    os.environ["PDF_PROCESS_WORKERS"] = str(max(1, (os.cpu_count() or 1) // workers))
+
+#document_id and job_id must resolve in whichever worker gets the request
+DEFAULT_SESSION_DB = os.path.join(tempfile.gettempdir(), "legaleagleeye_sessions.db")
+if workers > 1 and not os.getenv("SESSION_DB"):
+    os.environ["SESSION_DB"] = DEFAULT_SESSION_DB
+
+def on_starting(server):
+    #Sessions in the default file belong to a previous run
+    if os.environ.get("SESSION_DB") == DEFAULT_SESSION_DB:
+        for suffix in ("", "-wal", "-shm"):
+            try:
+                os.remove(DEFAULT_SESSION_DB + suffix)
+            except FileNotFoundError:
+                pass
+
+#Mark the worker as draining as soon as it is told to stop, while it still
+#finishes in-flight requests, so /ready reports 503 and /bulk refuses work
+def post_worker_init(worker):
+    from legal_eagleeye_ai import DRAINING
+    handle_exit = worker.handle_exit
+
+    def drain_and_exit(sig, frame):
+        DRAINING.set()
+        handle_exit(sig, frame)
+
+    worker.handle_exit = drain_and_exit
+    signal.signal(signal.SIGTERM, drain_and_exit)
+    signal.siginterrupt(signal.SIGTERM, False)
+
+def worker_int(worker):
+    backend = sys.modules.get("legal_eagleeye_ai")
+    if backend is not None:
+        backend.DRAINING.set()
+
+#Also called in the master for workers that are already gone; only the
+#worker itself has anything to clean up
+def worker_exit(server, worker):
+    backend = sys.modules.get("legal_eagleeye_ai")
+    if worker.pid != os.getpid() or backend is None:
+        return
+    backend.shutdown_backend()
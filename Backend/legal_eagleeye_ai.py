@@ -29,18 +29,45 @@
 #Import Libraries
 #---------------------------------
 import logging
-from flask import Flask, jsonify, request, send_file
+from flask import Flask, Request, jsonify, request, Response, stream_with_context, g
 import re
 import requests
+from requests.adapters import HTTPAdapter
 import os
 import openai
 from flask_cors import CORS
+from werkzeug.exceptions import RequestEntityTooLarge
 from dotenv import load_dotenv
 from io import BytesIO
 import fitz
 import html
 from pdfminer.high_level import extract_text
 import uuid
+import threading
+import time
+import math
+import hashlib
+import json
+import sqlite3
+import bisect
+import functools
+import asyncio
+import aiohttp
+import contextlib
+import contextvars
+import heapq
+import itertools
+import random
+import email.utils
+from collections import defaultdict, deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+import multiprocessing
+import tempfile
+import zipfile
+import mmap
+import zlib
+import numpy as np
+from PIL import Image, ImageOps
 
 #---------------------------
 #Load environment variables
@@ -56,26 +83,911 @@ AZURE_OPENAI_KEY = os.getenv("AZURE_OPENAI_KEY", "")# Azure OpenAI key
 AZURE_OPENAI_ENDPOINT = os.getenv("AZURE_OPENAI_ENDPOINT", "")# Azure OpenAI endpoint
 AZURE_OPENAI_DEPLOYMENT = os.getenv("AZURE_OPENAI_DEPLOYMENT", "")# Azure OpenAI deployment name
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")# openAI API key
+OPENAI_API_BASE = os.getenv("OPENAI_API_BASE") or "https://api.openai.com/v1"# openAI API base URL
 SPEECH_KEY = os.getenv("SPEECH_KEY")# Azure Speech AI Service key
 SPEECH_REGION = os.getenv("SPEECH_REGION")# Azure Speech AI Service Region
+SPEECH_ENDPOINT = os.getenv("SPEECH_ENDPOINT") or f"https://{SPEECH_REGION}.tts.speech.microsoft.com/cognitiveservices/v1"# Azure Speech TTS URL
 AZURE_TRANSLATOR_KEY = os.getenv("AZURE_TRANSLATOR_KEY")# Azure Translator API Key
-AZURE_TRANSLATOR_ENDPOINT = os.getenv("AZURE_TRANSLATOR_ENDPOINT")#Azure Translatoe API endpoint
+AZURE_TRANSLATOR_ENDPOINT = os.getenv("AZURE_TRANSLATOR_ENDPOINT") or "https://api.cognitive.microsofttranslator.com"#Azure Translatoe API endpoint (global by default)
 AZURE_TRANSLATOR_REGION = os.getenv("AZURE_TRANSLATOR_REGION")#Azure Translator API Region
+AGENT_POOL_SIZE = int(os.getenv("AGENT_POOL_SIZE", "4"))# Number of agents created per role
+AGENT_MAX_CONCURRENCY = int(os.getenv("AGENT_MAX_CONCURRENCY", "0"))# Max busy agents per role (0 = pool size)
+AGENT_QUEUE_LIMIT = int(os.getenv("AGENT_QUEUE_LIMIT", "32"))# Max tasks waiting for an agent per role
+AGENT_QUEUE_TIMEOUT = float(os.getenv("AGENT_QUEUE_TIMEOUT", "30"))# Seconds a task waits for an idle agent
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "256"))# In-memory entries per result cache
+RESULT_CACHE_DB = os.getenv("RESULT_CACHE_DB", "")# Optional SQLite file for a persistent result cache
+RISK_CHUNK_TOKENS = int(os.getenv("RISK_CHUNK_TOKENS", "3000"))# Token budget per risk analysis chunk
+RISK_SECTION_CACHE_SIZE = int(os.getenv("RISK_SECTION_CACHE_SIZE", "4096"))# In-memory per-section risk results
+RISK_CHUNK_CONCURRENCY = int(os.getenv("RISK_CHUNK_CONCURRENCY", "4"))# Chunks analyzed in parallel per document
+RISK_DEADLINE_SECONDS = float(os.getenv("RISK_DEADLINE_SECONDS", "60"))# Overall time limit for one document's risk analysis
+RISK_PRESCREEN = os.getenv("RISK_PRESCREEN", "false").lower() in ("1", "true", "yes")# Send only rule-matched clauses to the LLM
+RISK_PRESCREEN_MIN_SCORE = int(os.getenv("RISK_PRESCREEN_MIN_SCORE", "1"))# Rule score a clause needs to reach the LLM
+CLAUSE_LIBRARY_PATH = os.getenv("CLAUSE_LIBRARY_PATH") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "clause_library.json")# Known clauses answered without the LLM ("off" = disabled)
+CLAUSE_LIBRARY_THRESHOLD = float(os.getenv("CLAUSE_LIBRARY_THRESHOLD", "0.9"))# MinHash similarity a clause needs to match a library clause (near-verbatim)
+RISK_DUPLICATE_THRESHOLD = float(os.getenv("RISK_DUPLICATE_THRESHOLD", "0.85"))# MinHash similarity at which two risks count as duplicates
+TRANSLATION_CACHE_SIZE = int(os.getenv("TRANSLATION_CACHE_SIZE", "4096"))# Cached translations (text, language)
+PDF_MAX_PAGES = int(os.getenv("PDF_MAX_PAGES", "500"))# Pages extracted per PDF (0 = no limit)
+PDF_MAX_SECONDS = float(os.getenv("PDF_MAX_SECONDS", "60"))# Time limit for extracting one PDF
+MAX_REQUEST_BYTES = int(os.getenv("MAX_REQUEST_BYTES", str(256 * 1024 * 1024)))# Largest request body accepted (Flask MAX_CONTENT_LENGTH)
+PDF_MAX_BYTES = int(os.getenv("PDF_MAX_BYTES", str(100 * 1024 * 1024)))# Largest PDF accepted
+PDF_MAX_UPLOAD_PAGES = int(os.getenv("PDF_MAX_UPLOAD_PAGES", "5000"))# PDFs with more pages are rejected (0 = no limit)
+IMAGE_MAX_BYTES = int(os.getenv("IMAGE_MAX_BYTES", str(25 * 1024 * 1024)))# Largest image accepted
+IMAGE_MAX_PIXELS = int(os.getenv("IMAGE_MAX_PIXELS", str(60_000_000)))# Images with more pixels are rejected
+TEXT_MAX_BYTES = int(os.getenv("TEXT_MAX_BYTES", str(10 * 1024 * 1024)))# Largest text file accepted
+UPLOAD_SPOOL_BYTES = int(os.getenv("UPLOAD_SPOOL_BYTES", str(1024 * 1024)))# Uploads larger than this are spooled to a temp file
+PDF_PARALLEL_MIN_PAGES = int(os.getenv("PDF_PARALLEL_MIN_PAGES", "32"))# PDFs with this many pages use the process pool
+PDF_PROCESS_WORKERS = int(os.getenv("PDF_PROCESS_WORKERS") or os.cpu_count() or 1)# Worker processes for PDF extraction
+PDF_OCR_DPI = int(os.getenv("PDF_OCR_DPI", "200"))# Resolution scanned PDF pages are rendered at for OCR
+PDF_OCR_CONCURRENCY = int(os.getenv("PDF_OCR_CONCURRENCY", "4"))# Scanned PDF pages OCR'd at the same time
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))# Background threads running document jobs
+JOB_QUEUE_LIMIT = int(os.getenv("JOB_QUEUE_LIMIT", "64"))# Max unfinished (queued + running) jobs
+JOB_RESULT_TTL = float(os.getenv("JOB_RESULT_TTL", "900"))# Seconds a finished job's result is kept
+BULK_CONCURRENCY = int(os.getenv("BULK_CONCURRENCY", "8"))# Documents analyzed at once by /bulk, across all bulk requests
+BULK_MAX_FILES = int(os.getenv("BULK_MAX_FILES", "200"))# Max documents in one /bulk request
+BULK_MAX_BYTES = int(os.getenv("BULK_MAX_BYTES", str(200 * 1024 * 1024)))# Max total (unzipped) size of one /bulk request
+RETRIEVAL_CHUNK_TOKENS = int(os.getenv("RETRIEVAL_CHUNK_TOKENS", "250"))# Token size of /ask retrieval passages
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", "4"))# Passages sent to the LLM per question
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "1024"))# /ask answers kept in memory, per document, question and language
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "86400"))# Seconds a cached /ask answer is reused (0 = no expiry)
+ASK_PRECOMPUTE_QUESTIONS = [q.strip() for q in os.getenv("ASK_PRECOMPUTE_QUESTIONS", "").split("|") if q.strip()]# Questions answered in the background after /upload ("|"-separated)
+RETRIEVAL_INDEX_CACHE_SIZE = int(os.getenv("RETRIEVAL_INDEX_CACHE_SIZE", "64"))# Document indexes kept in memory
+AZURE_OPENAI_EMBEDDING_DEPLOYMENT = os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT", "")# Optional embeddings deployment for /ask retrieval
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "16"))# Passages per embeddings request (Azure caps inputs per request)
+DOCUMENT_TTL = float(os.getenv("DOCUMENT_TTL", "3600"))# Seconds an unused document session is kept
+DOCUMENT_STORE_MAX_DOCUMENTS = int(os.getenv("DOCUMENT_STORE_MAX_DOCUMENTS", "256"))# Max document sessions in memory
+DOCUMENT_STORE_MAX_BYTES = int(os.getenv("DOCUMENT_STORE_MAX_BYTES", str(256 * 1024 * 1024)))# Approx. memory cap for stored documents
+SESSION_DB = os.getenv("SESSION_DB", "")# Optional SQLite file sharing documents and jobs between worker processes
+SHUTDOWN_GRACE_SECONDS = float(os.getenv("SHUTDOWN_GRACE_SECONDS", "30"))# Time a stopping worker gives unfinished jobs
+LOG_LEVEL = os.getenv("LOG_LEVEL", "DEBUG").upper()# Root log level
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))# Seconds to connect to an upstream service
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "30"))# Seconds to wait for OCR/Translator/Speech responses
+LLM_READ_TIMEOUT = float(os.getenv("LLM_READ_TIMEOUT", "120"))# Seconds to wait for a chat completion response
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "32"))# Keep-alive connections per host for openai's synchronous calls
+UPSTREAM_CONCURRENCY = int(os.getenv("UPSTREAM_CONCURRENCY", "64"))# In-flight calls per upstream service (override with e.g. UPSTREAM_CONCURRENCY_OCR)
+UPSTREAM_RPM = int(os.getenv("UPSTREAM_RPM", "0"))# Requests per minute per upstream service (0 = no limit; override with e.g. UPSTREAM_RPM_AZURE_GPT)
+UPSTREAM_TPM = int(os.getenv("UPSTREAM_TPM", "0"))# Tokens (LLM) or characters (Translator, Speech) per minute per service (0 = no limit)
+UPSTREAM_MAX_RETRIES = int(os.getenv("UPSTREAM_MAX_RETRIES", "3"))# Retries of an upstream call answered with 429 or 5xx
+UPSTREAM_RETRY_MAX_WAIT = float(os.getenv("UPSTREAM_RETRY_MAX_WAIT", "20"))# Longest Retry-After waited out before the call fails (or the LLM fails over)
+LLM_ROUTING = os.getenv("LLM_ROUTING", "latency")# "latency" (fastest healthy provider first) or "ordered" (Azure, then OpenAI)
+LLM_HEDGE_DELAY = float(os.getenv("LLM_HEDGE_DELAY", "0"))# Seconds before a hedged request to the next provider (0 = off)
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))# Consecutive failures that open a provider's circuit
+LLM_BREAKER_ERROR_RATE = float(os.getenv("LLM_BREAKER_ERROR_RATE", "0.5"))# Error rate over the window that opens the circuit
+LLM_BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", "30"))# Seconds an open circuit waits before a trial request
+LLM_HEALTH_WINDOW = int(os.getenv("LLM_HEALTH_WINDOW", "50"))# Recent calls per provider used for error rate and latency
+TTS_CONCURRENCY = int(os.getenv("TTS_CONCURRENCY", "4"))# Speech segments synthesized in parallel
+TTS_CACHE_MEMORY_BYTES = int(os.getenv("TTS_CACHE_MEMORY_BYTES", str(64 * 1024 * 1024)))# In-memory audio cache size
+TTS_CACHE_DIR = os.getenv("TTS_CACHE_DIR") or os.path.join(tempfile.gettempdir(), "legaleagleeye_tts")# On-disk audio cache directory
+TTS_CACHE_DISK_BYTES = int(os.getenv("TTS_CACHE_DISK_BYTES", str(512 * 1024 * 1024)))# On-disk audio cache size (0 = memory only)
+OCR_MAX_DIMENSION = int(os.getenv("OCR_MAX_DIMENSION", "2400"))# Longest image side sent to OCR, in pixels
+OCR_JPEG_QUALITY = int(os.getenv("OCR_JPEG_QUALITY", "85"))# JPEG quality of preprocessed OCR images
+OCR_PREPROCESS_WORKERS = int(os.getenv("OCR_PREPROCESS_WORKERS") or os.cpu_count() or 1)# Threads preparing images for OCR
+AGENT_MEMORY_SIZE = int(os.getenv("AGENT_MEMORY_SIZE", "50"))# Task records kept per agent
 
 # --------------------------------
 # Initialize Flask app and logging
 # ---------------------------------
 app = Flask(__name__)
+app.config["MAX_CONTENT_LENGTH"] = MAX_REQUEST_BYTES #Larger requests get a 413 before the body is read
 CORS(app, resources={r"/*": {"origins": "http://localhost:3000"}}, supports_credentials=True)
-logging.basicConfig(level=logging.DEBUG,
+logging.basicConfig(level=LOG_LEVEL,
     format='%(asctime)s %(levelname)s %(name)s : %(message)s')
 
+# ------------------------------
+# Metrics
+# ------------------------------
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+class Metrics:
+    #Process-local counters, gauges and latency histograms,
+    #rendered in the Prometheus text format at /metrics
+    PREFIX = "legaleagleeye_"
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.kinds = {} #name -> (type, help text)
+        self.values = {} #(name, labels) -> counter or gauge value
+        self.histograms = {} #(name, labels) -> [bucket counts (last is +Inf), sum, count]
+
+    def describe(self, name, kind, help_text):
+        self.kinds[name] = (kind, help_text)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.values[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            histogram[0][bisect.bisect_left(self.buckets, value)] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+        return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+    def render(self):
+        with self.lock:
+            values = dict(self.values)
+            histograms = {key: (list(h[0]), h[1], h[2]) for key, h in self.histograms.items()}
+        samples = defaultdict(list)
+        for (name, labels), value in sorted(values.items()):
+            samples[name].append(f"{self.PREFIX}{name}{self._labels(labels)} {value}")
+        for (name, labels), (counts, total, count) in sorted(histograms.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                samples[name].append(f"{self.PREFIX}{name}_bucket{self._labels(labels, [('le', bound)])} {cumulative}")
+            samples[name].append(f"{self.PREFIX}{name}_sum{self._labels(labels)} {total}")
+            samples[name].append(f"{self.PREFIX}{name}_count{self._labels(labels)} {count}")
+        lines = []
+        for name in sorted(samples):
+            kind, help_text = self.kinds.get(name, ("untyped", ""))
+            lines.append(f"# HELP {self.PREFIX}{name} {help_text}")
+            lines.append(f"# TYPE {self.PREFIX}{name} {kind}")
+            lines.extend(samples[name])
+        return "\n".join(lines) + "\n"
+
+METRICS = Metrics()
+METRICS.describe("stage_seconds", "histogram", "Time spent in each processing stage")
+METRICS.describe("stage_runs_total", "counter", "Processing stage runs by outcome")
+METRICS.describe("agent_task_seconds", "histogram", "Time an agent spent on one task")
+METRICS.describe("agent_tasks_total", "counter", "Agent tasks by role and outcome")
+METRICS.describe("agent_queue_wait_seconds", "histogram", "Time a task waited for an idle agent")
+METRICS.describe("agent_queue_depth", "gauge", "Tasks waiting for an agent")
+METRICS.describe("agents_busy", "gauge", "Agents currently running a task")
+METRICS.describe("upstream_seconds", "histogram", "Latency of calls to external services")
+METRICS.describe("upstream_requests_total", "counter", "Calls to external services by outcome")
+METRICS.describe("upstream_bytes_sent_total", "counter", "Request bytes sent to external services")
+METRICS.describe("upstream_bytes_received_total", "counter", "Response bytes received from external services")
+METRICS.describe("upstream_queue_seconds", "histogram", "Time a call waited for its upstream quota")
+METRICS.describe("upstream_retries_total", "counter", "Upstream calls retried after a 429 or 5xx")
+METRICS.describe("llm_tokens_total", "counter", "Tokens reported by chat completions")
+METRICS.describe("http_request_seconds", "histogram", "Time to produce a response per endpoint")
+METRICS.describe("http_requests_total", "counter", "Requests per endpoint and status")
+METRICS.describe("http_request_bytes_total", "counter", "Request body bytes received per endpoint")
+METRICS.describe("http_response_bytes_total", "counter", "Response body bytes sent per endpoint (non-streamed)")
+METRICS.describe("jobs", "gauge", "Document jobs by status")
+METRICS.describe("cache_hits_total", "counter", "Result cache hits")
+METRICS.describe("cache_misses_total", "counter", "Result cache misses")
+METRICS.describe("clause_library_hits_total", "counter", "Clauses resolved from the known-clause library")
+
+#One call to an external service; outcome is "ok", "http_<status>" or "error"
+def record_upstream(service, outcome, seconds, sent=0, received=0):
+    METRICS.observe("upstream_seconds", seconds, service=service)
+    METRICS.inc("upstream_requests_total", service=service, outcome=outcome)
+    if sent:
+        METRICS.inc("upstream_bytes_sent_total", sent, service=service)
+    if received:
+        METRICS.inc("upstream_bytes_received_total", received, service=service)
+
+#Decorator recording latency and outcome of a processing stage.
+#Raised exceptions and "Error..." strings count as errors.
+#Works on plain and async functions.
+def instrument_stage(stage):
+    def record(start, result):
+        ok = not (isinstance(result, str) and result.startswith("Error"))
+        METRICS.observe("stage_seconds", time.perf_counter() - start, stage=stage)
+        METRICS.inc("stage_runs_total", stage=stage, outcome="ok" if ok else "error")
+
+    def decorator(fn):
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                result = "Error"
+                try:
+                    result = await fn(*args, **kwargs)
+                    return result
+                finally:
+                    record(start, result)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            result = "Error"
+            try:
+                result = fn(*args, **kwargs)
+                return result
+            finally:
+                record(start, result)
+        return wrapper
+    return decorator
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+#Upstream priority class per endpoint; everything else is "batch"
+ENDPOINT_PRIORITY = {
+    "ask_about_clause": "interactive",
+    "translate_risks": "interactive",
+    "speak_text": "interactive",
+    "bulk_analyze": "bulk",
+}
+
+#Set for every request, since server threads are reused between requests
+@app.before_request
+def set_request_priority():
+    UPSTREAM_PRIORITY.set(ENDPOINT_PRIORITY.get(request.endpoint, "batch"))
+
+@app.after_request
+def record_request_metrics(response):
+    endpoint = request.endpoint or "unknown"
+    if "request_started" in g:
+        METRICS.observe("http_request_seconds", time.perf_counter() - g.request_started, endpoint=endpoint)
+    METRICS.inc("http_requests_total", endpoint=endpoint, status=response.status_code)
+    if request.content_length:
+        METRICS.inc("http_request_bytes_total", request.content_length, endpoint=endpoint)
+    if not response.is_streamed and response.content_length:
+        METRICS.inc("http_response_bytes_total", response.content_length, endpoint=endpoint)
+    return response
+
+# ------------------------------
+# Outbound Service Clients
+# ------------------------------
+#Keep-alive requests session for openai's synchronous calls, with a bounded
+#connection pool per host. Async calls share ASYNC_ENGINE.http_session() and
+#are bounded by the upstream quotas instead.
+def make_http_session(pool_size=HTTP_POOL_SIZE):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=0)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+# ------------------------------
+# Async Execution Engine
+# ------------------------------
+class AsyncEngine:
+    #One event loop per worker process, running in a background thread.
+    #Upstream calls are coroutines on this loop, so hundreds can be in flight
+    #without a thread each. Sync code hands coroutines over with run()/submit(),
+    #and an UpstreamQuota per upstream service schedules calls across all requests.
+    def __init__(self):
+        self.loop = None
+        self.thread = None
+        self.pid = None
+        self.session = None
+        self.quotas = {}
+        self.lock = threading.Lock()
+
+    def _ensure_loop(self):
+        with self.lock:
+            #Started lazily, and again in a forked worker
+            if self.loop is None or self.pid != os.getpid():
+                loop = asyncio.new_event_loop()
+                self.thread = threading.Thread(target=loop.run_forever, name="async-engine", daemon=True)
+                self.thread.start()
+                self.loop, self.pid = loop, os.getpid()
+                self.session = None
+                self.quotas = {}
+            return self.loop
+
+    def submit(self, coro):
+        #Schedule a coroutine from any thread; returns a concurrent.futures.Future
+        return asyncio.run_coroutine_threadsafe(coro, self._ensure_loop())
+
+    def run(self, coro, timeout=None):
+        #Run a coroutine to completion from sync code
+        if threading.current_thread() is self.thread:
+            coro.close()
+            raise RuntimeError("AsyncEngine.run() called from the event loop; await the coroutine instead")
+        return self.submit(coro).result(timeout)
+
+    def http_session(self):
+        #Shared keep-alive aiohttp session; only call from the loop
+        if self.session is None:
+            self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0, keepalive_timeout=30))
+        return self.session
+
+    def quota(self, service):
+        #Scheduler for one upstream; each limit is UPSTREAM_<LIMIT>_<SERVICE>
+        #or the UPSTREAM_<LIMIT> default. Only call from the loop.
+        quota = self.quotas.get(service)
+        if quota is None:
+            quota = self.quotas[service] = UpstreamQuota(
+                service,
+                role_setting("UPSTREAM_CONCURRENCY", service, UPSTREAM_CONCURRENCY),
+                role_setting("UPSTREAM_RPM", service, UPSTREAM_RPM),
+                role_setting("UPSTREAM_TPM", service, UPSTREAM_TPM)
+            )
+        return quota
+
+    #Whether a 429 currently pauses service; safe from any thread
+    def paused(self, service):
+        quota = self.quotas.get(service)
+        return quota is not None and quota.paused_until > time.monotonic()
+
+    async def _acquire(self, service, cost):
+        quota = self.quota(service)
+        await quota.acquire(cost)
+        return quota
+
+    @contextlib.contextmanager
+    def slot(self, service, cost=0):
+        #Quota slot held by a blocking call made outside the loop
+        loop = self._ensure_loop()
+        quota = self.run(self._acquire(service, cost))
+        try:
+            yield quota
+        finally:
+            loop.call_soon_threadsafe(quota.release)
+
+    def stop(self):
+        with self.lock:
+            loop, session = self.loop, self.session
+            self.loop = None
+        if loop is None:
+            return
+        if session is not None:
+            asyncio.run_coroutine_threadsafe(session.close(), loop).result(5)
+        loop.call_soon_threadsafe(loop.stop)
+
+ASYNC_ENGINE = AsyncEngine()
+
+# ------------------------------
+# Upstream Quota Scheduler
+# ------------------------------
+#Priority classes of upstream calls; lower runs first. Set per request in
+#set_request_priority, and for executor threads with run_with_priority.
+PRIORITY_CLASSES = {"interactive": 0, "batch": 1, "bulk": 2}
+UPSTREAM_PRIORITY = contextvars.ContextVar("upstream_priority", default="batch")
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+#Run fn with UPSTREAM_PRIORITY set, for work handed to executor threads
+def run_with_priority(priority, fn, *args, **kwargs):
+    token = UPSTREAM_PRIORITY.set(priority)
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        UPSTREAM_PRIORITY.reset(token)
+
+#Seconds to wait before retry number attempt (from 0): the server's
+#retry-after-ms or Retry-After (seconds or HTTP date) when it sends one,
+#else exponential backoff with full jitter
+def retry_delay(headers, attempt):
+    headers = {str(k).lower(): v for k, v in (headers or {}).items()}
+    for name, scale in (("retry-after-ms", 0.001), ("x-ms-retry-after-ms", 0.001), ("retry-after", 1.0)):
+        value = headers.get(name)
+        if not value:
+            continue
+        try:
+            return max(float(value) * scale, 0.0)
+        except ValueError:
+            try:
+                return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+            except (TypeError, ValueError):
+                pass
+    return random.uniform(0, min(8.0, 0.5 * 2 ** attempt))
+
+class TokenBucket:
+    #Refills at per_minute / 60 per second and holds at most BURST_SECONDS
+    #worth: Azure checks per-minute quotas over 1-10s windows, so calls are
+    #paced rather than sent in a burst. A call larger than the bucket waits
+    #for a full bucket and leaves it in debt, which keeps the average rate.
+    BURST_SECONDS = 1
+
+    def __init__(self, per_minute):
+        self.rate = per_minute / 60
+        self.capacity = max(self.rate * self.BURST_SECONDS, 1.0)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def wait_time(self, cost, now):
+        #Seconds until cost fits; a cost above the capacity only needs a full bucket
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+        return max(min(cost, self.capacity) - self.level, 0.0) / self.rate
+
+    def take(self, cost):
+        self.level -= cost
+
+    def adjust(self, amount):
+        self.level = min(self.capacity, self.level + amount)
+
+class UpstreamQuota:
+    #Admission control for one upstream service, used on ASYNC_ENGINE's loop.
+    #A call is admitted when a concurrency slot is free and the request and
+    #token buckets cover it; waiting calls go by priority class, then arrival.
+    #A 429 pauses the service for its Retry-After (at most
+    #UPSTREAM_RETRY_MAX_WAIT) so queued calls are not all sent into the
+    #throttle, and the buckets meter them out afterwards.
+    def __init__(self, service, concurrency, rpm=0, tpm=0):
+        self.service = service
+        self.concurrency = concurrency
+        self.active = 0
+        self.requests = TokenBucket(rpm) if rpm > 0 else None
+        self.tokens = TokenBucket(tpm) if tpm > 0 else None
+        self.paused_until = 0.0
+        self.waiters = [] #Heap of (priority, arrival, cost, future)
+        self.arrivals = itertools.count()
+        self.timer = None
+
+    def _wait_time(self, cost, now):
+        #None while every slot is busy, else seconds until cost can be sent
+        if self.active >= self.concurrency:
+            return None
+        wait = self.paused_until - now
+        if self.requests is not None:
+            wait = max(wait, self.requests.wait_time(1, now))
+        if self.tokens is not None:
+            wait = max(wait, self.tokens.wait_time(cost, now))
+        return max(wait, 0.0)
+
+    def _admit(self, cost):
+        self.active += 1
+        if self.requests is not None:
+            self.requests.take(1)
+        if self.tokens is not None:
+            self.tokens.take(cost)
+
+    def _dispatch(self):
+        #Admit waiters from the head of the queue; a head that has to wait
+        #for the buckets sets a timer instead of letting later calls pass it
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        now = time.monotonic()
+        while self.waiters:
+            _, _, cost, future = self.waiters[0]
+            if future.done():
+                heapq.heappop(self.waiters) #Cancelled while waiting
+                continue
+            wait = self._wait_time(cost, now)
+            if wait is None:
+                return
+            if wait > 0:
+                self.timer = asyncio.get_running_loop().call_later(wait, self._dispatch)
+                return
+            heapq.heappop(self.waiters)
+            self._admit(cost)
+            future.set_result(None)
+
+    async def acquire(self, cost=0):
+        priority = UPSTREAM_PRIORITY.get()
+        if not self.waiters and self._wait_time(cost, time.monotonic()) == 0:
+            self._admit(cost)
+            METRICS.observe("upstream_queue_seconds", 0.0, service=self.service, priority=priority)
+            return
+        start = time.perf_counter()
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (PRIORITY_CLASSES.get(priority, 1), next(self.arrivals), cost, future))
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release() #Admitted just as the caller was cancelled
+            else:
+                self._dispatch()
+            raise
+        METRICS.observe("upstream_queue_seconds", time.perf_counter() - start, service=self.service, priority=priority)
+
+    def release(self):
+        self.active -= 1
+        self._dispatch()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, cost=0):
+        await self.acquire(cost)
+        try:
+            yield self
+        finally:
+            self.release()
+
+    def settle(self, estimated, actual):
+        #Give back tokens the estimate overcharged, or charge the shortfall
+        if self.tokens is not None:
+            self.tokens.adjust(estimated - actual)
+            self._dispatch()
+
+    def retry_delay(self, status, headers, attempt, retries=UPSTREAM_MAX_RETRIES):
+        #Delay before retrying an answer with this status, or None when it
+        #is final: not a 429/5xx, out of retries, or asked to wait too long
+        if status not in RETRY_STATUSES:
+            return None
+        delay = retry_delay(headers, attempt)
+        if status == 429:
+            #A long Retry-After fails this call over instead of stalling every
+            #later call for the whole period
+            self.paused_until = max(self.paused_until, time.monotonic() + min(delay, UPSTREAM_RETRY_MAX_WAIT))
+        if attempt >= retries or delay > UPSTREAM_RETRY_MAX_WAIT:
+            return None
+        METRICS.inc("upstream_retries_total", service=self.service, status=status)
+        return delay
+
+class UpstreamError(Exception):
+    #Raised for an HTTP error status from an upstream service
+    pass
+
+class UpstreamResponse:
+    #Fully read response of an upstream call
+    def __init__(self, service, status_code, content):
+        self.service = service
+        self.status_code = status_code
+        self.content = content
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if not self.ok:
+            raise UpstreamError(f"{self.service} returned HTTP {self.status_code}: {self.content[:200]!r}")
+
+class ServiceClient:
+    #Async HTTP client for one Azure service: fixed auth headers, explicit
+    #connect/read timeouts, the service's quota and 429/5xx retries.
+    #post() is a coroutine and must run on ASYNC_ENGINE.
+    def __init__(self, name, headers=None, timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)):
+        self.name = name
+        self.timeout = aiohttp.ClientTimeout(sock_connect=timeout[0], sock_read=timeout[1])
+        self.headers = {k: v for k, v in (headers or {}).items() if v}
+
+    #cost is what the call counts against the service's UPSTREAM_TPM
+    #quota (characters for Translator and Speech)
+    async def post(self, url, headers=None, data=None, json_body=None, cost=0):
+        headers = {**self.headers, **(headers or {})}
+        if json_body is not None:
+            data = json.dumps(json_body).encode("utf-8")
+            headers["Content-Type"] = "application/json"
+        quota = ASYNC_ENGINE.quota(self.name)
+        for attempt in itertools.count():
+            async with quota.slot(cost):
+                start = time.perf_counter()
+                try:
+                    async with ASYNC_ENGINE.http_session().post(url, headers=headers, data=data, timeout=self.timeout) as response:
+                        content = await response.read()
+                except Exception:
+                    record_upstream(self.name, "error", time.perf_counter() - start)
+                    raise
+            result = UpstreamResponse(self.name, response.status, content)
+            record_upstream(
+                self.name, "ok" if result.ok else f"http_{result.status_code}", time.perf_counter() - start,
+                sent=len(data or b""), received=len(content)
+            )
+            delay = quota.retry_delay(result.status_code, response.headers, attempt)
+            if delay is None:
+                return result
+            await asyncio.sleep(delay)
+
+class LLMClient:
+    #Chat completion settings for one provider. They are passed with every
+    #request instead of being written to the openai module globals.
+    #Each client (one per Azure deployment) has its own upstream quota.
+    def __init__(self, name, api_type, api_base, api_key, api_version=None, engine=None, model=None):
+        self.name = name
+        self.service = re.sub(r"\W+", "_", name.lower()) #Quota key, e.g. azure_gpt
+        self.engine = engine
+        self.model = model
+        self.credentials = {
+            "api_type": api_type,
+            "api_base": api_base,
+            "api_key": api_key,
+            "api_version": api_version
+        }
+
+    #Model or deployment answering with this client, as used in cache keys
+    def model_id(self, model=None):
+        return f"azure:{self.engine}" if self.engine else f"openai:{model or self.model}"
+
+    def options(self, model=None):
+        target = {"engine": self.engine} if self.engine else {"model": model or self.model}
+        return {**target, **self.credentials, "request_timeout": (HTTP_CONNECT_TIMEOUT, LLM_READ_TIMEOUT)}
+
+    def chat(self, messages, model=None, **kwargs):
+        #model only applies to OpenAI; Azure always uses its deployment.
+        #A streamed response gives its quota slot back once the stream opens.
+        with ASYNC_ENGINE.slot(self.service, estimate_chat_tokens(messages, kwargs.get("max_tokens"))):
+            return openai.ChatCompletion.create(messages=messages, **self.options(model), **kwargs)
+
+    async def achat(self, messages, model=None, retries=UPSTREAM_MAX_RETRIES, **kwargs):
+        #Same as chat() on ASYNC_ENGINE's shared aiohttp session, retrying
+        #429/5xx answers up to retries times. The quota is charged the
+        #estimated tokens up front and settled with the usage the response
+        #reports.
+        openai.aiosession.set(ASYNC_ENGINE.http_session())
+        quota = ASYNC_ENGINE.quota(self.service)
+        cost = estimate_chat_tokens(messages, kwargs.get("max_tokens"))
+        for attempt in itertools.count():
+            try:
+                async with quota.slot(cost):
+                    response = await openai.ChatCompletion.acreate(messages=messages, **self.options(model), **kwargs)
+            except openai.error.OpenAIError as e:
+                delay = quota.retry_delay(e.http_status, e.headers, attempt, retries)
+                if delay is None:
+                    raise
+                app.logger.warning(f"{self.name} answered HTTP {e.http_status}, retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+                continue
+            usage = response.get("usage") or {}
+            if usage.get("total_tokens"):
+                quota.settle(cost, usage["total_tokens"])
+            return response
+
+    def embed(self, texts):
+        with ASYNC_ENGINE.slot(self.service, sum(estimate_tokens(text) for text in texts)):
+            return openai.Embedding.create(input=texts, **self.options())
+
+#Tokens a chat call counts against the quota before it is sent: the
+#prompt estimate plus max_tokens, which Azure reserves for the completion
+def estimate_chat_tokens(messages, max_tokens=None):
+    return sum(estimate_tokens(m.get("content") or "") + 4 for m in messages) + (max_tokens or 0)
+
+OCR_CLIENT = ServiceClient("ocr", {"Ocp-Apim-Subscription-Key": AZURE_CV_KEY})
+TRANSLATOR_CLIENT = ServiceClient("translator", {
+    "Ocp-Apim-Subscription-Key": AZURE_TRANSLATOR_KEY,
+    "Ocp-Apim-Subscription-Region": AZURE_TRANSLATOR_REGION
+})
+SPEECH_CLIENT = ServiceClient("speech", {"Ocp-Apim-Subscription-Key": SPEECH_KEY})
+
+AZURE_LLM = None
+if AZURE_OPENAI_KEY and AZURE_OPENAI_DEPLOYMENT and AZURE_OPENAI_ENDPOINT:
+    AZURE_LLM = LLMClient("Azure GPT", "azure", AZURE_OPENAI_ENDPOINT, AZURE_OPENAI_KEY,
+                          api_version="2023-05-15", engine=AZURE_OPENAI_DEPLOYMENT)
+OPENAI_LLM = LLMClient("OpenAI", "open_ai", OPENAI_API_BASE, OPENAI_API_KEY, model="gpt-3.5-turbo")
+
+#Configured chat providers in preference order: Azure OpenAI, then OpenAI
+def llm_providers():
+    providers = [AZURE_LLM] if AZURE_LLM is not None else []
+    if OPENAI_API_KEY:
+        providers.append(OPENAI_LLM)
+    return providers
+
+#The openai library keeps one session per thread by default; share a pooled
+#one for the sync (streaming) calls instead
+openai.requestssession = make_http_session()
+
+# ------------------------------
+# LLM Provider Router
+# ------------------------------
+class LLMUnavailableError(Exception):
+    #Raised when no chat provider is configured or none could take the request
+    pass
+
+class ProviderHealth:
+    #Recent outcomes of one provider plus its circuit breaker.
+    #closed: normal; open: skipped until the cooldown ends;
+    #half_open: a single trial request decides whether to close again.
+    MIN_SAMPLES = 5
+
+    def __init__(self, name):
+        self.name = name
+        self.samples = deque(maxlen=LLM_HEALTH_WINDOW) #(ok, latency seconds)
+        self.consecutive_failures = 0
+        self.state = "closed"
+        self.opened_at = 0.0
+        self.trial_started = None
+        self.lock = threading.Lock()
+
+    #Whether a request could go to this provider now, without claiming the
+    #half-open trial
+    def available(self):
+        with self.lock:
+            now = time.monotonic()
+            if self.state == "closed":
+                return True
+            if self.state == "open":
+                return now - self.opened_at >= LLM_BREAKER_COOLDOWN
+            return self.trial_started is None or now - self.trial_started >= LLM_BREAKER_COOLDOWN
+
+    #Claim the provider for a request being sent; in half_open this
+    #consumes the single trial
+    def allow(self):
+        with self.lock:
+            now = time.monotonic()
+            if self.state == "open" and now - self.opened_at >= LLM_BREAKER_COOLDOWN:
+                self.state = "half_open"
+                self.trial_started = None
+            if self.state == "closed":
+                return True
+            #A trial that never reported back doesn't block the provider forever
+            if self.state == "half_open" and (self.trial_started is None or now - self.trial_started >= LLM_BREAKER_COOLDOWN):
+                self.trial_started = now
+                return True
+            return False
+
+    def record(self, ok, latency=None):
+        with self.lock:
+            if ok:
+                self.consecutive_failures = 0
+                if self.state != "closed":
+                    #Start the window afresh so old failures don't reopen it at once
+                    app.logger.info(f"Circuit for {self.name} closed")
+                    self.samples.clear()
+                self.state = "closed"
+                self.samples.append((ok, latency))
+                return
+            self.samples.append((ok, latency))
+            self.consecutive_failures += 1
+            errors = sum(1 for sample_ok, _ in self.samples if not sample_ok)
+            if (self.state == "half_open"
+                    or self.consecutive_failures >= LLM_BREAKER_FAILURES
+                    or (len(self.samples) >= self.MIN_SAMPLES and errors / len(self.samples) >= LLM_BREAKER_ERROR_RATE)):
+                if self.state != "open":
+                    app.logger.warning(f"Circuit for {self.name} opened after {self.consecutive_failures} consecutive failures")
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+    def latency(self, q=50):
+        #Latency percentile of recent successful calls, None without enough data
+        with self.lock:
+            latencies = [latency for ok, latency in self.samples if ok and latency is not None]
+        if len(latencies) < self.MIN_SAMPLES:
+            return None
+        return float(np.percentile(latencies, q))
+
+    def to_dict(self):
+        p50, p95 = self.latency(50), self.latency(95)
+        with self.lock:
+            errors = sum(1 for ok, _ in self.samples if not ok)
+            return {
+                "state": self.state,
+                "samples": len(self.samples),
+                "error_rate": errors / len(self.samples) if self.samples else 0.0,
+                "latency_p50": p50,
+                "latency_p95": p95,
+            }
+
+class LLMRouter:
+    #Chooses the chat provider for each call: providers with an open circuit
+    #are skipped, and with LLM_ROUTING=latency the provider with the lowest
+    #recent median latency goes first; providers paused by a 429 go last.
+    #With LLM_HEDGE_DELAY set, a second provider is raced against a slow
+    #first one and the first answer wins.
+    def __init__(self):
+        self.health = {}
+        self.lock = threading.Lock()
+
+    def health_of(self, provider):
+        with self.lock:
+            if provider.name not in self.health:
+                self.health[provider.name] = ProviderHealth(provider.name)
+            return self.health[provider.name]
+
+    def ordered(self):
+        providers = llm_providers()
+        if not providers:
+            raise LLMUnavailableError("No valid API key available.")
+        if LLM_ROUTING == "latency":
+            latencies = [self.health_of(p).latency() for p in providers]
+            if all(latency is not None for latency in latencies):
+                providers = [p for _, p in sorted(zip(latencies, providers), key=lambda pair: pair[0])]
+        #Providers paused by a 429 go last, behind ones that can answer now
+        providers = sorted(providers, key=lambda p: ASYNC_ENGINE.paused(p.service))
+        allowed = [p for p in providers if self.health_of(p).available()]
+        #Every circuit open: still try them rather than failing outright
+        return allowed or providers
+
+    #Call right before dispatching to provider. False when its half-open trial
+    #was taken by another request meanwhile; with every circuit open the
+    #request goes out anyway, as in ordered().
+    def claim(self, provider):
+        return self.health_of(provider).allow() or not any(self.health_of(p).available() for p in llm_providers())
+
+    def record(self, provider, ok, latency=None):
+        self.health_of(provider).record(ok, latency)
+        if latency is not None or not ok:
+            record_upstream(provider.name, "ok" if ok else "error", latency or 0.0)
+
+    #With another provider to fail over to, a 429/5xx is not retried in the
+    #client: the failover answers sooner than waiting out the backoff
+    async def _call(self, provider, messages, model, kwargs, fallback=False):
+        start = time.monotonic()
+        try:
+            retries = 0 if fallback else UPSTREAM_MAX_RETRIES
+            response = await provider.achat(messages, model=model, retries=retries, **kwargs)
+        except Exception:
+            self.record(provider, False)
+            raise
+        self.record(provider, True, time.monotonic() - start)
+        usage = response.get("usage") or {}
+        for kind in ("prompt", "completion"):
+            if usage.get(f"{kind}_tokens"):
+                METRICS.inc("llm_tokens_total", usage[f"{kind}_tokens"], provider=provider.name, kind=kind)
+        return response
+
+    def chat(self, messages, model=None, **kwargs):
+        return ASYNC_ENGINE.run(self.achat(messages, model, **kwargs))
+
+    async def achat(self, messages, model=None, **kwargs):
+        return (await self.dispatch(messages, model, **kwargs))[1]
+
+    #(provider that answered, response), for callers whose cache key
+    #names the model
+    async def dispatch(self, messages, model=None, **kwargs):
+        providers = self.ordered()
+        last_error = None
+        if LLM_HEDGE_DELAY <= 0 or len(providers) < 2:
+            for i, provider in enumerate(providers):
+                if not self.claim(provider):
+                    continue
+                fallback = any(self.health_of(p).available() for p in providers[i + 1:])
+                try:
+                    return provider, await self._call(provider, messages, model, kwargs, fallback)
+                except Exception as e:
+                    app.logger.error(f"{provider.name} failed: {e}", exc_info=True)
+                    last_error = e
+            raise last_error or LLMUnavailableError("No chat provider available")
+
+        pending = {}
+        remaining = deque(providers)
+
+        def launch():
+            while remaining:
+                provider = remaining.popleft()
+                if self.claim(provider):
+                    fallback = any(self.health_of(p).available() for p in remaining)
+                    future = asyncio.ensure_future(self._call(provider, messages, model, kwargs, fallback))
+                    future.add_done_callback(lambda f: f.cancelled() or f.exception()) #Losing hedges fail quietly
+                    pending[future] = provider
+                    return
+
+        launch()
+        while pending:
+            done, _ = await asyncio.wait(pending, timeout=LLM_HEDGE_DELAY if remaining else None,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                app.logger.info(f"Hedging slow {list(pending.values())[0].name} request to {remaining[0].name}")
+                launch()
+                continue
+            for future in done:
+                provider = pending.pop(future)
+                try:
+                    return provider, future.result() #A slower hedge keeps running and still updates health
+                except Exception as e:
+                    app.logger.error(f"{provider.name} failed: {e}", exc_info=True)
+                    last_error = e
+            if not pending and remaining:
+                launch()
+        raise last_error or LLMUnavailableError("No chat provider available")
+
+    def to_dict(self):
+        with self.lock:
+            health = dict(self.health)
+        return {name: h.to_dict() for name, h in health.items()}
+
+LLM_ROUTER = LLMRouter()
+
 # ------------------------------
 # Agent Registry & Team State
 # ------------------------------
 AGENTS = {}
 TEAMS = {}
 
+#Per-role override of a pool setting, e.g. AGENT_POOL_SIZE_OCR=8
+def role_setting(name, role, default):
+    value = os.getenv(f"{name}_{role.upper()}")
+    return type(default)(value) if value else default
+
+class AgentUnavailableError(Exception):
+    #Raised when no agent of a role can be obtained (queue full or timed out)
+    pass
+
+class DocumentProcessingError(Exception):
+    #Raised when extraction or analysis fails instead of giving a result.
+    #The PDF and OCR agents raise it, and it passes through the agents and
+    #the manager rather than being turned into an "Error: ..." string.
+    pass
+
 #---------------------
 #Agent Classes
 #---------------------
@@ -86,32 +998,49 @@ class Agent:
         self.role = role
         self.manager_id = manager_id
         self.status = "idle" #status of the agent idle/busy
-        self.memory = [] #Memory of completed agents tasks
+        self.memory = deque(maxlen=AGENT_MEMORY_SIZE) #Records of the most recent tasks
         AGENTS[self.id] = self#Register agent in AGENTS dictionary
 
     #Handle task assignment
     def assign_task(self, task, data=None):
-        self.memory.append(f"Assigned: {task}")
         self.status = "busy"
+        try:
+            return ASYNC_ENGINE.run(self.assign_task_async(task, data))
+        finally:
+            self.status = "idle"
+
+    #Run a task on the event loop. Unlike assign_task this doesn't mark the
+    #agent busy: concurrent calls share it and are bounded by the upstream limits.
+    async def assign_task_async(self, task, data=None):
+        started = time.time()
+        start = time.perf_counter()
         try:
             if self.role == "ocr":
-                result = ocr_agent_task(data)
+                result = await ocr_agent_task_async(data)
             elif self.role == "pdf":
-                result = pdf_agent_task(data)
+                result = await pdf_agent_task_async(data)
             elif self.role == "risk_analysis":
-                result = risk_agent_task(data)
+                result = await risk_agent_task_async(data)
             elif self.role == "translation":
-                result = translation_agent_task(data)
+                result = await translation_agent_task_async(data)
             elif self.role == "speech":
-                result = speech_agent_task(data)
+                result = await speech_agent_task_async(data)
             else:
                 result = f"{self.role} {self.name} completed: {task}"
+        except DocumentProcessingError as e:
+            self._record(task, started, time.perf_counter() - start, f"Error: {e}")
+            raise
         except Exception as e:
             app.logger.error(f"Agent {self.name} failed task {task}: {e}", exc_info=True)
             result = f"Error: {e}"
-        self.memory.append(f"Completed: {task}")
-        self.status = "idle"
+        self._record(task, started, time.perf_counter() - start, result)
         return result
+
+    def _record(self, task, started, seconds, result):
+        ok = not (isinstance(result, str) and result.startswith("Error"))
+        self.memory.append({"task": task, "started": round(started, 3), "seconds": round(seconds, 4), "ok": ok})
+        METRICS.observe("agent_task_seconds", seconds, role=self.role)
+        METRICS.inc("agent_tasks_total", role=self.role, outcome="ok" if ok else "error")
     
     #Return agent details as dictionary
     def to_dict(self):
@@ -121,319 +1050,2232 @@ class Agent:
             "role": self.role,
             "manager_id": self.manager_id,
             "status": self.status,
-            "memory": self.memory,
+            "memory": list(self.memory),
         }
 
+class AgentPool:
+    #Pool of agents sharing one role.
+    #Callers wait in a bounded FIFO queue so tasks are served in arrival order,
+    #and idle agents are handed out round-robin.
+    def __init__(self, role, max_concurrency=0, queue_limit=AGENT_QUEUE_LIMIT, queue_timeout=AGENT_QUEUE_TIMEOUT):
+        self.role = role
+        self.max_concurrency = max_concurrency #0 means limited only by pool size
+        self.queue_limit = queue_limit
+        self.queue_timeout = queue_timeout
+        self.idle = deque() #Idle agents, least recently used first
+        self.size = 0
+        self.in_flight = 0
+        self.waiting = deque() #Tickets of tasks waiting for an agent
+        self.cond = threading.Condition()
+        self.members = []
+        self.next_member = 0
+
+    def add(self, agent):
+        with self.cond:
+            agent.status = "idle"
+            self.idle.append(agent)
+            self.members.append(agent)
+            self.size += 1
+            self.cond.notify_all()
+
+    def next_agent(self):
+        #Round-robin pick for async tasks, which don't take an agent exclusively
+        with self.cond:
+            agent = self.members[self.next_member % len(self.members)]
+            self.next_member += 1
+            return agent
+
+    def _can_dispatch(self):
+        limit = self.max_concurrency or self.size
+        return bool(self.idle) and self.in_flight < limit
+
+    def _take(self):
+        agent = self.idle.popleft()
+        agent.status = "busy"
+        self.in_flight += 1
+        return agent
+
+    def acquire(self, timeout=None):
+        #Block until an agent is free, the queue is full or the wait times out
+        #(math.inf waits as long as it takes)
+        timeout = self.queue_timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            if not self.waiting and self._can_dispatch():
+                return self._take()
+            if len(self.waiting) >= self.queue_limit:
+                raise AgentUnavailableError(f"Too many queued {self.role} tasks ({self.queue_limit} waiting)")
+            ticket = object()
+            self.waiting.append(ticket)
+            try:
+                while not (self.waiting[0] is ticket and self._can_dispatch()):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise AgentUnavailableError(f"Timed out after {timeout}s waiting for a {self.role} agent")
+                    self.cond.wait(min(remaining, threading.TIMEOUT_MAX))
+                return self._take()
+            finally:
+                self.waiting.remove(ticket)
+                self.cond.notify_all()
+
+    def release(self, agent):
+        with self.cond:
+            agent.status = "idle"
+            self.in_flight -= 1
+            self.idle.append(agent)
+            self.cond.notify_all()
+
+    #Pool statistics for monitoring
+    def to_dict(self):
+        with self.cond:
+            return {
+                "role": self.role,
+                "size": self.size,
+                "busy": self.in_flight,
+                "idle": len(self.idle),
+                "waiting": len(self.waiting),
+                "max_concurrency": self.max_concurrency or self.size,
+                "queue_limit": self.queue_limit,
+            }
+
 class ManagerAgent(Agent):
     #Manager Agent who can delegate tasks to other agents
     #and manage the team
     def __init__(self, name, role="manager", manager_id=None):
         super().__init__(name, role, manager_id)
         self.team = []
+        self.pools = {} #role -> AgentPool
 
     def add_team_member(self, agent):
-        #Add agent under manager's team
+        #Add agent under manager's team and into the pool for its role
         self.team.append(agent.id)
         agent.manager_id = self.id
+        pool = self.pools.get(agent.role)
+        if pool is None:
+            pool = AgentPool(
+                agent.role,
+                max_concurrency=role_setting("AGENT_MAX_CONCURRENCY", agent.role, AGENT_MAX_CONCURRENCY),
+                queue_limit=role_setting("AGENT_QUEUE_LIMIT", agent.role, AGENT_QUEUE_LIMIT),
+                queue_timeout=role_setting("AGENT_QUEUE_TIMEOUT", agent.role, AGENT_QUEUE_TIMEOUT),
+            )
+            self.pools[agent.role] = pool
+        pool.add(agent)
 
-    def delegate_task(self, task, data=None):
-        #Delegate task to the appropriate agent in the team
-        eligible_agents = [AGENTS[agent_id] for agent_id in self.team 
-                          if AGENTS[agent_id].role == task]
-        
-        for agent in eligible_agents:
-            if agent.status == "idle":
-                try:
-                    result = agent.assign_task(task, data)
-                    self.memory.append(f"Delegated '{task}' to {agent.name}")
-                    return result
-                except Exception as e:
-                    app.logger.error(f"Manager {self.name} failed to delegate {task}: {e}", exc_info=True)
-                    return f"Error: {e}"
-        self.memory.append(f"No idle {task} agent available")
-        return f"No idle {task} agent available"
+    def delegate_task(self, task, data=None, timeout=None):
+        #Delegate task to the next free agent of the matching role,
+        #waiting in the role's queue if all of them are busy
+        pool = self.pools.get(task)
+        if pool is None:
+            self.memory.append({"task": task, "started": round(time.time(), 3), "ok": False, "error": "no agent in team"})
+            raise AgentUnavailableError(f"No {task} agent available")
+        #Bulk documents are already bounded by BULK_CONCURRENCY and would
+        #rather wait their turn behind interactive work than fail
+        if timeout is None and UPSTREAM_PRIORITY.get() == "bulk":
+            timeout = math.inf
+        queued = time.perf_counter()
+        agent = pool.acquire(timeout)
+        waited = time.perf_counter() - queued
+        METRICS.observe("agent_queue_wait_seconds", waited, role=task)
+        try:
+            result = agent.assign_task(task, data)
+            self.memory.append({"task": task, "agent": agent.name, "started": round(time.time(), 3), "wait_seconds": round(waited, 4)})
+            return result
+        except DocumentProcessingError:
+            raise
+        except Exception as e:
+            app.logger.error(f"Manager {self.name} failed to delegate {task}: {e}", exc_info=True)
+            return f"Error: {e}"
+        finally:
+            pool.release(agent)
+
+    #Async delegation for fan-out on the event loop: no queueing, concurrency
+    #is bounded per upstream service by ASYNC_ENGINE
+    async def delegate_task_async(self, task, data=None):
+        pool = self.pools.get(task)
+        if pool is None:
+            self.memory.append({"task": task, "started": round(time.time(), 3), "ok": False, "error": "no agent in team"})
+            raise AgentUnavailableError(f"No {task} agent available")
+        agent = pool.next_agent()
+        self.memory.append({"task": task, "agent": agent.name, "started": round(time.time(), 3), "wait_seconds": 0.0})
+        return await agent.assign_task_async(task, data)
     
     #Manager details including team members
     def to_dict(self):
-        d = super().to_dict()
-        d["team"] = self.team
-        return d
+        d = super().to_dict()
+        d["team"] = self.team
+        d["pools"] = {role: pool.to_dict() for role, pool in self.pools.items()}
+        return d
+
+#-----------------------------------
+# Content-addressed Result Cache
+#-----------------------------------
+#Bump when the risk prompt or its parsing changes so old results are not reused
+RISK_PROMPT_VERSION = "5"
+
+#SHA-256 hex digest of uploaded bytes or extracted text
+def content_hash(data):
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return hashlib.sha256(data).hexdigest()
+
+class ResultCache:
+    #LRU cache of JSON-serialisable results with an optional SQLite backend
+    #that survives restarts. Safe to share between request threads.
+    #With a ttl, entries older than ttl seconds are treated as missing.
+    def __init__(self, namespace, max_entries=RESULT_CACHE_SIZE, db_path=RESULT_CACHE_DB, ttl=0):
+        self.namespace = namespace
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict() #key -> (serialised value, created)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        #Exported at zero so rate() sees the series before the first lookup
+        METRICS.inc("cache_hits_total", 0, cache=namespace)
+        METRICS.inc("cache_misses_total", 0, cache=namespace)
+        self.db = None
+        if db_path:
+            self.db = sqlite3.connect(db_path, check_same_thread=False)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS result_cache ("
+                "namespace TEXT, key TEXT, value TEXT, created REAL, "
+                "PRIMARY KEY (namespace, key))"
+            )
+            self.db.commit()
+
+    def _remember(self, key, value, created):
+        self.entries[key] = (value, created)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def _expired(self, created):
+        return self.ttl > 0 and time.time() - created > self.ttl
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self._expired(entry[1]):
+                del self.entries[key]
+                entry = None
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                METRICS.inc("cache_hits_total", cache=self.namespace)
+                return json.loads(entry[0])
+            if self.db is not None:
+                row = self.db.execute(
+                    "SELECT value, created FROM result_cache WHERE namespace = ? AND key = ?",
+                    (self.namespace, key)
+                ).fetchone()
+                if row and not self._expired(row[1]):
+                    self._remember(key, row[0], row[1])
+                    self.hits += 1
+                    METRICS.inc("cache_hits_total", cache=self.namespace)
+                    return json.loads(row[0])
+            self.misses += 1
+            METRICS.inc("cache_misses_total", cache=self.namespace)
+            return None
+
+    def set(self, key, value):
+        #Values are stored serialised so callers can't mutate cached results
+        encoded = json.dumps(value)
+        created = time.time()
+        with self.lock:
+            self._remember(key, encoded, created)
+            if self.db is not None:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO result_cache (namespace, key, value, created) VALUES (?, ?, ?, ?)",
+                    (self.namespace, key, encoded, created)
+                )
+                self.db.commit()
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+TEXT_CACHE = ResultCache("text") #Extracted text keyed by file type + hash of uploaded bytes
+RISK_CACHE = ResultCache("risk") #Risk results keyed by text hash + prompt version + model
+#Parsed model output per section, same key format as RISK_CACHE, so
+#unchanged sections of an edited or regenerated document are not resent
+RISK_SECTION_CACHE = ResultCache("risk_section", RISK_SECTION_CACHE_SIZE)
+
+def llm_configured():
+    return bool((AZURE_OPENAI_KEY and AZURE_OPENAI_DEPLOYMENT and AZURE_OPENAI_ENDPOINT) or OPENAI_API_KEY)
+
+RISK_MODEL = "gpt-3.5-turbo-16k" #OpenAI model for the risk prompt; Azure uses its deployment
+
+#Model of the preferred provider, part of the risk cache key. Results
+#answered by another provider (failover, latency routing) are not cached
+#under it, see extract_and_score_risks_async.
+def risk_model_id():
+    providers = llm_providers()
+    if providers:
+        return providers[0].model_id(RISK_MODEL)
+    return "local:rules" #Offline clause screening, see local_risk_analysis
+
+def risk_cache_key(text):
+    return f"{content_hash(text)}:v{RISK_PROMPT_VERSION}:{risk_model_id()}:{KNOWN_CLAUSES.version}"
+
+#Run risk analysis through the manager unless a cached result exists.
+#bypass_cache also skips the per-section cache. Failed and incomplete
+#analyses are never cached; the sections that did finish still are.
+#Neither are sections answered by a fallback provider.
+def cached_risk_analysis(manager, text, filename, bypass_cache=False):
+    key = risk_cache_key(text)
+    if not bypass_cache:
+        cached = RISK_CACHE.get(key)
+        if cached is not None:
+            app.logger.debug(f"Risk cache hit for {filename}")
+            return cached
+    result = manager.delegate_task("risk_analysis", {"text": text, "filename": filename, "refresh": bypass_cache})
+    if not isinstance(result, dict):
+        return result
+    if result.pop("cacheable", True) and result.get("title") != "Risk Detection Failed" and not result.get("incomplete"):
+        RISK_CACHE.set(key, result)
+    return result
+
+#-----------------------------------
+# Azure Service Agent Task Functions
+#-----------------------------------
+#OCR results keyed by a hash of the preprocessed pixels, so the same
+#picture re-saved with different metadata or compression still hits
+OCR_CACHE = ResultCache("ocr")
+#Pillow releases the GIL while decoding and resizing, so threads run in parallel
+IMAGE_EXECUTOR = ThreadPoolExecutor(max_workers=OCR_PREPROCESS_WORKERS, thread_name_prefix="image")
+
+#Prepare a photo for OCR: apply EXIF rotation, convert to grayscale,
+#downscale to OCR_MAX_DIMENSION and re-encode as JPEG.
+#Returns (bytes to send, pixel hash); the original is kept if it is smaller.
+def preprocess_image(image_data):
+    try:
+        with Image.open(BytesIO(image_data)) as original:
+            img = ImageOps.exif_transpose(original).convert("L")
+        if max(img.size) > OCR_MAX_DIMENSION:
+            img.thumbnail((OCR_MAX_DIMENSION, OCR_MAX_DIMENSION), Image.LANCZOS)
+        pixel_hash = content_hash(f"{img.size}".encode() + img.tobytes())
+        output = BytesIO()
+        img.save(output, format="JPEG", quality=OCR_JPEG_QUALITY, optimize=True)
+        processed = output.getvalue()
+    except Exception as e:
+        app.logger.warning(f"Image preprocessing failed, sending original: {e}")
+        return image_data, content_hash(image_data)
+    return (processed if len(processed) < len(image_data) else image_data), pixel_hash
+
+#OCR Agent Task (reads text from image using Azure CV)
+@instrument_stage("ocr")
+async def ocr_agent_task_async(image_data):
+    if not AZURE_CV_ENDPOINT or not AZURE_CV_KEY:
+        app.logger.error("OCR service not configured (missing endpoint/key)")
+        raise DocumentProcessingError("OCR service not configured.")
+    ocr_url = AZURE_CV_ENDPOINT.rstrip('/') + "/vision/v3.2/ocr"
+    headers = {"Content-Type": "application/octet-stream"}
+    try:
+        loop = asyncio.get_running_loop()
+        image_data, pixel_hash = await loop.run_in_executor(IMAGE_EXECUTOR, preprocess_image, image_data)
+        cached = await asyncio.to_thread(OCR_CACHE.get, pixel_hash)
+        if cached is not None:
+            return cached
+
+        response = await OCR_CLIENT.post(ocr_url, headers=headers, data=image_data)
+        response.raise_for_status()
+        analysis = response.json()
+        
+        #Assemble text from OCR response line by line
+        extracted_text = ""
+        for region in analysis.get("regions", []):
+            for line in region.get("lines", []):
+                line_text = " ".join(word["text"] for word in line.get("words", []))
+                extracted_text += line_text + "\n"
+        await asyncio.to_thread(OCR_CACHE.set, pixel_hash, extracted_text.strip())
+        return extracted_text.strip()
+    except Exception as e:
+        app.logger.error(f"Error extracting text from image: {e}", exc_info=True)
+        raise DocumentProcessingError(f"Error extracting text from image: {e}") from e
+
+def ocr_agent_task(image_data):
+    return ASYNC_ENGINE.run(ocr_agent_task_async(image_data))
+    
+#---------------------------
+# PDF Extraction Engine
+#---------------------------
+PDF_MIN_PAGE_CHARS = 20 #Pages with less text than this are retried with pdfminer
+_pdf_process_pool = None
+_pdf_process_pool_lock = threading.Lock()
+
+#Shared process pool for large PDFs (spawned, so it is safe next to Flask threads)
+def get_pdf_process_pool():
+    global _pdf_process_pool
+    with _pdf_process_pool_lock:
+        if _pdf_process_pool is None:
+            _pdf_process_pool = ProcessPoolExecutor(
+                max_workers=PDF_PROCESS_WORKERS,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return _pdf_process_pool
+
+def reset_pdf_process_pool(broken_pool):
+    global _pdf_process_pool
+    with _pdf_process_pool_lock:
+        if _pdf_process_pool is broken_pool:
+            _pdf_process_pool = None
+    broken_pool.shutdown(wait=False, cancel_futures=True)
+
+#A PDF source is its bytes, or the path of a spooled upload (see Upload),
+#which pool workers open themselves instead of receiving a pickled copy
+def open_pdf(source):
+    if isinstance(source, str):
+        return fitz.open(source, filetype="pdf")
+    return fitz.open(stream=source, filetype="pdf")
+
+#Extract pages [start, stop) with PyMuPDF, falling back to pdfminer only
+#for pages with too little text. The sparse pages go to pdfminer in one
+#call (it re-parses the document per call); pages without fonts are
+#image-only and left to OCR. Runs in-process or in a pool worker.
+def extract_page_range(source, start, stop, deadline):
+    pages = {}
+    sparse = []
+    with open_pdf(source) as doc:
+        for page_no in range(start, stop):
+            if time.time() > deadline:
+                break
+            page = doc[page_no]
+            pages[page_no] = page.get_text("text").strip()
+            if len(pages[page_no]) < PDF_MIN_PAGE_CHARS and page.get_fonts():
+                sparse.append(page_no)
+    if sparse and time.time() <= deadline:
+        try:
+            #pdfminer ends every page with a form feed
+            fallback = extract_text(source if isinstance(source, str) else BytesIO(source), page_numbers=set(sparse))
+            for page_no, text in zip(sparse, fallback.split("\f")):
+                if len(text.strip()) > len(pages[page_no]):
+                    pages[page_no] = text.strip()
+        except Exception as e:
+            app.logger.warning(f"pdfminer fallback failed on pages {sparse[0] + 1}-{sparse[-1] + 1}: {e}")
+    return list(pages.items())
+
+#Scanned pages have no text layer: render them and OCR up to
+#PDF_OCR_CONCURRENCY at a time. Identical pages hit OCR_CACHE, so a
+#re-uploaded or partly changed scan only sends the new pages.
+@instrument_stage("pdf_ocr")
+def ocr_scanned_pages(source, page_numbers, deadline):
+    if not AZURE_CV_ENDPOINT or not AZURE_CV_KEY:
+        app.logger.warning(f"Skipping OCR of {len(page_numbers)} scanned PDF pages, OCR service not configured")
+        return {}
+    #Each slot is one rendered page waiting on OCR, so rendering overlaps
+    #the calls without holding every page image in memory at once
+    slots = threading.BoundedSemaphore(PDF_OCR_CONCURRENCY)
+    futures = {}
+    with open_pdf(source) as doc:
+        for page_no in page_numbers:
+            if not slots.acquire(timeout=max(0, deadline - time.time())):
+                break
+            pixmap = doc[page_no].get_pixmap(dpi=PDF_OCR_DPI, colorspace=fitz.csGRAY)
+            futures[page_no] = ASYNC_ENGINE.submit(ocr_agent_task_async(pixmap.tobytes("png")))
+            futures[page_no].add_done_callback(lambda _: slots.release())
+
+    texts = {}
+    for page_no, future in futures.items():
+        try:
+            text = future.result(timeout=max(0, deadline - time.time()) + 5)
+        except TimeoutError:
+            future.cancel()
+            continue
+        except DocumentProcessingError as e:
+            app.logger.warning(f"OCR failed on PDF page {page_no + 1}: {e}")
+            continue
+        texts[page_no] = text
+    if len(texts) < len(page_numbers):
+        app.logger.warning(f"OCR recovered {len(texts)} of {len(page_numbers)} scanned PDF pages")
+    return texts
+
+#Extract a PDF page by page within PDF_MAX_PAGES / PDF_MAX_SECONDS.
+#Pages without a text layer are OCR'd. With offload, PDFs too small to split
+#are still sent to the process pool, so many documents extract in parallel.
+#Returns the joined text plus per-page text with character offsets into it.
+def extract_pdf_pages(source, offload=False):
+    deadline = time.time() + PDF_MAX_SECONDS
+    with open_pdf(source) as doc:
+        page_count = doc.page_count
+    limit = min(page_count, PDF_MAX_PAGES) if PDF_MAX_PAGES else page_count
+
+    if PDF_PROCESS_WORKERS <= 1 or (limit < PDF_PARALLEL_MIN_PAGES and not offload):
+        results = extract_page_range(source, 0, limit, deadline)
+    else:
+        #Twice as many ranges as workers so a slow range doesn't hold up the rest;
+        #offloaded small PDFs go as one range
+        if limit < PDF_PARALLEL_MIN_PAGES:
+            step = max(1, limit)
+        else:
+            step = max(1, -(-limit // (PDF_PROCESS_WORKERS * 2)))
+        pool = get_pdf_process_pool()
+        ranges = [(start, min(start + step, limit)) for start in range(0, limit, step)]
+        futures = [pool.submit(extract_page_range, source, start, stop, deadline) for start, stop in ranges]
+        results = []
+        for (start, stop), future in zip(ranges, futures):
+            try:
+                results.extend(future.result(timeout=max(0, deadline - time.time()) + 5))
+            except TimeoutError:
+                future.cancel()
+            except Exception as e:
+                #A crashed worker breaks the pool; recreate it next time and finish this range here
+                app.logger.error(f"PDF page range {start + 1}-{stop} failed in worker: {e}")
+                reset_pdf_process_pool(pool)
+                results.extend(extract_page_range(source, start, stop, deadline))
+
+    results = dict(results)
+    scanned = [page_no for page_no in sorted(results) if len(results[page_no]) < PDF_MIN_PAGE_CHARS]
+    ocr_pages = ocr_scanned_pages(source, scanned, deadline) if scanned else {}
+    for page_no, text in ocr_pages.items():
+        if len(text) > len(results[page_no]):
+            results[page_no] = text
+
+    pages = []
+    offset = 0
+    for page_no, text in sorted(results.items()):
+        pages.append({
+            "page": page_no + 1, "text": text, "start": offset, "end": offset + len(text),
+            "ocr": page_no in ocr_pages
+        })
+        offset += len(text) + 1
+    if len(pages) < page_count:
+        app.logger.warning(f"PDF extraction stopped at {len(pages)} of {page_count} pages")
+    return {
+        "text": "\n".join(p["text"] for p in pages),
+        "pages": pages,
+        "page_count": page_count,
+        "truncated": len(pages) < page_count
+    }
+
+#PDF Agent Task-reads text from PDF using PyMuPDF with per-page pdfminer fallback.
+#Takes PDF bytes, a file object or the path of a spooled upload.
+#Given {"data": ..., "pages": True} it returns the full extract_pdf_pages result;
+#"offload": True extracts even small PDFs in the process pool.
+#Extraction is CPU work, so the async version runs it in a thread.
+@instrument_stage("pdf")
+def pdf_agent_task(file):
+    try:
+        with_pages = False
+        offload = False
+        if isinstance(file, dict):
+            if "data" not in file:
+                raise ValueError("Invalid file format received") #Validation
+            with_pages = file.get("pages", False)
+            offload = file.get("offload", False)
+            file = file["data"]
+        source = file if isinstance(file, (bytes, bytearray, str)) else file.read()
+        extracted = extract_pdf_pages(source, offload)
+        return extracted if with_pages else extracted["text"].strip()
+    except Exception as e:
+        app.logger.error(f"Error extracting text from PDF: {e}", exc_info=True)
+        raise DocumentProcessingError(f"Error extracting text from PDF: {e}") from e
+
+async def pdf_agent_task_async(file):
+    return await asyncio.to_thread(pdf_agent_task, file)
+
+#Translator v3 request limits
+TRANSLATOR_MAX_ELEMENTS = 1000 #Texts per request
+TRANSLATOR_MAX_CHARS = 50000 #Characters per request, all texts combined
+
+#Translations keyed by (text hash, target language), in-process only
+TRANSLATION_CACHE = ResultCache("translation", TRANSLATION_CACHE_SIZE, db_path="")
+
+#Group texts into batches within the Translator element and character limits
+def pack_translation_batches(texts):
+    batches = []
+    current, size = [], 0
+    for text in texts:
+        if current and (len(current) >= TRANSLATOR_MAX_ELEMENTS or size + len(text) > TRANSLATOR_MAX_CHARS):
+            batches.append(current)
+            current, size = [], 0
+        current.append(text)
+        size += len(text)
+    if current:
+        batches.append(current)
+    return batches
+
+#Translate a list of texts with as few Translator calls as possible, sending
+#the batches concurrently. Cached and repeated texts skip the network;
+#failed batches keep the original text.
+async def translate_texts_async(texts, to_lang):
+    #Cache lookups may hit SQLite, so they run off the event loop
+    def lookup(unique):
+        return {text: TRANSLATION_CACHE.get(f"{content_hash(text)}:{to_lang}") for text in unique if text.strip()}
+
+    def store(translations):
+        for text, translated in translations:
+            TRANSLATION_CACHE.set(f"{content_hash(text)}:{to_lang}", translated)
+
+    results = {}
+    missing = []
+    unique = list(dict.fromkeys(texts))
+    found = await asyncio.to_thread(lookup, unique)
+    for text in unique:
+        if not text.strip():
+            results[text] = text
+            continue
+        cached = found[text]
+        if cached is not None:
+            results[text] = cached
+        else:
+            missing.append(text)
+
+    if not missing:
+        return [results[text] for text in texts]
+    if not AZURE_TRANSLATOR_KEY:
+        app.logger.error("Translation service not configured (missing key)")
+        return [results.get(text, text) for text in texts] #Fallback to original text
+    endpoint = AZURE_TRANSLATOR_ENDPOINT.rstrip('/') + f"/translate?api-version=3.0&to={to_lang}"
+
+    async def translate_batch(batch):
+        body = [{"Text": text} for text in batch]
+        try:
+            response = await TRANSLATOR_CLIENT.post(endpoint, json_body=body, cost=sum(len(text) for text in batch))
+            response.raise_for_status()
+            translations = [(text, item["translations"][0]["text"]) for text, item in zip(batch, response.json())]
+            await asyncio.to_thread(store, translations)
+            results.update(translations)
+        except Exception as e:
+            app.logger.error(f"Translation failed: {e}", exc_info=True)
+
+    await asyncio.gather(*(translate_batch(batch) for batch in pack_translation_batches(missing)))
+    return [results.get(text, text) for text in texts]
+
+#Translation Agent Task
+#Accepts {"text": ...} for a single text or {"texts": [...]} for a batch
+@instrument_stage("translation")
+async def translation_agent_task_async(data):
+    to_lang = data.get("to_lang", "en")
+    if "texts" in data:
+        return await translate_texts_async(data.get("texts") or [], to_lang)
+    text = data.get("text")
+    if not text:
+        return text
+    return (await translate_texts_async([text], to_lang))[0]
+
+def translation_agent_task(data):
+    return ASYNC_ENGINE.run(translation_agent_task_async(data))
+
+#Risk Agent Task
+#Extracts risks from the document using LLM
+@instrument_stage("risk_analysis")
+async def risk_agent_task_async(data):
+    text = data.get("text")
+    filename = data.get("filename")
+    return await extract_and_score_risks_async(
+        text, filename, data.get("refresh", False), data.get("sections"), data.get("library", True)
+    )
+
+def risk_agent_task(data):
+    return ASYNC_ENGINE.run(risk_agent_task_async(data))
+
+#---------------------------
+# Speech Synthesis (segments)
+#---------------------------
+#For English use different voices based on severity
+ENGLISH_VOICE_MAP = {
+    "High Risk": ("en-US-GuyNeural", "newscast"),
+    "Moderate Risk": ("en-US-AriaNeural", "chat"),
+    "Informational": ("en-US-JennyNeural", "cheerful")
+}
+#For other languages use a single voice
+LANG_VOICE_MAP = {
+    "es": "es-ES-AlvaroNeural",
+    "fr": "fr-FR-DeniseNeural",
+    "it": "it-IT-DiegoNeural",
+    "de": "de-DE-ConradNeural",
+    "pt": "pt-PT-DuarteNeural",
+    "ta": "ta-IN-ValluvarNeural",
+    "zh-Hans": "zh-CN-YunxiNeural"
+}
+
+class AudioCache:
+    #Synthesized audio keyed by (text hash, voice, style, language).
+    #A byte-capped LRU in memory in front of a byte-capped directory on disk.
+    def __init__(self, max_memory_bytes=TTS_CACHE_MEMORY_BYTES, directory=TTS_CACHE_DIR, max_disk_bytes=TTS_CACHE_DISK_BYTES):
+        self.max_memory_bytes = max_memory_bytes
+        self.directory = directory if max_disk_bytes > 0 else None
+        self.max_disk_bytes = max_disk_bytes
+        self.entries = OrderedDict()
+        self.memory_bytes = 0
+        self.lock = threading.Lock()
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+
+    def _remember(self, key, audio):
+        if key in self.entries:
+            self.memory_bytes -= len(self.entries.pop(key))
+        self.entries[key] = audio
+        self.memory_bytes += len(audio)
+        while self.entries and self.memory_bytes > self.max_memory_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.memory_bytes -= len(evicted)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.mp3")
+
+    def get(self, key):
+        with self.lock:
+            audio = self.entries.get(key)
+            if audio is not None:
+                self.entries.move_to_end(key)
+                return audio
+        if not self.directory:
+            return None
+        try:
+            with open(self._path(key), "rb") as f:
+                audio = f.read()
+        except OSError:
+            return None
+        with self.lock:
+            self._remember(key, audio)
+        return audio
+
+    def set(self, key, audio):
+        with self.lock:
+            self._remember(key, audio)
+        if not self.directory:
+            return
+        try:
+            tmp_path = self._path(key) + f".{uuid.uuid4().hex}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(audio)
+            os.replace(tmp_path, self._path(key))
+            self._trim_disk()
+        except OSError as e:
+            app.logger.warning(f"Could not write TTS cache file: {e}")
+
+    def _trim_disk(self):
+        #Drop least recently written files once the directory is over its cap
+        files = [entry for entry in os.scandir(self.directory) if entry.name.endswith(".mp3")]
+        total = sum(entry.stat().st_size for entry in files)
+        for entry in sorted(files, key=lambda e: e.stat().st_mtime):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                total -= entry.stat().st_size
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+TTS_CACHE = AudioCache()
+
+#Split the summary and each risk clause into (text, voice, style, lang) segments
+def speech_segments(summary, risk_factors, target_lang="en"):
+    if target_lang == "en":
+        segments = [(summary, "en-US-JennyNeural", "general", target_lang)] if summary else []
+    else:
+        segments = [(summary, LANG_VOICE_MAP.get(target_lang, "en-US-JennyNeural"), "", target_lang)] if summary else []
+    if not risk_factors:
+        risk_factors = [{"text": "No legal risks or obligations were found in this document.", "severity": "Informational"}]
+    for item in risk_factors:
+        clause_text = item.get("text", "")
+        if not clause_text:
+            continue
+        if target_lang == "en":
+            voice, style = ENGLISH_VOICE_MAP.get(item.get("severity", "Informational"), ENGLISH_VOICE_MAP["Informational"])
+        else:
+            voice, style = LANG_VOICE_MAP.get(target_lang, "en-US-JennyNeural"), ""
+        segments.append((clause_text, voice, style, target_lang))
+    return segments
+
+#SSML document for one segment
+def segment_ssml(text, voice, style):
+    body = f'<prosody rate="medium" pitch="default">{html.escape(text)}</prosody>'
+    if style:
+        body = f'<mstts:express-as style="{style}">{body}</mstts:express-as>'
+    return f"""
+    <speak version="1.0" xml:lang="en-US"
+           xmlns:mstts="http://www.w3.org/2001/mstts"
+           xmlns="http://www.w3.org/2001/10/synthesis">
+        <voice name="{voice}">{body}</voice>
+    </speak>
+    """
+
+#Synthesize one segment with Azure Speech, or return it from the audio cache
+#(cache files are read and written off the event loop)
+async def synthesize_segment_async(text, voice, style, lang):
+    key = content_hash(f"{text}\x00{voice}\x00{style}\x00{lang}")
+    audio = await asyncio.to_thread(TTS_CACHE.get, key)
+    if audio is not None:
+        return audio
+    #Send request to Azure Speech service API
+    tts_url = SPEECH_ENDPOINT
+    headers = {
+        "Content-Type": "application/ssml+xml",
+        "X-Microsoft-OutputFormat": "audio-16khz-128kbitrate-mono-mp3",
+    }
+    response = await SPEECH_CLIENT.post(tts_url, headers=headers, data=segment_ssml(text, voice, style).encode("utf-8"), cost=len(text))
+    response.raise_for_status()
+    await asyncio.to_thread(TTS_CACHE.set, key, response.content)
+    return response.content
+
+#Synthesize segments TTS_CONCURRENCY at a time per request
+def schedule_segments(segments):
+    limit = asyncio.Semaphore(TTS_CONCURRENCY)
+    async def synthesize(segment):
+        async with limit:
+            return await synthesize_segment_async(*segment)
+    return [ASYNC_ENGINE.submit(synthesize(segment)) for segment in segments]
+
+#Yield segment audio in order while later segments are still being synthesized.
+#Failed segments are skipped so one bad clause doesn't silence the rest.
+def stream_speech(segments):
+    futures = schedule_segments(segments)
+    try:
+        for future in futures:
+            try:
+                yield future.result()
+            except Exception as e:
+                app.logger.error(f"Speech synthesis failed for a segment: {e}", exc_info=True)
+    finally:
+        for future in futures: #Client went away
+            future.cancel()
+
+#Speech Agent Task
+#Returns MP3 bytes, or an iterator of per-segment MP3 chunks with "stream": True
+@instrument_stage("speech")
+async def speech_agent_task_async(data):
+    segments = speech_segments(data.get("summary", ""), data.get("risk_factors", []), data.get("target_lang", "en"))
+    if data.get("stream"):
+        return stream_speech(segments)
+    limit = asyncio.Semaphore(TTS_CONCURRENCY)
+    async def synthesize(segment):
+        async with limit:
+            return await synthesize_segment_async(*segment)
+    chunks = await asyncio.gather(*(synthesize(segment) for segment in segments), return_exceptions=True)
+    for chunk in chunks:
+        if isinstance(chunk, Exception):
+            app.logger.error(f"Speech synthesis failed for a segment: {chunk}", exc_info=chunk)
+    audio = b"".join(chunk for chunk in chunks if isinstance(chunk, bytes))
+    return audio or None
+
+def speech_agent_task(data):
+    return ASYNC_ENGINE.run(speech_agent_task_async(data))
+
+# -------------------------------------------
+# Risk Extraction  with Severity Tags (LLM)
+#--------------------------------------------
+#Instructions only; the document text is sent once, as the user message
+RISK_PROMPT = (
+    "You are a legal document assistant. Analyze the document below and extract ONLY the clauses that include penalties/penalty, "
+    "fees, user obligations, personal data usage, disqualification, or legal consequences.\n"
+    "Ignore general descriptions or unrelated content.\n"
+    "Format your response as follows:\n"
+    "Title: [Your Title Here]\n"
+    "- [High Risk] Clause in plain English\n"
+    "- [Moderate Risk] Another clause...\n"
+    "- [Informational] Mild clauses, optional duties, or user advice\n\n"
+    "If no risks are found, return:\n"
+    "Title: No risks detected\n"
+    "- [Informational] No legal risks or obligations were found in this document.\n"
+)
+
+SEVERITY_ORDER = {
+    "High Risk": 0,
+    "Moderate Risk": 1,
+    "Informational": 2
+}
+
+#Splits before numbered clauses, (a)/(i) items, Section/Article headings,
+#ALL CAPS headings and at blank lines
+CLAUSE_BOUNDARY = re.compile(
+    r"\n\s*\n"
+    r"|\n(?=[ \t]*(?:\d+(?:\.\d+)*[.)]\s|\([a-zA-Z0-9]{1,4}\)\s|(?i:section|article|clause)\s+[\dIVXLC]+|[A-Z][A-Z0-9 ,&\-]{3,}\n))"
+)
+
+#Rough token estimate (~4 characters per token for English text)
+def estimate_tokens(text):
+    return len(text) // 4 + 1
+
+#Split a document into clauses on section/clause boundaries
+def split_into_clauses(text):
+    return [c.strip() for c in CLAUSE_BOUNDARY.split(text) if c and c.strip()]
+
+#Pack consecutive clauses into chunks that fit the token budget.
+#Clauses larger than the budget are split on sentences, then hard-cut.
+def chunk_document(text, max_tokens=None):
+    max_tokens = max_tokens or RISK_CHUNK_TOKENS
+    max_chars = max_tokens * 4
+    pieces = []
+    for clause in split_into_clauses(text):
+        if len(clause) <= max_chars:
+            pieces.append(clause)
+            continue
+        for sentence in re.split(r"(?<=[.;!?])\s+", clause):
+            for i in range(0, len(sentence), max_chars):
+                pieces.append(sentence[i:i + max_chars])
+    chunks = []
+    current = ""
+    for piece in pieces:
+        if current and len(current) + len(piece) + 2 > max_chars:
+            chunks.append(current)
+            current = ""
+        current = f"{current}\n\n{piece}" if current else piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+#Section IDs are content hashes of the chunk text, so the same text
+#always splits into the same sections with the same IDs
+def section_id(section_text):
+    return content_hash(section_text)[:12]
+
+#Clause text with case, punctuation and spacing ignored
+def risk_key(text):
+    return re.sub(r"[^a-z0-9]+", " ", text.lower()).strip()
+
+#Give each risk a stable clause ID: the same clause found in the same
+#section always gets the same ID, so reviewers can refer to it
+def tag_risks(section, risks):
+    return [
+        {**risk, "id": content_hash(f"{section}\x00{risk_key(risk['text'])}")[:12], "section": section}
+        for risk in risks
+    ]
+
+#------------------------------
+# Clause Pre-screening (rules)
+#------------------------------
+#Categories the risk prompt asks for. Every keyword is compiled into one
+#case-insensitive regex, so a clause is scanned once no matter how many
+#rules there are. Rules start with a literal letter or a character class.
+CLAUSE_RULES = [
+    ("penalty", "High Risk", [
+        r"penalt\w*", r"liquidated damages", r"late (?:fee|charge|payment)s?", r"forfeit\w*", r"fines?", r"surcharges?"
+    ]),
+    ("termination", "High Risk", [
+        r"terminat\w*", r"evict\w*", r"cancel\w*", r"default\w*", r"breach\w*", r"repossess\w*"
+    ]),
+    ("liability", "High Risk", [
+        r"indemnif\w*", r"hold harmless", r"liab(?:le|ility|ilities)", r"damages?", r"at (?:your|their) own (?:risk|expense)"
+    ]),
+    ("dispute", "High Risk", [
+        r"arbitrat\w*", r"waive[sdr]?", r"waiver", r"class action", r"jury trial", r"legal action", r"court costs?"
+    ]),
+    ("disqualification", "High Risk", [
+        r"disqualif\w*", r"ineligib\w*", r"suspen(?:d|ds|ded|sion)", r"revok\w*", r"revocation"
+    ]),
+    ("fee", "Moderate Risk", [
+        r"fees?", r"charg\w*", r"pay\w*", r"costs?", r"dollars?", r"tolls?", r"deposits?", r"interest", r"reimburs\w*",
+        r"non-?refundable", r"[$€£]\s?\d[\d,]*(?:\.\d+)?"
+    ]),
+    ("personal_data", "Moderate Risk", [
+        r"personal (?:data|information)", r"privacy", r"consent", r"third[- ]part(?:y|ies)", r"disclos\w*",
+        r"credit (?:check|report)s?", r"background checks?", r"monitor\w*", r"gps", r"tracking"
+    ]),
+    ("renewal", "Moderate Risk", [
+        r"auto(?:matic(?:ally)?)?[- ]?renew\w*", r"renew\w*"
+    ]),
+    ("obligation", "Informational", [
+        r"must", r"required to", r"responsible for", r"obligat\w*", r"shall not", r"may not", r"prohibit\w*", r"notice"
+    ]),
+]
+RULE_WEIGHTS = {"High Risk": 3, "Moderate Risk": 2, "Informational": 1}
+RULE_SEVERITY = {category: severity for category, severity, _ in CLAUSE_RULES}
+#A phrase for every rule, in rule order, that the compiled pattern must
+#file under the rule's category; checked when the module loads
+CLAUSE_RULE_SAMPLES = {
+    "penalty": ["a penalty applies", "liquidated damages", "a late fee", "it is forfeited", "traffic fines", "a fuel surcharge"],
+    "termination": ["we may terminate", "the tenant is evicted", "cancellation", "in default", "a material breach", "the car is repossessed"],
+    "liability": ["you will indemnify us", "hold harmless", "we are not liable", "for any damages", "at your own risk"],
+    "dispute": ["binding arbitration", "you waive", "this waiver", "no class action", "a jury trial", "take legal action", "court costs"],
+    "disqualification": ["you may be disqualified", "ineligible entries", "access is suspended", "we may revoke", "revocation"],
+    "fee": ["a cleaning fee", "charged for cleaning", "pay all tolls", "the costs", "twenty dollars", "highway tolls",
+            "a deposit", "interest accrues", "to be reimbursed", "non-refundable", "$500"],
+    "personal_data": ["your personal data", "our privacy notice", "with your consent", "third parties", "we disclose it",
+                      "a credit check", "a background check", "we monitor use", "gps", "tracking devices"],
+    "renewal": ["it auto-renews", "renewal"],
+    "obligation": ["you must", "you are required to", "you are responsible for", "your obligations", "you shall not",
+                   "you may not", "smoking is prohibited", "written notice"],
+}
+#Phrases that must not match any rule
+CLAUSE_RULE_NON_MATCHES = ["the sky is blue", "gtracking", "gpsx", "repayment"]
+
+#A top-level "|" would split a rule's first letter from its other
+#alternatives, so such rules are never grouped by first letter
+def has_top_level_alternation(pattern):
+    depth = 0
+    in_class = False
+    escaped = False
+    for c in pattern:
+        if escaped:
+            escaped = False
+        elif c == "\\":
+            escaped = True
+        elif in_class:
+            in_class = c != "]"
+        elif c == "[":
+            in_class = True
+        elif c == "(":
+            depth += 1
+        elif c == ")":
+            depth -= 1
+        elif c == "|" and depth == 0:
+            return True
+    return False
+
+#Alternatives are grouped by first letter so only the few rules that can
+#start at a word are tried there. Each rule is one capturing group and
+#the returned list maps group number - 1 to its category.
+def compile_clause_rules(rules):
+    branches = defaultdict(list)
+    for category, _, patterns in rules:
+        for pattern in patterns:
+            first = pattern[0].lower() if pattern[0].isalpha() and not has_top_level_alternation(pattern) else ""
+            branches[first].append((category, pattern[len(first):]))
+    group_categories = []
+    alternatives = []
+    for first, rules_here in branches.items():
+        group_categories.extend(category for category, _ in rules_here)
+        alternatives.append(re.escape(first) + "(?:" + "|".join(f"({rest})" for _, rest in rules_here) + ")")
+    #Lookarounds instead of \b so rules starting with a currency sign still match
+    pattern = re.compile(r"(?<!\w)(?:" + "|".join(alternatives) + r")(?!\w)", re.IGNORECASE)
+    return pattern, group_categories
+
+CLAUSE_PATTERN, CLAUSE_GROUPS = compile_clause_rules(CLAUSE_RULES)
+
+def rule_categories(text):
+    return {CLAUSE_GROUPS[match.lastindex - 1] for match in CLAUSE_PATTERN.finditer(text)}
+
+#Raise if a rule's sample phrase is not filed under its category, or a
+#non-match is matched, so a broken rule can't silently stop matching
+def check_clause_rules():
+    for category, _, patterns in CLAUSE_RULES:
+        samples = CLAUSE_RULE_SAMPLES.get(category, [])
+        if len(samples) != len(patterns):
+            raise ValueError(f"Clause rules for {category} need one sample phrase per rule")
+        for pattern, sample in zip(patterns, samples):
+            if category not in rule_categories(sample):
+                raise ValueError(f"Clause rule {pattern!r} doesn't match its sample {sample!r}")
+    for text in CLAUSE_RULE_NON_MATCHES:
+        if rule_categories(text):
+            raise ValueError(f"Clause rules match {text!r}: {sorted(rule_categories(text))}")
+
+check_clause_rules()
+
+#Short lines without sentence punctuation are treated as headings and
+#sent along with the clause that follows them
+def is_heading(clause):
+    return len(clause) <= 80 and "\n" not in clause and not clause.endswith((".", ";", ","))
+
+#Split text into clauses and score each one against CLAUSE_RULES.
+#Returns every clause with its matched categories, score and severity.
+def screen_clauses(text):
+    screened = []
+    for index, clause in enumerate(split_into_clauses(text)):
+        categories = sorted(rule_categories(clause))
+        severities = [RULE_SEVERITY[c] for c in categories]
+        screened.append({
+            "index": index,
+            "text": clause,
+            "categories": categories,
+            "score": sum(RULE_WEIGHTS[s] for s in severities),
+            "severity": min(severities, key=SEVERITY_ORDER.get) if severities else None
+        })
+    return screened
+
+#Candidate clauses plus minimal context (the document's opening line for
+#the title, and the heading right before each candidate) for the LLM.
+#Returns "" when no clause matches any rule.
+@instrument_stage("prescreen")
+def prescreen_document(text):
+    clauses = screen_clauses(text)
+    keep = set()
+    for clause in clauses:
+        if clause["score"] >= RISK_PRESCREEN_MIN_SCORE:
+            keep.add(clause["index"])
+            if clause["index"] > 0 and is_heading(clauses[clause["index"] - 1]["text"]):
+                keep.add(clause["index"] - 1)
+    if not keep:
+        return ""
+    if is_heading(clauses[0]["text"]):
+        keep.add(0)
+    return "\n\n".join(clauses[i]["text"] for i in sorted(keep))
+
+#------------------------------
+# Clause Similarity (MinHash)
+#------------------------------
+#A text is reduced to hashed word shingles (k consecutive words) and the
+#shingle set to MINHASH_PERMUTATIONS minimum hash values. The share of equal
+#values in two signatures estimates the Jaccard similarity of their shingle
+#sets, so reworded or lightly edited clauses still come out as close.
+MINHASH_PERMUTATIONS = 64
+MINHASH_PRIME = (1 << 61) - 1
+MINHASH_BLOCK = 8192 #Shingles hashed per numpy batch, bounds the temporary matrix
+_minhash_seeds = np.random.default_rng(0x1E6A1E)
+MINHASH_A = _minhash_seeds.integers(1, 1 << 32, MINHASH_PERMUTATIONS, dtype=np.uint64)
+MINHASH_B = _minhash_seeds.integers(0, 1 << 32, MINHASH_PERMUTATIONS, dtype=np.uint64)
+SHINGLE_TOKEN = re.compile(r"[a-z0-9$€£%]+")
+
+@functools.lru_cache(maxsize=65536)
+def token_hash(token):
+    return zlib.crc32(token.encode("utf-8"))
+
+#Hashed word k-grams of text; texts shorter than k words are one shingle
+def shingle_hashes(text, k):
+    tokens = np.fromiter((token_hash(t) for t in SHINGLE_TOKEN.findall(text.lower())), dtype=np.uint64)
+    k = min(k, len(tokens))
+    if not k:
+        return tokens
+    count = len(tokens) - k + 1
+    shingles = tokens[:count].copy()
+    for j in range(1, k):
+        shingles = (shingles * np.uint64(1000003) + tokens[j:j + count]) & np.uint64(0xFFFFFFFF)
+    return shingles
+
+#MinHash signatures of texts, one row per text, plus a mask of the rows
+#that have any shingles (texts without words never match anything).
+#All shingles are hashed together in blocks and reduced per text.
+def minhash_signatures(texts, k=3):
+    shingles = [shingle_hashes(text, k) for text in texts]
+    lengths = np.array([len(s) for s in shingles], dtype=np.int64)
+    signatures = np.full((len(texts), MINHASH_PERMUTATIONS), 0xFFFFFFFF, dtype=np.uint64)
+    if not lengths.sum():
+        return signatures, lengths > 0
+    values = np.concatenate(shingles)
+    owners = np.repeat(np.arange(len(texts)), lengths)
+    for start in range(0, len(values), MINHASH_BLOCK):
+        block = values[start:start + MINHASH_BLOCK]
+        owner = owners[start:start + MINHASH_BLOCK]
+        hashed = ((block[:, None] * MINHASH_A + MINHASH_B) % np.uint64(MINHASH_PRIME)) & np.uint64(0xFFFFFFFF)
+        starts = np.flatnonzero(np.r_[True, owner[1:] != owner[:-1]])
+        rows = owner[starts]
+        signatures[rows] = np.minimum(signatures[rows], np.minimum.reduceat(hashed, starts, axis=0))
+    return signatures, lengths > 0
+
+class MinHashIndex:
+    #Signatures of a fixed set of texts for closest-match lookups.
+    #Every query is compared with every entry in one numpy pass per block,
+    #which is plenty for a clause library of a few thousand entries.
+    def __init__(self, texts, k=3):
+        self.k = k
+        self.signatures, self.valid = minhash_signatures(texts, k)
+
+    def __len__(self):
+        return len(self.signatures)
+
+    #(entry index, similarity) of the closest entry for each text
+    def best_matches(self, texts, block=256):
+        queries, valid = minhash_signatures(texts, self.k)
+        matches = []
+        for start in range(0, len(queries), block):
+            similarity = (queries[start:start + block, None, :] == self.signatures[None, :, :]).mean(axis=2)
+            similarity[:, ~self.valid] = 0
+            similarity[~valid[start:start + block]] = 0
+            best = similarity.argmax(axis=1)
+            matches.extend(zip(best.tolist(), similarity[np.arange(len(best)), best].tolist()))
+        return matches
+
+#Words that carry a figure: amounts, counts, periods and percentages
+NUMBER_WORDS = frozenset(
+    "zero one two three four five six seven eight nine ten eleven twelve thirteen fourteen fifteen "
+    "sixteen seventeen eighteen nineteen twenty thirty forty fifty sixty seventy eighty ninety hundred thousand".split()
+)
+
+def clause_figures(text):
+    return {
+        token for token in SHINGLE_TOKEN.findall(text.lower())
+        if token in NUMBER_WORDS or any(c.isdigit() or c in "$€£%" for c in token)
+    }
+
+#Indices of the texts left when each near-duplicate (similarity at or above
+#threshold to an earlier kept text with the same figures) is collapsed onto
+#the first one. Risks that differ in an amount or a period are never merged.
+def collapse_near_duplicates(texts, threshold, k=3):
+    signatures, valid = minhash_signatures(texts, k)
+    figures = [clause_figures(text) for text in texts]
+    kept = []
+    for i in range(len(texts)):
+        if valid[i] and any(
+            figures[j] == figures[i] and (signatures[j] == signatures[i]).mean() >= threshold for j in kept
+        ):
+            continue
+        kept.append(i)
+    return kept
+
+#------------------------------
+# Known-clause Library
+#------------------------------
+class ClauseLibrary:
+    #Common clauses with a severity and a plain-English explanation, loaded
+    #from CLAUSE_LIBRARY_PATH. Only near-verbatim copies match: the clause
+    #must reach CLAUSE_LIBRARY_THRESHOLD and carry no figure the entry
+    #doesn't. A match skips the LLM but is reported with the document's own
+    #wording; entries with a null severity are boilerplate without risk.
+    def __init__(self, entries=(), version="none"):
+        self.entries = [
+            e for e in entries
+            if e.get("id") and e.get("text") and (e.get("severity") is None or e["severity"] in SEVERITY_ORDER)
+        ]
+        self.version = version
+        self.index = MinHashIndex([e["text"] for e in self.entries]) if self.entries else None
+
+    @classmethod
+    def load(cls, path):
+        if not path or path.lower() == "off":
+            return cls()
+        try:
+            with open(path, "rb") as f:
+                raw = f.read()
+            entries = json.loads(raw)
+        except (OSError, ValueError) as e:
+            app.logger.warning(f"Clause library {path} not loaded: {e}")
+            return cls()
+        #The version goes into risk cache keys, so editing the library or the
+        #threshold retires old results
+        return cls(entries, f"{content_hash(raw)[:12]}@{CLAUSE_LIBRARY_THRESHOLD}")
+
+    #Matching library entry (or None) for each clause
+    def match(self, clauses):
+        if self.index is None:
+            return [None] * len(clauses)
+        return [
+            self.entries[i]
+            if score >= CLAUSE_LIBRARY_THRESHOLD and clause_figures(clause) <= clause_figures(self.entries[i]["text"])
+            else None
+            for clause, (i, score) in zip(clauses, self.index.best_matches(clauses))
+        ]
+
+    #Known clauses of text that carry a risk, and the remaining text with
+    #every known clause and the heading right before it removed.
+    #A remainder of nothing but headings is dropped.
+    def split(self, text):
+        if self.index is None:
+            return [], text
+        clauses = split_into_clauses(text)
+        matches = self.match(clauses)
+        if not any(matches):
+            return [], text
+        known = []
+        drop = set()
+        for i, entry in enumerate(matches):
+            if entry is None:
+                continue
+            drop.add(i)
+            #Index 0 is the document title, which the LLM still needs
+            if i > 1 and matches[i - 1] is None and is_heading(clauses[i - 1]):
+                drop.add(i - 1)
+            if entry["severity"]:
+                known.append(clauses[i])
+        rest = [clause for i, clause in enumerate(clauses) if i not in drop]
+        if all(is_heading(clause) for clause in rest):
+            rest = []
+        return known, "\n\n".join(rest)
+
+    #Library risks of the sections that are a known clause, by section id.
+    #The risk text is the clause as written; the library adds the severity
+    #and its explanation.
+    def resolve(self, sections):
+        resolved = {}
+        for (sid, section), entry in zip(sections, self.match([section for _, section in sections])):
+            if entry is None:
+                continue
+            resolved[sid] = [{
+                "text": compact_clause(section),
+                "severity": entry["severity"],
+                "explanation": entry["explanation"],
+                "library_id": entry["id"]
+            }] if entry["severity"] else []
+        return resolved
+
+KNOWN_CLAUSES = ClauseLibrary.load(CLAUSE_LIBRARY_PATH)
+
+#(section id, text) pairs the risk analysis runs on: clause-aligned chunks
+#of the document, or of its pre-screened clauses with RISK_PRESCREEN.
+#Clauses found in the known-clause library are a section of their own
+#(after the chunks) so they can be answered without the LLM.
+#Empty when pre-screening finds nothing.
+def risk_sections(text):
+    candidates = prescreen_document(text) if RISK_PRESCREEN else text
+    if not candidates:
+        return []
+    known, candidates = KNOWN_CLAUSES.split(candidates)
+    sections = [(section_id(chunk), chunk) for chunk in chunk_document(candidates) or [candidates]] if candidates else []
+    return sections + [(section_id(clause), clause) for clause in known]
+
+#Clause text on one line, shortened to 300 characters for a risk item
+def compact_clause(text):
+    text = " ".join(text.split())
+    return text[:297].rstrip() + "..." if len(text) > 300 else text
+
+#Rule-matched clauses of text as risks
+def local_clause_risks(text):
+    return [
+        {"text": compact_clause(clause["text"]), "severity": clause["severity"]}
+        for clause in screen_clauses(text)
+        if clause["score"] >= RISK_PRESCREEN_MIN_SCORE and not is_heading(clause["text"])
+    ]
+
+#Offline risk analysis from the rules alone, used when no LLM is configured
+def local_risk_analysis(text, filename=None):
+    risks = local_clause_risks(text)
+    if not risks:
+        return {
+            "title": "No risks detected",
+            "risks": [{"text": "No legal risks or obligations were found in this document.", "severity": "Informational"}]
+        }
+    risks.sort(key=lambda r: SEVERITY_ORDER.get(r["severity"], 3))
+    return {"title": fallback_title(text, filename), "risks": risks}
+
+#Parse "Title:" and "- [Severity] clause" lines from the model output
+def parse_gpt_response(response_text):
+    title = ""
+    risks = []
+    for line in response_text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if line.lower().startswith("title:"):
+            potential_title = line.split(":", 1)[1].strip()
+            if len(potential_title) > 3:
+                title = potential_title
+        elif re.match(r"^-\s+\[(High Risk|Moderate Risk|Informational)\]\s+", line):
+            match = re.match(r"^-\s+\[(.*?)\]\s+(.*)", line)
+            if match:
+                severity = match.group(1).strip()
+                clause_text = match.group(2).strip()
+                if clause_text:
+                    risks.append({"text": clause_text, "severity": severity})
+    return title, risks
+
+#Title used when the model did not return one
+def fallback_title(original_text, filename=None):
+    for orig_line in original_text.splitlines():
+        orig_line = orig_line.strip()
+        if 5 < len(orig_line) < 100:
+            return orig_line
+    if filename:
+        name = os.path.splitext(filename)[0]
+        return f"{name.capitalize()} Document Summary"
+    return ""
+
+#Merge per-chunk results: first real title wins, duplicate clauses across
+#chunks keep their highest severity, risks are ordered by severity
+def merge_risk_results(parsed_chunks, original_text, filename=None, failed_sections=()):
+    title = ""
+    merged = {}
+    for chunk_title, risks in parsed_chunks:
+        if not title and chunk_title and chunk_title.strip().lower() != "no risks detected":
+            title = chunk_title
+        for risk in risks:
+            key = risk_key(risk["text"])
+            existing = merged.get(key)
+            if existing is None:
+                merged[key] = dict(risk)
+            elif SEVERITY_ORDER.get(risk["severity"], 3) < SEVERITY_ORDER.get(existing["severity"], 3):
+                existing["severity"] = risk["severity"]
+    if not title:
+        #Every chunk said "No risks detected" (or gave no title)
+        titles = [t for t, _ in parsed_chunks if t]
+        title = titles[0] if titles else fallback_title(original_text, filename)
+    risks = list(merged.values())
+    #To sort the risks by severity
+    risks.sort(key=lambda r: SEVERITY_ORDER.get(r["severity"], 3))
+    merged_result = {
+        "title": title,
+        "risks": risks
+    }
+    #Sections that failed or missed the deadline are missing from the risks
+    if failed_sections:
+        merged_result["incomplete"] = True
+        merged_result["failed_sections"] = list(failed_sections)
+    return merged_result
+
+#Send one chunk to the LLM through the provider router.
+#Returns (answer, model id of the provider that answered).
+@instrument_stage("risk_chunk")
+async def request_risk_completion_async(chunk):
+    messages = [
+        {"role": "system", "content": RISK_PROMPT},
+        {"role": "user", "content": chunk}
+    ]
+    provider, response = await LLM_ROUTER.dispatch(messages, model=RISK_MODEL, temperature=0.4, max_tokens=800)
+    return response['choices'][0]['message']['content'].strip(), provider.model_id(RISK_MODEL)
+
+#Map-reduce risk extraction: the document is split into sections (see
+#risk_sections), analyzed concurrently, and the section results are merged.
+#Sections found in RISK_SECTION_CACHE are not resent unless refresh is set.
+#Sections that fail or are still running at the deadline are dropped and
+#the result is marked incomplete with their ids in "failed_sections".
+#Given sections, only those (section id, text) pairs are analyzed.
+#Sections matching the known-clause library skip the model unless
+#use_library is False.
+async def extract_and_score_risks_async(text, filename=None, refresh=False, sections=None, use_library=True):
+    if sections is None:
+        sections = await asyncio.to_thread(risk_sections, text)
+        if not sections:
+            return local_risk_analysis(text, filename)
+    #Library matching (MinHash) and the section cache (SQLite) run off the event loop
+    known = await asyncio.to_thread(KNOWN_CLAUSES.resolve, sections) if use_library else {}
+    if known:
+        METRICS.inc("clause_library_hits_total", len(known))
+    if not llm_configured():
+        app.logger.warning("No LLM API key configured, using rule-based risk screening")
+        parsed = [
+            ("", tag_risks(sid, known[sid] if sid in known else local_clause_risks(section)))
+            for sid, section in sections
+        ]
+        return merge_risk_results(parsed, text, filename)
+
+    def cached_sections():
+        found = {}
+        for sid, section in sections:
+            if sid not in known:
+                cached = RISK_SECTION_CACHE.get(risk_cache_key(section))
+                if cached is not None:
+                    found[sid] = cached
+        return found
+
+    results = {sid: ("", risks) for sid, risks in known.items()}
+    if not refresh:
+        results.update(await asyncio.to_thread(cached_sections))
+    missing = {sid: section for sid, section in sections if sid not in results}
+    if results:
+        app.logger.debug(f"Reusing {len(results)} known or cached risk sections, analyzing {len(missing)}")
+
+    limit = asyncio.Semaphore(RISK_CHUNK_CONCURRENCY)
+    primary = risk_model_id()
+    fallback_sections = set() #Answered by a provider other than the one in the cache keys
+    async def analyze(sid, section):
+        async with limit:
+            answer, model_id = await request_risk_completion_async(section)
+            if model_id != primary:
+                fallback_sections.add(sid)
+            return parse_gpt_response(answer)
+    futures = {sid: asyncio.ensure_future(analyze(sid, section)) for sid, section in missing.items()}
+    errors = []
+    failed = []
+    if futures:
+        done, not_done = await asyncio.wait(futures.values(), timeout=RISK_DEADLINE_SECONDS)
+        for future in not_done:
+            future.cancel()
+        if not_done:
+            app.logger.warning(f"Risk analysis deadline hit: {len(not_done)} of {len(sections)} sections dropped")
+        for sid, future in futures.items():
+            if future not in done:
+                failed.append(sid)
+                continue
+            try:
+                results[sid] = future.result()
+            except Exception as e:
+                app.logger.error(f"Risk section failed: {e}", exc_info=True)
+                errors.append(e)
+                failed.append(sid)
+                continue
+            if sid not in fallback_sections:
+                await asyncio.to_thread(RISK_SECTION_CACHE.set, risk_cache_key(missing[sid]), list(results[sid]))
+
+    #Keep section order so the merged output follows the document
+    parsed_chunks = [
+        (results[sid][0], tag_risks(sid, results[sid][1]))
+        for sid, _ in sections if sid in results
+    ]
+    if not parsed_chunks:
+        reason = str(errors[0]) if errors else f"Risk analysis timed out after {RISK_DEADLINE_SECONDS}s"
+        return {"title": "Risk Detection Failed", "risks": [{"text": reason, "severity": "Error"}]}
+    merged = merge_risk_results(parsed_chunks, text, filename, failed)
+    if fallback_sections & results.keys():
+        merged["cacheable"] = False
+    return merged
+
+
+#------------------------------
+#Document Retrieval Index (/ask)
+#------------------------------
+STOPWORDS = frozenset(
+    "a an and are as at be by for from has have if in is it its of on or that the this to was were will with "
+    "i you your we our they their he she my me what when where which who how can do does did not no".split()
+)
+
+def tokenize(text):
+    return [t for t in re.findall(r"[a-z0-9]+", text.lower()) if t not in STOPWORDS]
+
+class Embedder:
+    #Interface for optional dense embeddings used alongside BM25
+    def embed(self, texts):
+        #Return a (len(texts), dim) float array
+        raise NotImplementedError
+
+class AzureOpenAIEmbedder(Embedder):
+    def __init__(self):
+        self.client = LLMClient("Azure embeddings", "azure", AZURE_OPENAI_ENDPOINT, AZURE_OPENAI_KEY,
+                                api_version="2023-05-15", engine=AZURE_OPENAI_EMBEDDING_DEPLOYMENT)
+
+    def embed(self, texts):
+        #Long documents have more passages than one request accepts
+        embeddings = []
+        for start in range(0, len(texts), EMBEDDING_BATCH_SIZE):
+            response = self.client.embed(texts[start:start + EMBEDDING_BATCH_SIZE])
+            embeddings.extend(item["embedding"] for item in sorted(response["data"], key=lambda item: item["index"]))
+        vectors = np.array(embeddings, dtype=np.float32)
+        return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-9)
+
+def default_embedder():
+    if AZURE_OPENAI_EMBEDDING_DEPLOYMENT and AZURE_OPENAI_KEY and AZURE_OPENAI_ENDPOINT:
+        return AzureOpenAIEmbedder()
+    return None
+
+class RetrievalIndex:
+    #BM25 index over a document's passages.
+    #Postings are NumPy arrays so a query is scored with a few vector operations per term.
+    K1 = 1.5
+    B = 0.75
+
+    def __init__(self, passages, embedder=None):
+        self.passages = passages
+        self.doc_len = np.zeros(len(passages), dtype=np.float32)
+        postings = {}
+        for doc_id, passage in enumerate(passages):
+            terms = tokenize(passage)
+            self.doc_len[doc_id] = len(terms)
+            counts = {}
+            for term in terms:
+                counts[term] = counts.get(term, 0) + 1
+            for term, tf in counts.items():
+                postings.setdefault(term, ([], []))
+                postings[term][0].append(doc_id)
+                postings[term][1].append(tf)
+        n = max(len(passages), 1)
+        self.avgdl = float(self.doc_len.mean()) if len(passages) else 0.0
+        self.postings = {}
+        for term, (ids, tfs) in postings.items():
+            idf = np.log(1 + (n - len(ids) + 0.5) / (len(ids) + 0.5))
+            self.postings[term] = (np.array(ids, dtype=np.int32), np.array(tfs, dtype=np.float32), idf)
+
+        self.embedder = embedder
+        self.vectors = None
+        if embedder is not None and passages:
+            try:
+                self.vectors = embedder.embed(passages)
+            except Exception as e:
+                app.logger.error(f"Passage embedding failed, using BM25 only: {e}", exc_info=True)
+
+    def bm25(self, query):
+        scores = np.zeros(len(self.passages), dtype=np.float32)
+        norm = self.K1 * (1 - self.B + self.B * self.doc_len / max(self.avgdl, 1e-9))
+        for term in set(tokenize(query)):
+            posting = self.postings.get(term)
+            if posting is None:
+                continue
+            ids, tfs, idf = posting
+            scores[ids] += idf * tfs * (self.K1 + 1) / (tfs + norm[ids])
+        return scores
+
+    def search(self, query, k=RETRIEVAL_TOP_K):
+        #Indexes of the top-k passages, in document order
+        if not self.passages:
+            return []
+        scores = self.bm25(query)
+        if self.vectors is not None:
+            try:
+                query_vector = self.embedder.embed([query])[0]
+                top = scores.max()
+                scores = (scores / top if top > 0 else scores) + self.vectors @ query_vector
+            except Exception as e:
+                app.logger.error(f"Query embedding failed, using BM25 only: {e}", exc_info=True)
+        k = min(k, len(self.passages))
+        top_ids = np.argpartition(-scores, k - 1)[:k]
+        return sorted(int(i) for i in top_ids if scores[i] > 0) or [0]
+
+_index_cache = OrderedDict()
+_index_cache_lock = threading.Lock()
+
+#Retrieval index for a document text, built once per distinct text (LRU)
+def get_document_index(text):
+    key = content_hash(text)
+    with _index_cache_lock:
+        index = _index_cache.get(key)
+        if index is not None:
+            _index_cache.move_to_end(key)
+            return index
+    index = RetrievalIndex(chunk_document(text, RETRIEVAL_CHUNK_TOKENS), default_embedder())
+    with _index_cache_lock:
+        _index_cache[key] = index
+        while len(_index_cache) > RETRIEVAL_INDEX_CACHE_SIZE:
+            _index_cache.popitem(last=False)
+    return index
+
+#Passages of the document most relevant to the question.
+#Short documents are sent whole since they already fit the budget.
+def retrieve_passages(full_text, question, k=RETRIEVAL_TOP_K):
+    if estimate_tokens(full_text) <= RETRIEVAL_CHUNK_TOKENS * k:
+        return [full_text]
+    index = get_document_index(full_text)
+    return [index.passages[i] for i in index.search(question or "", k)]
+
+#------------------------------
+#Document Sessions
+#------------------------------
+class DocumentNotFoundError(Exception):
+    #Raised when a document_id is unknown or has expired
+    pass
+
+#SQLite file shared by worker processes; WAL lets readers run during a write
+def open_session_db(path):
+    db = sqlite3.connect(path, check_same_thread=False, timeout=10)
+    db.execute("PRAGMA journal_mode=WAL")
+    return db
+
+class DocumentStore:
+    #Server-side documents (text, PDF pages, latest analysis) keyed by document_id,
+    #so clients don't have to send the full text back on every request.
+    #Entries expire after DOCUMENT_TTL idle seconds; least recently used
+    #entries are evicted beyond the document count or size cap.
+    #With a db_path the documents live in SQLite instead, so every worker
+    #process sees the same sessions and the same caps.
+    def __init__(self, ttl=DOCUMENT_TTL, max_documents=DOCUMENT_STORE_MAX_DOCUMENTS, max_bytes=DOCUMENT_STORE_MAX_BYTES,
+                 db_path=SESSION_DB):
+        self.ttl = ttl
+        self.max_documents = max_documents
+        self.max_bytes = max_bytes
+        self.documents = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        self.db = None
+        if db_path:
+            self.db = open_session_db(db_path)
+            self.db.execute("CREATE TABLE IF NOT EXISTS documents (document_id TEXT PRIMARY KEY, data TEXT, last_access REAL, size INTEGER DEFAULT 0)")
+            columns = [row[1] for row in self.db.execute("PRAGMA table_info(documents)")]
+            if "size" not in columns: #Session files created before the size cap
+                self.db.execute("ALTER TABLE documents ADD COLUMN size INTEGER DEFAULT 0")
+            self.db.commit()
+
+    def _save(self, doc):
+        self.db.execute("INSERT OR REPLACE INTO documents (document_id, data, last_access, size) VALUES (?, ?, ?, ?)",
+                        (doc["document_id"], json.dumps(doc), doc["last_access"], doc["size"]))
+        self._evict_db()
+        self.db.commit()
+
+    def _evict_db(self):
+        #Same policy as _evict, shared by all workers: expired rows first, then
+        #the least recently used rows beyond the document count or size cap
+        self.db.execute("DELETE FROM documents WHERE last_access < ?", (time.time() - self.ttl,))
+        self.db.execute(
+            "DELETE FROM documents WHERE document_id IN ("
+            " SELECT document_id FROM ("
+            "  SELECT document_id,"
+            "   ROW_NUMBER() OVER (ORDER BY last_access DESC) AS position,"
+            "   SUM(size) OVER (ORDER BY last_access DESC ROWS UNBOUNDED PRECEDING) AS running_size"
+            "  FROM documents)"
+            " WHERE position > ? OR running_size > ?)",
+            (self.max_documents, self.max_bytes))
+
+    def _load(self, document_id):
+        row = self.db.execute("SELECT data FROM documents WHERE document_id = ? AND last_access >= ?",
+                              (document_id, time.time() - self.ttl)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    @staticmethod
+    def _size(doc):
+        #Approximate: text is the bulk of every entry
+        pages = doc.get("pages") or []
+        return len(doc["text"]) + sum(len(p["text"]) for p in pages) + len(json.dumps(doc.get("risk_factors") or []))
+
+    def _evict(self):
+        now = time.time()
+        for document_id in [d for d, doc in self.documents.items() if now - doc["last_access"] > self.ttl]:
+            self.total_bytes -= self.documents.pop(document_id)["size"]
+        while self.documents and (len(self.documents) > self.max_documents or self.total_bytes > self.max_bytes):
+            _, doc = self.documents.popitem(last=False)
+            self.total_bytes -= doc["size"]
+
+    def create(self, text, filename, pages=None):
+        document_id = str(uuid.uuid4())
+        now = time.time()
+        doc = {
+            "document_id": document_id,
+            "filename": filename,
+            "text": text,
+            "pages": pages,
+            "summary": None,
+            "risk_factors": None,
+            "created": now,
+            "last_access": now,
+        }
+        doc["size"] = self._size(doc)
+        with self.lock:
+            if self.db is not None:
+                self._save(doc)
+                return document_id
+            self.documents[document_id] = doc
+            self.total_bytes += doc["size"]
+            self._evict()
+        return document_id
+
+    def get(self, document_id):
+        with self.lock:
+            if self.db is not None:
+                doc = self._load(document_id)
+                if doc is None:
+                    raise DocumentNotFoundError(f"Document {document_id} not found or expired")
+                doc["last_access"] = time.time()
+                self.db.execute("UPDATE documents SET last_access = ? WHERE document_id = ?", (doc["last_access"], document_id))
+                self.db.commit()
+                return doc
+            self._evict()
+            doc = self.documents.get(document_id)
+            if doc is None:
+                raise DocumentNotFoundError(f"Document {document_id} not found or expired")
+            doc["last_access"] = time.time()
+            self.documents.move_to_end(document_id)
+            return doc
+
+    def update(self, document_id, **fields):
+        with self.lock:
+            if self.db is not None:
+                doc = self._load(document_id)
+                if doc is not None:
+                    doc.update(fields, last_access=time.time())
+                    doc["size"] = self._size(doc)
+                    self._save(doc)
+                return
+            doc = self.documents.get(document_id)
+            if doc is None:
+                return
+            doc.update(fields)
+            self.total_bytes -= doc["size"]
+            doc["size"] = self._size(doc)
+            self.total_bytes += doc["size"]
+            doc["last_access"] = time.time()
+            self._evict()
+
+    def stats(self):
+        with self.lock:
+            if self.db is not None:
+                count, size = self.db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM documents").fetchone()
+                return {"documents": count, "bytes": size}
+            return {"documents": len(self.documents), "bytes": self.total_bytes}
+
+DOCUMENTS = DocumentStore()
+
+#Stored document for a request body's document_id, or None when the
+#client sent its data inline
+def request_document(data):
+    document_id = data.get("document_id")
+    return DOCUMENTS.get(document_id) if document_id else None
+
+#------------------------------
+#Document Analysis Jobs
+#------------------------------
+class JobQueueFullError(Exception):
+    #Raised when too many jobs are already queued or running
+    pass
+
+class Job:
+    #A document analysis running in the background.
+    #Progress is recorded as a list of stage events that clients can poll or stream.
+    def __init__(self, kind):
+        self.id = str(uuid.uuid4())
+        self.kind = kind
+        self.status = "queued" #queued/running/done/failed
+        self.events = []
+        self.result = None
+        self.error = None
+        self.error_status = 500
+        self.created = time.time()
+        self.finished = None
+        self.cond = threading.Condition()
+        self.remote = False #True for a copy of a job running in another worker
+        self.listener = None #Called after every change, see JobEngine
+        self.emit("queued")
+
+    #Read-only copy of a job saved by JobEngine
+    @classmethod
+    def restore(cls, data):
+        job = cls(data["kind"])
+        job.id = data["job_id"]
+        job.status = data["status"]
+        job.events = data["events"]
+        job.result = data["result"]
+        job.error = data["error"]
+        job.error_status = data["error_status"]
+        job.finished = data["finished"]
+        job.remote = True
+        return job
+
+    def _changed(self):
+        if self.listener is not None:
+            self.listener(self)
+
+    def emit(self, stage, **info):
+        with self.cond:
+            self.events.append({"stage": stage, "time": time.time(), **info})
+            self.cond.notify_all()
+        self._changed()
+
+    def finish(self, result=None, error=None, error_status=500):
+        with self.cond:
+            if self.finished is not None: #Already failed by JobEngine.drain
+                return
+            self.result = result
+            self.error = error
+            self.error_status = error_status
+            self.status = "failed" if error else "done"
+            self.finished = time.time()
+            self.events.append({"stage": self.status, "time": self.finished})
+            self.cond.notify_all()
+        self._changed()
+
+    def wait(self, timeout=None):
+        with self.cond:
+            self.cond.wait_for(lambda: self.finished is not None, timeout)
+            return self.finished is not None
+
+    def to_dict(self):
+        with self.cond:
+            return {
+                "job_id": self.id,
+                "kind": self.kind,
+                "status": self.status,
+                "events": list(self.events),
+                "result": self.result,
+                "error": self.error,
+            }
 
-#-----------------------------------
-# Azure Service Agent Task Functions
-#-----------------------------------
-#OCR Agent Task (reads text from image using Azure CV)
-def ocr_agent_task(image_data):
-    if not AZURE_CV_ENDPOINT or not AZURE_CV_KEY:
-        app.logger.error("OCR service not configured (missing endpoint/key)")
-        return "OCR service not configured."
-    ocr_url = AZURE_CV_ENDPOINT.rstrip('/') + "/vision/v3.2/ocr"
-    headers = {"Ocp-Apim-Subscription-Key": AZURE_CV_KEY, "Content-Type": "application/octet-stream"}
-    try:
-        response = requests.post(ocr_url, headers=headers, data=image_data)
-        response.raise_for_status()
-        analysis = response.json()
-        
-        #Assemble text from OCR response line by line
-        extracted_text = ""
-        for region in analysis.get("regions", []):
-            for line in region.get("lines", []):
-                line_text = " ".join(word["text"] for word in line.get("words", []))
-                extracted_text += line_text + "\n"
-        return extracted_text.strip()
-    except Exception as e:
-        app.logger.error(f"Error extracting text from image: {e}", exc_info=True)
-        return f"Error extracting text from image: {e}"
-    
-#PDF Agent Task-reads text from PDF using pdfminer and PyMuPDF
-def pdf_agent_task(file):
+#Run fn(job, ...) and finish the job with its result or error
+def run_job(job, fn, *args, **kwargs):
+    with job.cond:
+        job.status = "running"
+    job.emit("started")
     try:
-        if isinstance(file, dict):
-            raise ValueError("Invalid file format received") #Validation
-            
-        file_data = BytesIO(file.read())
-        text = extract_text(file_data)
-        file_data.seek(0)
-
-        #if text is empty or too short use PyMuPDF(fallback)
-        if not text or len(text.strip()) < 20:
-            doc = fitz.open(stream=file_data, filetype="pdf")
-            text = ""
-            for page in doc:
-                text += page.get_text("text")
-        return text.strip()
+        job.finish(result=fn(job, *args, **kwargs))
+    except AgentUnavailableError as e:
+        job.finish(error=str(e), error_status=503)
+    except DocumentProcessingError as e:
+        job.finish(error=str(e))
     except Exception as e:
-        app.logger.error(f"Error extracting text from PDF: {e}", exc_info=True)
-        return f"Error extracting text from PDF: {e}"
+        app.logger.error(f"Job {job.id} ({job.kind}) failed: {e}", exc_info=True)
+        job.finish(error="Internal server error")
 
-#Translation Agent Task
-def translation_agent_task(data):
-    text, to_lang = data.get("text"), data.get("to_lang", "en")
-    if not AZURE_TRANSLATOR_KEY or not AZURE_TRANSLATOR_ENDPOINT:
-        app.logger.error("Translation service not configured (missing endpoint/key)")
-        return text #Fallback to original text
-    endpoint = f"https://api.cognitive.microsofttranslator.com/translate?api-version=3.0&to={to_lang}"
-    headers = {
-        'Ocp-Apim-Subscription-Key': AZURE_TRANSLATOR_KEY,
-        'Ocp-Apim-Subscription-Region': AZURE_TRANSLATOR_REGION,
-        'Content-type': 'application/json'
-    }
-    body = [{"Text": text}]
-    try:
-        response = requests.post(endpoint, headers=headers, json=body)
-        response.raise_for_status()
-        return response.json()[0]["translations"][0]["text"]
-    except Exception as e:
-        app.logger.error(f"Translation failed: {e}", exc_info=True)
-        return text
+class JobEngine:
+    #Runs jobs on a fixed thread pool with a bounded number of unfinished jobs.
+    #Finished jobs are kept for JOB_RESULT_TTL seconds.
+    #With a db_path every change is also saved to SQLite, so other worker
+    #processes can answer status and event requests for the job.
+    POLL_INTERVAL = 0.5 #Seconds between checks on a job running in another worker
 
-#Risk Agent Task
-#Extracts risks from the document using LLM
-def risk_agent_task(data):
-    text = data.get("text")
-    filename = data.get("filename")
-    return extract_and_score_risks(text, filename)
+    def __init__(self, workers=JOB_WORKERS, queue_limit=JOB_QUEUE_LIMIT, ttl=JOB_RESULT_TTL, db_path=SESSION_DB):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job")
+        self.queue_limit = queue_limit
+        self.ttl = ttl
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.accepting = True
+        self.db = None
+        self.db_lock = threading.Lock()
+        if db_path:
+            self.db = open_session_db(db_path)
+            self.db.execute("CREATE TABLE IF NOT EXISTS jobs (job_id TEXT PRIMARY KEY, data TEXT, finished REAL)")
+            self.db.commit()
 
-#Speech Agent Task
-def speech_agent_task(data):
-    summary = html.escape(data.get("summary", ""))
-    risk_factors = data.get("risk_factors", [])
-    target_lang = data.get("target_lang", "en")
+    def _save(self, job):
+        with job.cond:
+            data = {**job.to_dict(), "error_status": job.error_status, "finished": job.finished}
+        with self.db_lock:
+            self.db.execute("INSERT OR REPLACE INTO jobs (job_id, data, finished) VALUES (?, ?, ?)",
+                            (job.id, json.dumps(data), job.finished))
+            self.db.commit()
 
-    #For English use different voices based on severity
-    english_voice_map = {
-        "High Risk": ("en-US-GuyNeural", "newscast"),
-        "Moderate Risk": ("en-US-AriaNeural", "chat"),
-        "Informational": ("en-US-JennyNeural", "cheerful")
-    }
-    #For other languages use a single voice
-    lang_voice_map = {
-        "es": "es-ES-AlvaroNeural",
-        "fr": "fr-FR-DeniseNeural",
-        "it": "it-IT-DiegoNeural",
-        "de": "de-DE-ConradNeural",
-        "pt": "pt-PT-DuarteNeural",
-        "ta": "ta-IN-ValluvarNeural",
-        "zh-Hans": "zh-CN-YunxiNeural"
-    }
-    #Helper function to wrap clauses in SSML speech format
-    def wrap_clause(clause_text, severity, lang="en"):
-        clause_text = html.escape(clause_text)
-        if lang == "en":
-            voice, style = english_voice_map.get(severity, english_voice_map["Informational"])
-            return f"""
-            <voice name="{voice}">
-                <mstts:express-as style="{style}">
-                    <prosody rate="medium" pitch="default">
-                        {clause_text}
-                    </prosody>
-                </mstts:express-as>
-            </voice>
-            """
-        else:
-            voice = lang_voice_map.get(lang, "en-US-JennyNeural")
-            return f"""
-            <voice name="{voice}">
-                <prosody rate="medium" pitch="default">
-                    {clause_text}
-                </prosody>
-            </voice>
-            """
-        
-    #prepare summary and risk factors for speech synthesis    
-    if target_lang == "en":
-        summary_voice = "en-US-JennyNeural"
-        summary_style = "general"
-    else:
-        summary_voice = lang_voice_map.get(target_lang, "en-US-JennyNeural")
-        summary_style = ""
-    summary_block = f"""
-    <voice name="{summary_voice}">
-        <mstts:express-as style="{summary_style}">""" if summary_style else f"""<voice name="{summary_voice}">"""
-    summary_block += f"""
-            <prosody rate="medium" pitch="default">{summary}</prosody>
-        </mstts:express-as></voice>""" if summary_style else "</voice>"
-    speech_body = summary_block
-
-    #Wrap each risk factor into the speech body
-    if risk_factors:
-        for item in risk_factors:
-            clause_text = item.get("text", "")
-            severity = item.get("severity", "Informational")
-            speech_body += wrap_clause(clause_text, severity, lang=target_lang)
-    else:
-        speech_body += wrap_clause("No legal risks or obligations were found in this document.", "Informational", lang=target_lang)
-    
-    #Final SSML body
-    ssml = f"""
-    <speak version="1.0" xml:lang="en-US"
-           xmlns:mstts="http://www.w3.org/2001/mstts"
-           xmlns="http://www.w3.org/2001/10/synthesis">
-        {speech_body}
-    </speak>
-    """
+    def _load(self, job_id):
+        with self.db_lock:
+            row = self.db.execute("SELECT data FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return Job.restore(json.loads(row[0])) if row else None
 
-    #Send request to Azure Speech service API
-    tts_url = f"https://{SPEECH_REGION}.tts.speech.microsoft.com/cognitiveservices/v1"
-    headers = {
-        "Ocp-Apim-Subscription-Key": SPEECH_KEY,
-        "Content-Type": "application/ssml+xml",
-        "X-Microsoft-OutputFormat": "audio-16khz-128kbitrate-mono-mp3",
-    }
-    try:
-        response = requests.post(tts_url, headers=headers, data=ssml.encode("utf-8"))
-        response.raise_for_status()
-        return response.content
-    except Exception as e:
-        app.logger.error(f"Speech synthesis failed: {e}", exc_info=True)
-        return None
+    def purge_expired(self):
+        now = time.time()
+        with self.lock:
+            expired = [job_id for job_id, job in self.jobs.items()
+                       if job.finished is not None and now - job.finished > self.ttl]
+            for job_id in expired:
+                del self.jobs[job_id]
+        if self.db is not None:
+            with self.db_lock:
+                self.db.execute("DELETE FROM jobs WHERE finished IS NOT NULL AND finished < ?", (now - self.ttl,))
+                self.db.commit()
 
-# -------------------------------------------
-# Risk Extraction  with Severity Tags (LLM)
-#--------------------------------------------
-def extract_and_score_risks(text, filename=None):
-    prompt = (
-        "You are a legal document assistant. Analyze the document below and extract ONLY the clauses that include penalties/penalty, "
-        "fees, user obligations, personal data usage, disqualification, or legal consequences.\n"
-        "Ignore general descriptions or unrelated content.\n"
-        "Format your response as follows:\n"
-        "Title: [Your Title Here]\n"
-        "- [High Risk] Clause in plain English\n"
-        "- [Moderate Risk] Another clause...\n"
-        "- [Informational] Mild clauses, optional duties, or user advice\n\n"
-        "If no risks are found, return:\n"
-        "Title: No risks detected\n"
-        "- [Informational] No legal risks or obligations were found in this document.\n\n"
-        f"{text}"
-    )
-    def parse_gpt_response(response_text, original_text, filename=None):
-        title = ""
-        risks = []
-        lines = response_text.splitlines()
-        for line in lines:
-            line = line.strip()
-            if not line:
-                continue
-            if line.lower().startswith("title:"):
-                potential_title = line.split(":", 1)[1].strip()
-                if len(potential_title) > 3:
-                    title = potential_title
-            elif re.match(r"^-\s+\[(High Risk|Moderate Risk|Informational)\]\s+", line):
-                match = re.match(r"^-\s+\[(.*?)\]\s+(.*)", line)
-                if match:
-                    severity = match.group(1).strip()
-                    clause_text = match.group(2).strip()
-                    if clause_text:
-                        risks.append({"text": clause_text, "severity": severity})
-        if not title:
-            original_lines = original_text.splitlines()
-            for orig_line in original_lines:
-                orig_line = orig_line.strip()
-                if 5 < len(orig_line) < 100:
-                    title = orig_line
-                    break
-            if not title and filename:
-                name = os.path.splitext(filename)[0]
-                title = f"{name.capitalize()} Document Summary"
-
-        #To sort the risks by severity        
-        severity_order = { 
-            "High Risk": 0,
-            "Moderate Risk": 1,
-            "Informational": 2
-        }
-        risks.sort(key=lambda r: severity_order.get(r["severity"], 3))
-        return {
-            "title": title,
-            "risks": risks
-        }
+    def submit(self, kind, fn, *args, **kwargs):
+        #fn(job, *args, **kwargs) returns the job result; exceptions fail the job
+        self.purge_expired()
+        with self.lock:
+            if not self.accepting:
+                raise JobQueueFullError("Server is shutting down")
+            if sum(1 for job in self.jobs.values() if job.finished is None) >= self.queue_limit:
+                raise JobQueueFullError(f"Too many pending jobs ({self.queue_limit})")
+            job = Job(kind)
+            if self.db is not None:
+                job.listener = self._save
+                self._save(job)
+            self.jobs[job.id] = job
+        self.executor.submit(self._run, job, fn, args, kwargs)
+        return job
+
+    def _run(self, job, fn, args, kwargs):
+        run_job(job, fn, *args, **kwargs)
+
+    def get(self, job_id):
+        self.purge_expired()
+        with self.lock:
+            job = self.jobs.get(job_id)
+        if job is None and self.db is not None:
+            job = self._load(job_id)
+        return job
+
+    #Job state once it has more than `sent` events, or after timeout.
+    #Returns None if a job from another worker has expired meanwhile.
+    def wait_for_events(self, job, sent, timeout):
+        if not job.remote:
+            with job.cond:
+                job.cond.wait_for(lambda: len(job.events) > sent, timeout=timeout)
+            return job.to_dict()
+        deadline = time.monotonic() + timeout
+        state = job.to_dict()
+        while len(state["events"]) <= sent and time.monotonic() < deadline:
+            time.sleep(self.POLL_INTERVAL)
+            job = self._load(job.id)
+            if job is None:
+                return None
+            state = job.to_dict()
+        return state
+
+    #Stop taking jobs and wait up to timeout for unfinished ones.
+    #Jobs still unfinished after that are failed so clients stop waiting.
+    def drain(self, timeout):
+        with self.lock:
+            self.accepting = False
+            pending = [job for job in self.jobs.values() if job.finished is None]
+        deadline = time.monotonic() + timeout
+        for job in pending:
+            job.wait(max(0, deadline - time.monotonic()))
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        unfinished = [job for job in pending if job.finished is None]
+        for job in unfinished:
+            job.finish(error="Server shut down before the job finished", error_status=503)
+        return len(unfinished)
+
+    def stats(self):
+        with self.lock:
+            counts = defaultdict(int)
+            for job in self.jobs.values():
+                counts[job.status] += 1
+            return dict(counts)
+
+JOBS = JobEngine()
+
+def get_manager_agent():
+    manager_agents = [a for a in AGENTS.values() if isinstance(a, ManagerAgent)]
+    if not manager_agents:
+        raise DocumentProcessingError("No manager agent available")
+    return manager_agents[0]
+
+#Drop placeholder/duplicate risks and derive the summary line
+def finalize_risk_result(result):
+    #Filter out empty or irrvelavant risks
+    result["risks"] = [
+        r for r in result["risks"]
+        if r["text"].strip().lower() != "no legal risks or obligations were found in this document."
+    ]
     
-    max_text_length = 12000
-    processed_text = text[:max_text_length] if len(text) > max_text_length else text
+    #Remove duplicate and near-duplicate risks. Risks are ordered by
+    #severity, so the one kept from each group is the most severe.
+    kept = collapse_near_duplicates([r["text"] for r in result["risks"]], RISK_DUPLICATE_THRESHOLD)
+    result["risks"] = [result["risks"][i] for i in kept]
     
-    if AZURE_OPENAI_KEY and AZURE_OPENAI_DEPLOYMENT and AZURE_OPENAI_ENDPOINT:
+    #If no risks found, add a default message
+    #and set summary to "No risks detected"
+    if not result["risks"]:
+        result["summary"] = "No risks detected"
+        result["risks"] = [{
+            "text": "No legal risks or obligations were found in this document.",
+            "severity": "Informational"
+        }]
+    else:
+        result["summary"] = result["title"] if result["title"].strip().lower() != "no risks detected" else "Document Summary"
+    return result
+
+#------------------------------
+# Upload Ingestion
+#------------------------------
+class UploadRejectedError(Exception):
+    #Raised for an upload over the size/page limits or unreadable as its type
+    def __init__(self, message, status=413):
+        super().__init__(message)
+        self.status = status
+
+#Reject a file over the size limit for its type
+def check_upload_size(filename, size):
+    limit = UPLOAD_MAX_BYTES[file_kind(filename)]
+    if size > limit:
+        raise UploadRejectedError(f"{filename} is larger than the {limit} byte limit for {file_kind(filename)} files")
+
+#"pdf", "image" or "text", from the file extension
+def file_kind(filename):
+    extension = filename.rsplit('.', 1)[-1].lower()
+    if extension == "pdf":
+        return "pdf"
+    if extension in ("png", "jpg", "jpeg"):
+        return "image"
+    return "text"
+
+UPLOAD_MAX_BYTES = {"pdf": PDF_MAX_BYTES, "image": IMAGE_MAX_BYTES, "text": TEXT_MAX_BYTES}
+
+class UploadSpool:
+    #Where Werkzeug writes each multipart file while parsing the request: in
+    #memory up to UPLOAD_SPOOL_BYTES, then a named temp file. The content is
+    #hashed as it arrives, so an Upload can take the file over as it is.
+    #Reads, seeks etc. go to the active buffer or file.
+    def __init__(self, suffix=""):
+        self.suffix = suffix
+        self.buffer = BytesIO()
+        self.file = None
+        self.path = None
+        self.size = 0
+        self.digest = hashlib.sha256()
+
+    def write(self, data):
+        self.digest.update(data)
+        self.size += len(data)
+        if self.file is None and self.size > UPLOAD_SPOOL_BYTES:
+            fd, self.path = tempfile.mkstemp(prefix="legaleagleeye_upload_", suffix=self.suffix)
+            self.file = os.fdopen(fd, "w+b")
+            self.file.write(self.buffer.getvalue())
+            self.buffer = None
+        return (self.file or self.buffer).write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.file if self.file is not None else self.buffer, name)
+
+    #Hand the temp file to its new owner, who deletes it
+    def detach(self):
+        path, self.path = self.path, None
+        self.file.close()
+        return path
+
+    def close(self):
+        (self.file if self.file is not None else self.buffer).close()
+        if self.path is not None:
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+            self.path = None
+
+class UploadRequest(Request):
+    #Spool uploaded files into an UploadSpool rather than Werkzeug's
+    #anonymous temp files
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return UploadSpool(os.path.splitext(filename or "")[1])
+
+app.request_class = UploadRequest
+
+class Upload:
+    #One uploaded document, held at most once per worker. Up to
+    #UPLOAD_SPOOL_BYTES it is kept as bytes; larger files live in a private
+    #temp file that is memory-mapped. Request files are taken over from
+    #their UploadSpool; other streams (ZIP members) are copied in chunks.
+    #PDF extraction opens a spooled file by path, in-process and in pool
+    #workers alike, and the content hash is computed while spooling, so a
+    #PDF's pages are never all resident. The analysis pipeline closes it
+    #once the text is extracted.
+    def __init__(self, filename, data=b"", path=None, digest=None):
+        self.filename = filename
+        self.kind = file_kind(filename)
+        self.path = path
+        self.file = None
+        self.data = data #bytes, or an mmap of the spooled file
+        self.digest = digest or content_hash(data)
+        if path is not None and os.path.getsize(path):
+            self.file = open(path, "rb")
+            self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    #Upload of a request file's stream, taking over its UploadSpool
+    #(already hashed and on disk if large) instead of copying it again
+    @classmethod
+    def from_request_file(cls, filename, stream, size):
+        if not isinstance(stream, UploadSpool):
+            return cls.from_stream(filename, stream, size)
+        check_upload_size(filename, stream.size)
+        if stream.path is None:
+            return cls(filename, data=stream.buffer.getvalue(), digest=stream.digest.hexdigest()).validate()
+        return cls(filename, path=stream.detach(), digest=stream.digest.hexdigest()).validate()
+
+    #Spool a readable stream (ZIP member), enforcing the size limit for its
+    #type before and while copying
+    @classmethod
+    def from_stream(cls, filename, stream, size=None):
+        if size is not None:
+            check_upload_size(filename, size)
+        head = stream.read(UPLOAD_SPOOL_BYTES + 1)
+        if len(head) <= UPLOAD_SPOOL_BYTES:
+            return cls(filename, data=head).validate()
+        fd, path = tempfile.mkstemp(prefix="legaleagleeye_upload_", suffix=os.path.splitext(filename)[1])
         try:
-            openai.api_type = "azure"
-            openai.api_base = AZURE_OPENAI_ENDPOINT
-            openai.api_key = AZURE_OPENAI_KEY
-            openai.api_version = "2023-05-15"
-            response = openai.ChatCompletion.create(
-                engine=AZURE_OPENAI_DEPLOYMENT,
-                messages=[
-                    {"role": "system", "content": prompt},
-                    {"role": "user", "content": processed_text}
-                ],
-                temperature=0.4,
-                max_tokens=800
-            )
-            output = response['choices'][0]['message']['content'].strip()
-            return parse_gpt_response(output, text, filename)
-        except Exception as e:
-            app.logger.error(f"Azure GPT failed: {e}", exc_info=True)
-    
-    if OPENAI_API_KEY:
+            with os.fdopen(fd, "wb") as out:
+                digest = hashlib.sha256(head)
+                written = len(head)
+                out.write(head)
+                del head
+                while True:
+                    chunk = stream.read(1024 * 1024)
+                    if not chunk:
+                        break
+                    written += len(chunk)
+                    check_upload_size(filename, written)
+                    digest.update(chunk)
+                    out.write(chunk)
+        except BaseException:
+            os.unlink(path)
+            raise
+        return cls(filename, path=path, digest=digest.hexdigest()).validate()
+
+    #Reject PDFs over PDF_MAX_UPLOAD_PAGES and images over IMAGE_MAX_PIXELS
+    #from their headers, before any extraction work is queued
+    def validate(self):
         try:
-            openai.api_version = ""
-            openai.api_type = "openai"
-            openai.api_base = "https://api.openai.com/v1"
-            openai.api_key = OPENAI_API_KEY
-            response = openai.ChatCompletion.create(
-                model="gpt-3.5-turbo-16k",
-                messages=[
-                    {"role": "system", "content": prompt},
-                    {"role": "user", "content": processed_text}
-                ],
-                temperature=0.4,
-                max_tokens=800
-            )
-            output = response['choices'][0]['message']['content'].strip()
-            return parse_gpt_response(output, text, filename)
-        except Exception as e:
-            app.logger.error(f"OpenAI fallback failed: {e}", exc_info=True)
-            return {"title": "Risk Detection Failed", "risks": [{"text": str(e), "severity": "Error"}]}
-    
-    return {"title": "Risk Detection Failed", "risks": [{"text": "No valid API key available.", "severity": "Error"}]}
+            if self.kind == "pdf":
+                try:
+                    with open_pdf(self.source) as doc:
+                        page_count = doc.page_count
+                except Exception:
+                    raise UploadRejectedError(f"{self.filename} is not a valid PDF", 400)
+                if PDF_MAX_UPLOAD_PAGES and page_count > PDF_MAX_UPLOAD_PAGES:
+                    raise UploadRejectedError(f"{self.filename} has {page_count} pages, the limit is {PDF_MAX_UPLOAD_PAGES}")
+            elif self.kind == "image":
+                try:
+                    with Image.open(BytesIO(self.data) if self.path is None else self.path) as img:
+                        width, height = img.size
+                except Exception:
+                    raise UploadRejectedError(f"{self.filename} is not a valid image", 400)
+                if width * height > IMAGE_MAX_PIXELS:
+                    raise UploadRejectedError(f"{self.filename} is {width}x{height} pixels, the limit is {IMAGE_MAX_PIXELS}")
+        except UploadRejectedError:
+            self.close()
+            raise
+        return self
+
+    #What the PDF extractors read: the spooled path, or the bytes
+    @property
+    def source(self):
+        return self.path if self.path is not None else self.data
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.data = b""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.path is not None:
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+            self.path = None
+
+#Extract text from an Upload based on file type (PDF, IMAGE, TEXT).
+#Returns (text, pages); pages is the per-page PDF text or None.
+#Re-uploads of the same bytes reuse the previously extracted text.
+def extract_document_text(manager, upload, bypass_cache=False, offload=False):
+    file_extension = upload.filename.rsplit('.', 1)[-1].lower()
+    text_key = f"{file_extension}:{upload.digest}"
+    cached = None if bypass_cache else TEXT_CACHE.get(text_key)
+    if isinstance(cached, str): #Entries written before pages were cached
+        return cached, None
+    if cached is not None:
+        return cached["text"], cached["pages"]
+    pages = None
+    if upload.kind == "pdf":
+        extracted = manager.delegate_task("pdf", {"data": upload.source, "pages": True, "offload": offload})
+        if not isinstance(extracted, dict):
+            raise DocumentProcessingError(str(extracted))
+        text, pages = extracted["text"].strip(), extracted["pages"]
+    elif upload.kind == "image":
+        text = manager.delegate_task("ocr", bytes(upload.data)) #Images are small, see IMAGE_MAX_BYTES
+    else:
+        try:
+            text = str(upload.data, 'utf-8')
+        except UnicodeDecodeError:
+            raise DocumentProcessingError(f"{upload.filename} is not a PDF, image or UTF-8 text file")
+    if not text.strip():
+        raise DocumentProcessingError("No text could be extracted from the document.")
+    TEXT_CACHE.set(text_key, {"text": text, "pages": pages})
+    return text, pages
+
+#Full upload pipeline, reporting each finished stage on the job.
+#The text and analysis are kept in DOCUMENTS under the returned document_id.
+def analyze_document(job, upload, target_lang="en", bypass_cache=False, include_text=True, offload=False, precompute=False):
+    manager = get_manager_agent()
+    filename = upload.filename
+    try:
+        text, pages = extract_document_text(manager, upload, bypass_cache, offload)
+    finally:
+        upload.close()
+    document_id = DOCUMENTS.create(text, filename, pages)
+    job.emit("extracted", characters=len(text), document_id=document_id)
+    get_document_index(text) #Ready for /ask before the client's first question
+
+    #Analyze the text for risks
+    result = cached_risk_analysis(manager, text, filename, bypass_cache)
+    if isinstance(result, str):
+        raise DocumentProcessingError(result)
+    result = finalize_risk_result(result)
+    DOCUMENTS.update(document_id, summary=result["summary"], risk_factors=result["risks"])
+    job.emit("analyzed", risks=len(result["risks"]), incomplete=result.get("incomplete", False))
+    if precompute:
+        schedule_precompute(text, result["risks"], target_lang)
+
+    response = {
+        "document_id": document_id,
+        "summary": result["summary"],
+        "risk_factors": result["risks"],
+        "incomplete": result.get("incomplete", False)
+    }
+    if result.get("incomplete"):
+        response["failed_sections"] = result["failed_sections"]
+    if include_text:
+        response["full_text"] = text
+    if target_lang and target_lang != "en":
+        texts = [result["summary"]] + [r["text"] for r in result["risks"]]
+        translated = manager.delegate_task("translation", {"texts": texts, "to_lang": target_lang})
+        if isinstance(translated, list):
+            response["translation"] = {
+                "target_lang": target_lang,
+                "summary": translated[0],
+                "risk_factors": [
+                    {**r, "text": t}
+                    for r, t in zip(result["risks"], translated[1:])
+                ]
+            }
+            job.emit("translated", target_lang=target_lang)
+    return response
 
+#Read the uploaded file from the current request and queue an analysis job
+def submit_upload_job():
+    #Checked before the body is parsed; Flask enforces it again while reading
+    if (request.content_length or 0) > MAX_REQUEST_BYTES:
+        return None, (jsonify({"error": f"Request is larger than the {MAX_REQUEST_BYTES} byte limit"}), 413)
+    if 'file' not in request.files:
+        return None, (jsonify({'error': 'No file provided'}), 400)
+    file = request.files['file']
+    if file.filename == '':
+        return None, (jsonify({'error': 'No file selected'}), 400)
+    bypass_cache = request.form.get("bypass_cache", "").lower() in ("1", "true", "yes")
+    #Clients that use document_id can skip receiving the full text back
+    include_text = request.form.get("include_text", "true").lower() not in ("0", "false", "no")
+    target_lang = request.form.get("target_lang", "en")
+    #Size the upload from the request's spooled stream
+    file.stream.seek(0, os.SEEK_END)
+    size = file.stream.tell()
+    file.stream.seek(0)
+    try:
+        upload = Upload.from_request_file(file.filename, file.stream, size)
+    except UploadRejectedError as e:
+        return None, (jsonify({"error": str(e)}), e.status)
+    try:
+        job = JOBS.submit("analyze", analyze_document, upload, target_lang, bypass_cache, include_text, precompute=True)
+    except Exception:
+        upload.close()
+        raise
+    return job, None
 
 #------------------------------
 #Document Processing Endpoints
@@ -445,76 +3287,223 @@ def upload_document():
         return jsonify({"status": "ok"}), 200
     
     try:
-        #check if the file is uploaded
-        if 'file' not in request.files:
-            return jsonify({'error': 'No file provided'}), 400
-        file = request.files['file']
-        if file.filename == '':
-            return jsonify({'error': 'No file selected'}), 400
-        
-        #Determine file type(PDF,IMAGE,TEXT)
-        file_extension = file.filename.rsplit('.', 1)[-1].lower()
-        
-        #Find manager agent
-        manager_agents = [a for a in AGENTS.values() if isinstance(a, ManagerAgent)]
-        
-        if not manager_agents:
-            return jsonify({"error": "No manager agent available"}), 500
-        manager = manager_agents[0]
-        
-        #Process the file based on its type
-        if file_extension == 'pdf':
-            file_data = BytesIO(file.read())
-            file.seek(0)
-            text = manager.delegate_task("pdf", file_data)
-        elif file_extension in ['png', 'jpg', 'jpeg']:
-            image_data = file.read()
-            file.seek(0)
-            text = manager.delegate_task("ocr", image_data)
-        else:
-            text = file.read().decode('utf-8')
-            file.seek(0)
-        
-        #Analyze the text for risks 
-        result = manager.delegate_task("risk_analysis", {"text": text, "filename": file.filename})
-        
-        if isinstance(result, str):
-            return jsonify({"error": result}), 500
-        
-        #Filter out empty or irrvelavant risks
-        result["risks"] = [
-            r for r in result["risks"]
-            if r["text"].strip().lower() != "no legal risks or obligations were found in this document."
-        ]
-        
-        #Remove duplicate risks
-        seen = set()
-        result["risks"] = [
-            r for r in result["risks"]
-            if not (r["text"] in seen or seen.add(r["text"]))
-        ]
-        
-        #If no risks found, add a default message
-        #and set summary to "No risks detected"
-        if not result["risks"]:
-            result["summary"] = "No risks detected"
-            result["risks"] = [{
-                "text": "No legal risks or obligations were found in this document.",
-                "severity": "Informational"
-            }]
-        else:
-            result["summary"] = result["title"] if result["title"].strip().lower() != "no risks detected" else "Document Summary"
+        #Run the analysis as a job and wait for it to finish
+        job, error_response = submit_upload_job()
+        if error_response:
+            return error_response
+        job.wait()
+        if job.error:
+            return jsonify({"error": job.error}), job.error_status
 
         #Return the final result as JSON including summary, risks and full text    
-        return jsonify({
-            "summary": result["summary"],
-            "risk_factors": result["risks"],
-            "full_text": text
-        })
+        return jsonify(job.result)
+    except JobQueueFullError as e:
+        return jsonify({"error": str(e)}), 503
     except Exception as e:
         app.logger.error(f"CRITICAL ERROR IN /upload: {e}", exc_info=True)
         return jsonify({'error': 'Internal server error'}), 500
 
+@app.route("/jobs", methods=["POST", "OPTIONS"])
+def submit_job():
+    if request.method == "OPTIONS":
+        return jsonify({"status": "ok"}), 200
+
+    try:
+        job, error_response = submit_upload_job()
+        if error_response:
+            return error_response
+        return jsonify({
+            "job_id": job.id,
+            "status": job.status,
+            "status_url": f"/jobs/{job.id}",
+            "events_url": f"/jobs/{job.id}/events"
+        }), 202
+    except JobQueueFullError as e:
+        return jsonify({"error": str(e)}), 503
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def get_job(job_id):
+    job = JOBS.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found or expired"}), 404
+    return jsonify(job.to_dict())
+
+#Server-Sent Events stream of job stages; the final event carries the result
+@app.route("/jobs/<job_id>/events", methods=["GET"])
+def stream_job_events(job_id):
+    job = JOBS.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found or expired"}), 404
+
+    def generate():
+        sent = 0
+        while True:
+            state = JOBS.wait_for_events(job, sent, timeout=15)
+            if state is None:
+                return
+            events = state["events"][sent:]
+            if not events:
+                yield ": keep-alive\n\n"
+                continue
+            for event in events:
+                sent += 1
+                payload = dict(event)
+                if event["stage"] == "done":
+                    payload["result"] = state["result"]
+                elif event["stage"] == "failed":
+                    payload["error"] = state["error"]
+                yield sse_event(event["stage"], payload)
+            if state["status"] in ("done", "failed") and sent >= len(state["events"]):
+                return
+
+    return Response(stream_with_context(generate()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+#------------------------------
+#Bulk Analysis
+#------------------------------
+#Shared by all /bulk requests so a few large batches can't starve each other
+#of upstream quota. PDFs are extracted in the process pool, and LLM calls
+#are bounded per document (RISK_CHUNK_CONCURRENCY) and per upstream.
+BULK_EXECUTOR = ThreadPoolExecutor(max_workers=BULK_CONCURRENCY, thread_name_prefix="bulk")
+
+class BulkRequestError(Exception):
+    #Raised for a /bulk request with no usable files or over the limits
+    pass
+
+#(filename, Upload or None, rejection or None) for every uploaded file, with
+#ZIP archives expanded. Directories, hidden files and macOS metadata inside
+#archives are skipped. Files over their type's limits are reported in the
+#stream instead of failing the whole batch.
+def bulk_files():
+    files = []
+    total = 0
+
+    def add(filename, stream, size):
+        try:
+            files.append((filename, Upload.from_request_file(filename, stream, size), None))
+        except UploadRejectedError as e:
+            files.append((filename, None, str(e)))
+
+    try:
+        for upload in request.files.getlist("files") + request.files.getlist("file"):
+            if not upload.filename:
+                continue
+            upload.stream.seek(0, os.SEEK_END)
+            size = upload.stream.tell()
+            upload.stream.seek(0)
+            if not upload.filename.lower().endswith(".zip"):
+                total += size
+                if total > BULK_MAX_BYTES:
+                    raise BulkRequestError(f"Bulk upload is larger than {BULK_MAX_BYTES} bytes")
+                add(upload.filename, upload.stream, size)
+                continue
+            try:
+                with zipfile.ZipFile(upload.stream) as archive:
+                    members = [
+                        m for m in archive.infolist()
+                        if not m.is_dir() and not any(part.startswith((".", "__MACOSX")) for part in m.filename.split("/"))
+                    ]
+                    #Check the declared sizes before inflating anything
+                    total += sum(m.file_size for m in members)
+                    if total > BULK_MAX_BYTES:
+                        raise BulkRequestError(f"Bulk upload is larger than {BULK_MAX_BYTES} bytes")
+                    if len(files) + len(members) > BULK_MAX_FILES:
+                        raise BulkRequestError(f"Too many documents, the limit is {BULK_MAX_FILES}")
+                    for member in members:
+                        with archive.open(member) as stream:
+                            add(member.filename, stream, member.file_size)
+            except zipfile.BadZipFile:
+                raise BulkRequestError(f"{upload.filename} is not a valid ZIP archive")
+        if not files:
+            raise BulkRequestError("No files provided")
+        if len(files) > BULK_MAX_FILES:
+            raise BulkRequestError(f"Too many documents ({len(files)}), the limit is {BULK_MAX_FILES}")
+    except BaseException:
+        for _, upload, _ in files:
+            if upload is not None:
+                upload.close()
+        raise
+    return files
+
+#Seconds spent in each stage, from the job's events
+def job_timings(job):
+    times = {event["stage"]: event["time"] for event in job.events}
+    timings = {}
+    previous = times.get("started")
+    for stage, name in (("extracted", "extract"), ("analyzed", "analyze"), ("translated", "translate")):
+        if stage in times and previous is not None:
+            timings[name] = round(times[stage] - previous, 3)
+            previous = times[stage]
+    if "started" in times and job.finished:
+        timings["total"] = round(job.finished - times["started"], 3)
+    return timings
+
+#One NDJSON line per document as soon as it finishes, then a batch summary.
+#A client that disconnects cancels the documents that haven't started yet.
+def stream_bulk_results(files, target_lang, bypass_cache, include_text):
+    started = time.time()
+    jobs = {}
+    rejected = []
+    for index, (filename, upload, error) in enumerate(files):
+        if upload is None:
+            rejected.append({"type": "document", "index": index, "filename": filename, "status": "failed", "error": error})
+            continue
+        job = Job("bulk")
+        future = BULK_EXECUTOR.submit(run_with_priority, "bulk", run_job, job, analyze_document, upload, target_lang,
+                                      bypass_cache, include_text, True)
+        jobs[future] = (index, filename, job, upload)
+    succeeded = 0
+    severities = defaultdict(int)
+    try:
+        for line in rejected:
+            yield json.dumps(line) + "\n"
+        for future in as_completed(jobs):
+            index, filename, job, _ = jobs[future]
+            line = {"type": "document", "index": index, "filename": filename, "timings": job_timings(job)}
+            if job.error:
+                line.update(status="failed", error=job.error)
+            else:
+                succeeded += 1
+                line.update(status="done", **job.result)
+                for risk in job.result["risk_factors"]:
+                    severities[risk["severity"]] += 1
+            yield json.dumps(line) + "\n"
+        seconds = time.time() - started
+        yield json.dumps({
+            "type": "summary",
+            "documents": len(files),
+            "succeeded": succeeded,
+            "failed": len(files) - succeeded,
+            "risk_counts": dict(severities),
+            "seconds": round(seconds, 3),
+            "documents_per_second": round(len(files) / seconds, 3) if seconds > 0 else None
+        }) + "\n"
+    finally:
+        for future, (_, _, _, upload) in jobs.items():
+            if future.cancel():
+                upload.close()
+
+#Analyze many documents in parallel: multipart "files" (repeatable), each a
+#document or a ZIP of documents. Responds with NDJSON, see stream_bulk_results.
+@app.route("/bulk", methods=["POST", "OPTIONS"])
+def bulk_analyze():
+    if request.method == "OPTIONS":
+        return jsonify({"status": "ok"}), 200
+    if DRAINING.is_set():
+        return jsonify({"error": "Server is shutting down"}), 503
+    try:
+        files = bulk_files()
+    except BulkRequestError as e:
+        return jsonify({"error": str(e)}), 400
+    bypass_cache = request.form.get("bypass_cache", "").lower() in ("1", "true", "yes")
+    #Full texts make a bulk response huge; they stay available by document_id
+    include_text = request.form.get("include_text", "false").lower() in ("1", "true", "yes")
+    target_lang = request.form.get("target_lang", "en")
+    return Response(stream_with_context(stream_bulk_results(files, target_lang, bypass_cache, include_text)),
+                    mimetype="application/x-ndjson",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 @app.route("/translate", methods=["POST", "OPTIONS"])
 def translate_risks():
     if request.method == "OPTIONS":
@@ -522,8 +3511,9 @@ def translate_risks():
     
     try:
         data = request.json
-        summary = data.get("summary", "")
-        risk_factors = data.get("risk_factors", [])
+        doc = request_document(data) or {}
+        summary = data.get("summary") or doc.get("summary") or ""
+        risk_factors = data.get("risk_factors") or doc.get("risk_factors") or []
         target_lang = data.get("target_lang", "en")
 
         #Find manager agent
@@ -532,16 +3522,24 @@ def translate_risks():
             return jsonify({"error": "No manager agent available"}), 500
         manager = manager_agents[0]
 
-        #Translates the summary and risk factors using Azure Translator
-        translated_summary = manager.delegate_task("translation", {"text": summary, "to_lang": target_lang})
-        translated_risks = []
-        for rf in risk_factors:
-            translated_text = manager.delegate_task("translation", {"text": rf["text"], "to_lang": target_lang})
-            translated_risks.append({"text": translated_text, "severity": rf["severity"]})
+        #Translates the summary and risk factors in one batched Azure Translator call
+        texts = [summary] + [rf["text"] for rf in risk_factors]
+        translated = manager.delegate_task("translation", {"texts": texts, "to_lang": target_lang})
+        if isinstance(translated, str):
+            return jsonify({"error": translated}), 500
+        translated_summary = translated[0]
+        translated_risks = [
+            {**rf, "text": text}
+            for rf, text in zip(risk_factors, translated[1:])
+        ]
         return jsonify({
             "summary": translated_summary,
             "risk_factors": translated_risks
         })
+    except AgentUnavailableError as e:
+        return jsonify({"error": str(e)}), 503
+    except DocumentNotFoundError as e:
+        return jsonify({"error": str(e)}), 404
     except Exception as e:
         app.logger.error(f"Error in /translate: {e}", exc_info=True)
         return jsonify({"error": f"Translation failed: {e}"}), 500
@@ -553,8 +3551,10 @@ def speak_text():
     
     try:
         data = request.json
-        summary = html.escape(data.get("summary", ""))
-        risk_factors = data.get("risk_factors", [])
+        doc = request_document(data) or {}
+        #Text is escaped when each segment's SSML is built
+        summary = data.get("summary") or doc.get("summary") or ""
+        risk_factors = data.get("risk_factors") or doc.get("risk_factors") or []
         target_lang = data.get("target_lang", "en")
 
         #Find the manager agent
@@ -563,25 +3563,31 @@ def speak_text():
             return jsonify({"error": "No manager agent available"}), 500
         manager = manager_agents[0]
 
-        #Generate speech
-        audio_bytes = manager.delegate_task("speech", {"summary": summary, "risk_factors": risk_factors, "target_lang": target_lang})
-        if not audio_bytes:
+        #Generate speech segment by segment
+        chunks = manager.delegate_task("speech", {"summary": summary, "risk_factors": risk_factors, "target_lang": target_lang, "stream": True})
+        first_chunk = next(chunks, None) if not isinstance(chunks, str) else None
+        if not first_chunk:
             return jsonify({"error": "Speech synthesis failed"}), 500
-        #return the audio file as a response
-        #Set the content type to audio/mpeg
-        return send_file(BytesIO(audio_bytes), mimetype="audio/mpeg", as_attachment=False, download_name="speech.mp3")
+
+        #Stream the MP3 segments in order as they are ready, so playback
+        #starts after the first one. Set the content type to audio/mpeg
+        def generate():
+            yield first_chunk
+            yield from chunks
+
+        return Response(stream_with_context(generate()), mimetype="audio/mpeg",
+                        headers={"Content-Disposition": "inline; filename=speech.mp3"})
+    except AgentUnavailableError as e:
+        return jsonify({"error": str(e)}), 503
+    except DocumentNotFoundError as e:
+        return jsonify({"error": str(e)}), 404
     except Exception as e:
         app.logger.error(f"Error in /speak: {e}", exc_info=True)
         return jsonify({"error": f"Speech synthesis failed: {e}"}), 500
 
-@app.route("/ask", methods=["POST"])
-def ask_about_clause():
-    data = request.json
-    user_question = data.get("question")
-    risk_factors = data.get("risk_factors", [])
-    full_text = data.get("full_text", "")
-    target_lang = data.get("target_lang", "en")
-
+#Build the retrieval-augmented prompt for a document question.
+#Only the top-k passages are included, so prompt size doesn't grow with the document.
+def build_ask_prompt(user_question, risk_factors, full_text):
     # Build retrieval context
     context = ""
     if risk_factors:
@@ -589,9 +3595,10 @@ def ask_about_clause():
         for r in risk_factors:
             context += f"- [{r['severity']}] {r['text']}\n"
     if full_text:
-        context += "\n---\nFull Document Content:\n" + full_text
+        passages = retrieve_passages(full_text, user_question)
+        context += "\n---\nRelevant Document Content:\n" + "\n...\n".join(passages)
 
-    rag_prompt = f"""
+    return f"""
 You are a helpful legal assistant. Use the information below to answer the user’s legal question accurately and clearly.
 If the answer is not found, respond honestly with "I'm not sure based on this document".
 
@@ -604,64 +3611,304 @@ If the answer is not found, respond honestly with "I'm not sure based on this do
 ### Answer:
 """
 
-    answer = None
+#------------------------------
+# Answer Cache (/ask)
+#------------------------------
+#Answers keyed by everything that goes into the prompt: the document text,
+#its risk clauses and the normalized question, plus the answer language
+ANSWER_CACHE = ResultCache("answer", ANSWER_CACHE_SIZE, ttl=ANSWER_CACHE_TTL)
+PRECOMPUTE_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ask-precompute")
+
+#Question with case, punctuation and spacing ignored
+def normalize_question(question):
+    return re.sub(r"[^a-z0-9]+", " ", (question or "").lower()).strip()
 
-    # Try Azure first
-    if AZURE_OPENAI_KEY and AZURE_OPENAI_DEPLOYMENT and AZURE_OPENAI_ENDPOINT:
+def answer_cache_key(question, risk_factors, full_text, lang):
+    risks = "\n".join(f"[{r['severity']}] {r['text']}" for r in risk_factors)
+    return (f"{content_hash(full_text)}:{content_hash(risks)[:16]}:"
+            f"{content_hash(normalize_question(question))[:16]}:{risk_model_id()}:{lang}")
+
+def ask_messages(rag_prompt):
+    return [
+        {"role": "system", "content": "You are a legal reasoning assistant."},
+        {"role": "user", "content": rag_prompt}
+    ]
+
+#A translation that failed: an "Error: ..." string from the agent, or the
+#original text handed back when Translator is down or not configured
+def translation_failed(original, translated):
+    return not isinstance(translated, str) or not translated or translated.startswith("Error") or translated.strip() == original.strip()
+
+#Translate an English answer and cache it under its language.
+#A failed translation is not cached; the English answer is returned instead.
+def translate_answer(answer, question, risk_factors, full_text, target_lang, manager):
+    translated = manager.delegate_task("translation", {"text": answer, "to_lang": target_lang})
+    if translation_failed(answer, translated):
+        return answer
+    ANSWER_CACHE.set(answer_cache_key(question, risk_factors, full_text, target_lang), translated)
+    return translated
+
+#Cached answer in target_lang, translating a cached English answer when
+#only that is known. None on a miss.
+def cached_answer(question, risk_factors, full_text, target_lang, manager):
+    answer = ANSWER_CACHE.get(answer_cache_key(question, risk_factors, full_text, target_lang))
+    if answer is not None or target_lang == "en":
+        return answer
+    english = ANSWER_CACHE.get(answer_cache_key(question, risk_factors, full_text, "en"))
+    if english is None or manager is None:
+        return english
+    return translate_answer(english, question, risk_factors, full_text, target_lang, manager)
+
+#Answer a question about a document in target_lang through the cache.
+#The English answer is cached too, so other languages only pay for translation.
+def answer_question(question, risk_factors, full_text, target_lang, manager):
+    answer = cached_answer(question, risk_factors, full_text, target_lang, manager)
+    if answer is not None:
+        return answer
+    rag_prompt = build_ask_prompt(question, risk_factors, full_text)
+    response = LLM_ROUTER.chat(ask_messages(rag_prompt), temperature=0.3, max_tokens=500)
+    answer = response['choices'][0]['message']['content'].strip()
+    if answer:
+        ANSWER_CACHE.set(answer_cache_key(question, risk_factors, full_text, "en"), answer)
+    if target_lang != "en" and answer and manager is not None:
+        answer = translate_answer(answer, question, risk_factors, full_text, target_lang, manager)
+    return answer
+
+#Answer ASK_PRECOMPUTE_QUESTIONS for a freshly analyzed document, so those
+#questions come straight from ANSWER_CACHE. Runs one question at a time at
+#"bulk" priority, behind any interactive call.
+def precompute_answers(full_text, risk_factors, target_lang):
+    manager = get_manager_agent()
+    for question in ASK_PRECOMPUTE_QUESTIONS:
+        if DRAINING.is_set():
+            return
         try:
-            openai.api_type = "azure"
-            openai.api_base = AZURE_OPENAI_ENDPOINT
-            openai.api_key = AZURE_OPENAI_KEY
-            openai.api_version = "2023-05-15"
-
-            response = openai.ChatCompletion.create(
-                engine=AZURE_OPENAI_DEPLOYMENT,
-                messages=[
-                    {"role": "system", "content": "You are a legal reasoning assistant."},
-                    {"role": "user", "content": rag_prompt}
-                ],
-                temperature=0.3,
-                max_tokens=500
-            )
-            answer = response['choices'][0]['message']['content'].strip()
+            answer_question(question, risk_factors, full_text, target_lang, manager)
         except Exception as e:
-            print("⚠️ Azure GPT failed, switching to OpenAI:", e)
+            app.logger.warning(f"Precomputing an answer to {question!r} failed: {e}")
+            return
 
-    # Fallback to OpenAI
-    if answer is None:
+def schedule_precompute(full_text, risk_factors, target_lang):
+    if ASK_PRECOMPUTE_QUESTIONS and llm_configured():
+        PRECOMPUTE_EXECUTOR.submit(run_with_priority, "bulk", precompute_answers, full_text, risk_factors, target_lang)
+
+#Stream answer tokens from the router's preferred provider.
+#A provider is only abandoned if it fails before sending its first token.
+def stream_ask_completion(rag_prompt):
+    messages = ask_messages(rag_prompt)
+    last_error = None
+    for client in LLM_ROUTER.ordered():
+        if not LLM_ROUTER.claim(client):
+            continue
+        started = False
+        start = time.monotonic()
         try:
-            openai.api_version = ""
-            openai.api_type = "openai"
-            openai.api_base = "https://api.openai.com/v1"
-            openai.api_key = OPENAI_API_KEY
-
-            response = openai.ChatCompletion.create(
-                model="gpt-3.5-turbo",
-                messages=[
-                    {"role": "system", "content": "You are a legal reasoning assistant."},
-                    {"role": "user", "content": rag_prompt}
-                ],
-                temperature=0.3,
-                max_tokens=500
-            )
-            answer = response['choices'][0]['message']['content'].strip()
+            response = client.chat(messages, temperature=0.3, max_tokens=500, stream=True)
+            for chunk in response:
+                #Azure sends chunks without choices (content filter results)
+                choices = chunk.get("choices") or []
+                token = choices[0].get("delta", {}).get("content") if choices else None
+                if token:
+                    if not started:
+                        #Time to first token is the latency that matters for streaming
+                        LLM_ROUTER.record(client, True, time.monotonic() - start)
+                    started = True
+                    yield token
+            return
         except Exception as e:
-            print("❌ OpenAI fallback also failed:", e)
-            return jsonify({"answer": "⚠️ Something went wrong."}), 500
+            if started:
+                raise
+            LLM_ROUTER.record(client, False)
+            app.logger.error(f"{client.name} streaming failed: {e}", exc_info=True)
+            last_error = e
+    raise last_error or LLMUnavailableError("No chat provider available")
 
-    # Translate answer if needed
-    if target_lang != "en" and answer:
-        manager_agents = [a for a in AGENTS.values() if isinstance(a, ManagerAgent)]
-        if manager_agents:
-            manager = manager_agents[0]
-            translated_answer = manager.delegate_task("translation", {"text": answer, "to_lang": target_lang})
-            answer = translated_answer
+SENTENCE_END = re.compile(r"(?<=[.!?。！？])\s+")
+
+#Format one Server-Sent Event
+def sse_event(event, payload):
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+#SSE stream of an answer. For non-English targets, complete sentences are
+#translated in batches while the rest of the answer is still generating.
+#The finished answer is cached under cache_keys ({language: key}).
+def stream_answer_events(rag_prompt, target_lang, manager, cache_keys=None):
+    translate_sentences = target_lang != "en" and manager is not None
+    pending = deque() #(sentences, translation future), in answer order
+    buffer = ""
+    answer = ""
+    english = ""
+    translated = True #False once a sentence comes back untranslated
+
+    def translate(text):
+        return text, ASYNC_ENGINE.submit(manager.delegate_task_async("translation", {"text": text, "to_lang": target_lang}))
+
+    def translated_event(item):
+        #Translator trims whitespace, so put the sentence gap back
+        nonlocal answer, translated
+        original, future = item
+        text = future.result()
+        if translation_failed(original, text):
+            translated = False
+            text = original.strip()
+        if answer and not answer[-1].isspace():
+            text = " " + text
+        answer += text
+        return sse_event("token", {"text": text})
+
+    try:
+        for token in stream_ask_completion(rag_prompt):
+            english += token
+            if not translate_sentences:
+                answer += token
+                yield sse_event("token", {"text": token})
+                continue
+            buffer += token
+            parts = SENTENCE_END.split(buffer)
+            if len(parts) > 1:
+                buffer = parts[-1]
+                pending.append(translate(" ".join(parts[:-1])))
+            while pending and pending[0][1].done():
+                yield translated_event(pending.popleft())
+        if translate_sentences:
+            if buffer.strip():
+                pending.append(translate(buffer))
+            while pending:
+                yield translated_event(pending.popleft())
+        if cache_keys and english.strip():
+            ANSWER_CACHE.set(cache_keys["en"], english.strip())
+            if translate_sentences and translated:
+                ANSWER_CACHE.set(cache_keys[target_lang], answer)
+        yield sse_event("done", {"answer": answer})
+    except Exception as e:
+        app.logger.error(f"Streaming answer failed: {e}", exc_info=True)
+        yield sse_event("error", {"answer": "⚠️ Something went wrong."})
+    finally:
+        for _, future in pending: #Client went away
+            future.cancel()
+
+@app.route("/ask", methods=["POST"])
+def ask_about_clause():
+    data = request.json
+    doc = request_document(data) or {}
+    user_question = data.get("question")
+    risk_factors = data.get("risk_factors") or doc.get("risk_factors") or []
+    full_text = data.get("full_text") or doc.get("text") or ""
+    target_lang = data.get("target_lang", "en")
+    manager_agents = [a for a in AGENTS.values() if isinstance(a, ManagerAgent)]
+    manager = manager_agents[0] if manager_agents else None
+
+    #Stream tokens as SSE when asked to, otherwise answer with JSON as before
+    if data.get("stream") or "text/event-stream" in request.headers.get("Accept", ""):
+        sse_headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        answer = cached_answer(user_question, risk_factors, full_text, target_lang, manager)
+        if answer is not None:
+            events = sse_event("token", {"text": answer}) + sse_event("done", {"answer": answer})
+            return Response(events, mimetype="text/event-stream", headers=sse_headers)
+        rag_prompt = build_ask_prompt(user_question, risk_factors, full_text)
+        cache_keys = {lang: answer_cache_key(user_question, risk_factors, full_text, lang) for lang in {"en", target_lang}}
+        return Response(stream_with_context(stream_answer_events(rag_prompt, target_lang, manager, cache_keys)),
+                        mimetype="text/event-stream", headers=sse_headers)
+
+    # Router picks Azure or OpenAI and falls back on failure; repeated questions come from the cache
+    try:
+        answer = answer_question(user_question, risk_factors, full_text, target_lang, manager)
+    except Exception as e:
+        app.logger.error(f"All LLM providers failed: {e}", exc_info=True)
+        return jsonify({"answer": "⚠️ Something went wrong."}), 500
 
     return jsonify({"answer": answer})  
          
 #---------------------------------
 # HITL feature (Human in the loop)
 #---------------------------------
+class ClauseNotFoundError(Exception):
+    #Raised when none of the rejected clause IDs or spans are in the document
+    pass
+
+#Sections behind the rejected clause IDs and text spans. A span is
+#{"start", "end"} character offsets into the text or an excerpt of it.
+#Clauses of a span that no section contains (e.g. ones pre-screening
+#skipped) become a section of their own so the model gets to see them.
+#Returns ([(section id, text)], IDs and spans that could not be found).
+def rejected_sections(text, sections, previous, rejected_ids, spans):
+    texts = dict(sections)
+    section_of = {r["id"]: r.get("section") for r in previous if r.get("id")}
+    selected = {}
+    unresolved = []
+    for risk_id in rejected_ids:
+        sid = section_of.get(risk_id)
+        if sid in texts:
+            selected[sid] = texts[sid]
+        else:
+            unresolved.append(risk_id)
+
+    clauses = []
+    offset = 0
+    for clause in split_into_clauses(text):
+        start = text.find(clause, offset)
+        if start < 0:
+            continue
+        clauses.append((start, start + len(clause), clause))
+        offset = start + len(clause)
+    section_clauses = {sid: set(split_into_clauses(section)) for sid, section in sections}
+    for span in spans:
+        if isinstance(span, str):
+            start = text.find(span)
+            end = start + len(span)
+        else:
+            start, end = int(span.get("start", -1)), int(span.get("end", -1))
+        hit = [clause for s, e, clause in clauses if s < end and e > start] if 0 <= start < end else []
+        if not hit:
+            unresolved.append(span)
+            continue
+        matched = [sid for sid, _ in sections if any(clause in section_clauses[sid] for clause in hit)]
+        for sid in matched:
+            selected[sid] = texts[sid]
+        if not matched:
+            excerpt = "\n\n".join(hit)
+            selected[section_id(excerpt)] = excerpt
+    return list(selected.items()), unresolved
+
+#Re-analyze only the sections behind rejected clauses/spans and keep every
+#other clause as it was. Rejected sections skip the known-clause library,
+#so a reviewer can overrule it. Returns the merged result and a diff
+#against the previous clauses, or an error string.
+def incremental_regeneration(manager, text, filename, summary, previous, rejected_ids, spans):
+    sections, unresolved = rejected_sections(text, risk_sections(text), previous, rejected_ids, spans)
+    if not sections:
+        raise ClauseNotFoundError("None of the rejected clauses or spans were found in the document")
+    result = manager.delegate_task("risk_analysis", {
+        "text": text, "filename": filename, "sections": sections, "refresh": True, "library": False
+    })
+    if isinstance(result, str):
+        return result, None
+    if result.get("title") == "Risk Detection Failed":
+        return result["risks"][0]["text"], None
+
+    #Sections that failed again keep their previous clauses
+    failed = result.get("failed_sections", [])
+    redone = {sid for sid, _ in sections} - set(failed)
+    kept = [r for r in previous if r.get("section") not in redone]
+    merged = merge_risk_results([(summary, kept), ("", result["risks"])], text, filename, failed)
+    #A later full analysis of the same text starts from the reviewed result
+    if not failed and result.pop("cacheable", True):
+        RISK_CACHE.set(risk_cache_key(text), merged)
+
+    previous_ids = {r.get("id") for r in previous}
+    new_ids = {r["id"] for r in result["risks"]}
+    diff = {
+        "sections": sorted(redone),
+        "added": [r for r in result["risks"] if r["id"] not in previous_ids],
+        "removed": [r for r in previous if r.get("section") in redone and r.get("id") not in new_ids],
+        "kept": sum(1 for r in kept if r.get("id")),
+        "unresolved": unresolved
+    }
+    return merged, diff
+
+#Full regeneration by default. With "rejected_ids" (clause IDs) and/or
+#"spans", only the sections behind them go back to the model and the
+#response carries a "diff" against the previous risk_factors.
 @app.route("/regenerate", methods=["POST", "OPTIONS"])
 def regenerate_analysis():
     if request.method == "OPTIONS":
@@ -669,8 +3916,11 @@ def regenerate_analysis():
     
     try:
         data = request.json
-        text = data.get("full_text", "")
-        filename = data.get("filename", "document.txt")
+        doc = request_document(data)
+        text = data.get("full_text") or (doc["text"] if doc else "")
+        filename = data.get("filename") or (doc["filename"] if doc else "document.txt")
+        #Regeneration asks for a fresh analysis by default; the new result replaces the cached one
+        bypass_cache = data.get("bypass_cache", True)
         
         # Get manager agent
         manager_agents = [a for a in AGENTS.values() if isinstance(a, ManagerAgent)]
@@ -678,47 +3928,106 @@ def regenerate_analysis():
             return jsonify({"error": "No manager agent available"}), 500
         manager = manager_agents[0]
         
-        # Call risk analysis agent again
-        result = manager.delegate_task("risk_analysis", {"text": text, "filename": filename})
+        rejected_ids = data.get("rejected_ids") or []
+        spans = data.get("spans") or []
+        diff = None
+        if rejected_ids or spans:
+            previous = data.get("risk_factors") or (doc["risk_factors"] if doc else None) or []
+            summary = data.get("summary") or (doc["summary"] if doc else None) or ""
+            result, diff = incremental_regeneration(manager, text, filename, summary, previous, rejected_ids, spans)
+        else:
+            # Call risk analysis agent again
+            result = cached_risk_analysis(manager, text, filename, bypass_cache)
         
         if isinstance(result, str):
             return jsonify({"error": result}), 500
         
-        # Process results by removing empty or irrelevant risks
-        result["risks"] = [
-            r for r in result["risks"]
-            if r["text"].strip().lower() != "no legal risks or obligations were found in this document."
-        ]
-        
-        #Remove duplicate risks
-        seen = set()
-        result["risks"] = [
-            r for r in result["risks"]
-            if not (r["text"] in seen or seen.add(r["text"]))
-        ]
-        
-        #Handle no risks found scenarios
-        if not result["risks"]:
-            result["summary"] = "No risks detected"
-            result["risks"] = [{
-                "text": "No legal risks or obligations were found in this document.",
-                "severity": "Informational"
-            }]
-        else:
-            result["summary"] = result["title"] if result["title"].strip().lower() != "no risks detected" else "Document Summary"
-            
-        return jsonify({
+        # Process results by removing empty, irrelevant or duplicate risks
+        result = finalize_risk_result(result)
+        response = {
             "summary": result["summary"],
             "risk_factors": result["risks"],
-            "full_text": text  # Return the full text to maintain state
-        })
+            "incomplete": result.get("incomplete", False)
+        }
+        if result.get("incomplete"):
+            response["failed_sections"] = result["failed_sections"]
+        if diff is not None:
+            response["diff"] = diff
+        if doc:
+            DOCUMENTS.update(doc["document_id"], summary=result["summary"], risk_factors=result["risks"])
+            response["document_id"] = doc["document_id"]
+        if "full_text" in data:
+            response["full_text"] = text  # Return the full text to maintain state
+        return jsonify(response)
+    except AgentUnavailableError as e:
+        return jsonify({"error": str(e)}), 503
+    except DocumentNotFoundError as e:
+        return jsonify({"error": str(e)}), 404
+    except ClauseNotFoundError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         app.logger.error(f"Error in /regenerate: {e}", exc_info=True)
         return jsonify({"error": f"Regeneration failed: {e}"}), 500
 
+#------------------------------
+#Monitoring Endpoints
+#------------------------------
+#Prometheus scrape endpoint; queue and job gauges are sampled on each scrape
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    for agent in list(AGENTS.values()):
+        if isinstance(agent, ManagerAgent):
+            for role, pool in agent.pools.items():
+                stats = pool.to_dict()
+                METRICS.set("agent_queue_depth", stats["waiting"], role=role)
+                METRICS.set("agents_busy", stats["busy"], role=role)
+    job_counts = JOBS.stats()
+    for status in ("queued", "running", "done", "failed"):
+        METRICS.set("jobs", job_counts.get(status, 0), status=status)
+    return Response(METRICS.render(), mimetype="text/plain; version=0.0.4")
+
+#Readiness probe: 503 until the agents exist and again once the worker is draining
+@app.route("/ready", methods=["GET"])
+def ready():
+    if DRAINING.is_set():
+        return jsonify({"status": "draining"}), 503
+    if not any(isinstance(agent, ManagerAgent) for agent in list(AGENTS.values())):
+        return jsonify({"status": "starting"}), 503
+    return jsonify({"status": "ready", "pid": os.getpid()})
+
+#Agents with their recent task records, plus pool and provider health
+@app.route("/agents", methods=["GET"])
+def agents():
+    return jsonify({
+        "agents": [agent.to_dict() for agent in list(AGENTS.values())],
+        "llm_providers": LLM_ROUTER.to_dict()
+    })
+
 #-------------------------
 #Global Error Handler
 #-------------------------
+@app.errorhandler(AgentUnavailableError)
+def handle_agent_unavailable(e):
+    app.logger.warning(f"Agent unavailable: {e}")
+    return jsonify(error=str(e)), 503
+
+@app.errorhandler(DocumentNotFoundError)
+def handle_document_not_found(e):
+    return jsonify(error=str(e)), 404
+
+@app.errorhandler(JobQueueFullError)
+def handle_job_queue_full(e):
+    app.logger.warning(f"Job queue full: {e}")
+    return jsonify(error=str(e)), 503
+
+@app.errorhandler(RequestEntityTooLarge)
+def handle_request_too_large(e):
+    return jsonify(error=f"Request is larger than the {MAX_REQUEST_BYTES} byte limit"), 413
+
+@app.errorhandler(UploadRejectedError)
+def handle_upload_rejected(e):
+    return jsonify(error=str(e)), e.status
+
 @app.errorhandler(Exception)
 def handle_exception(e):
     app.logger.error("UNHANDLED EXCEPTION", exc_info=True)
@@ -727,19 +4036,51 @@ def handle_exception(e):
 #--------------------------
 #Initialize Default Agents
 #--------------------------
+DEFAULT_AGENT_ROLES = [
+    ("PDFParser", "pdf"),
+    ("OCRScanner", "ocr"),
+    ("RiskAnalyzer", "risk_analysis"),
+    ("Translator", "translation"),
+    ("SpeechSynthesizer", "speech")
+]
+
 def initialize_default_agents():
     manager = ManagerAgent("MainManager", "manager")
-    agents = [
-        Agent("PDFParser", "pdf", manager.id),
-        Agent("OCRScanner", "ocr", manager.id),
-        Agent("RiskAnalyzer", "risk_analysis", manager.id),
-        Agent("Translator", "translation", manager.id),
-        Agent("SpeechSynthesizer", "speech", manager.id)
-    ]
-    for agent in agents:
-        manager.add_team_member(agent)
+    #Create a pool of agents per role (AGENT_POOL_SIZE or AGENT_POOL_SIZE_<ROLE>)
+    for name, role in DEFAULT_AGENT_ROLES:
+        for i in range(max(1, role_setting("AGENT_POOL_SIZE", role, AGENT_POOL_SIZE))):
+            manager.add_team_member(Agent(f"{name}-{i + 1}", role, manager.id))
     return manager
 
+#------------------------------
+#Application Entry Points
+#------------------------------
+DRAINING = threading.Event() #Set once the worker starts shutting down
+_init_lock = threading.Lock()
+
+#Application factory for WSGI servers, e.g. gunicorn -c gunicorn.conf.py.
+#Each worker process builds its own agent registry; later calls are no-ops.
+def create_app():
+    with _init_lock:
+        if not any(isinstance(agent, ManagerAgent) for agent in list(AGENTS.values())):
+            initialize_default_agents()
+    return app
+
+#Called when a worker stops: fail readiness, give unfinished jobs up to
+#timeout seconds, then stop the PDF worker processes
+def shutdown_backend(timeout=SHUTDOWN_GRACE_SECONDS):
+    DRAINING.set()
+    unfinished = JOBS.drain(timeout)
+    if unfinished:
+        app.logger.warning(f"Shut down with {unfinished} unfinished jobs")
+    with _pdf_process_pool_lock:
+        pool = _pdf_process_pool
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+    BULK_EXECUTOR.shutdown(wait=False, cancel_futures=True)
+    PRECOMPUTE_EXECUTOR.shutdown(wait=False, cancel_futures=True)
+    ASYNC_ENGINE.stop()
+
+#Development server; use gunicorn.conf.py in production
 if __name__ == "__main__":
-    initialize_default_agents()
-    app.run(debug=True, port=5001)
+    create_app().run(debug=True, port=5001)